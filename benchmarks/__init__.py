@@ -0,0 +1,5 @@
+"""
+Benchmarks for the renderer hot paths
+
+Run with `python -m benchmarks.run --help`.
+"""
@@ -0,0 +1,278 @@
+"""
+Benchmark cases
+
+Every case is a function returning (callable, rays per call). The callable is
+timed by benchmarks.run, the ray count turns the timing into rays/s and
+ns/ray(cases that trace no rays use 1 and report ns per call).
+"""
+import atexit
+import random
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from help import sampling_up_hemisphere, snell_law
+from readers.load import SceneLoader
+from readers.obj import OBJReader
+from render import INTEGRATORS
+from samplers import SAMPLERS
+from scene.bvh import BVH
+from scene.camera import Camera
+from scene.mesh import TriangleMesh
+from scene.ray import Ray
+
+SDL_FILE = Path(__file__).resolve().parent.parent / 'cornellroom' / 'cornellroom.sdl'
+SEED = 9
+
+CASES = {}
+
+
+def case(name, group):
+    """register a benchmark case"""
+    def register(setup):
+        CASES[name] = group, setup
+        return setup
+    return register
+
+
+def seed():
+    random.seed(SEED)
+    np.random.seed(SEED)
+
+
+def cornell_tracer(accelerator='auto', integrator='phong'):
+    scene = SceneLoader(SDL_FILE)
+    camera = scene.get_camera()
+    return scene, INTEGRATORS[integrator](
+        camera, scene.get_objects(), scene.get_light(), accelerator=accelerator
+    )
+
+
+def cornell_rays(n):
+    """n fixed camera rays of the Cornell room"""
+    seed()
+    scene = SceneLoader(SDL_FILE)
+    origins, directions, _ = next(scene.get_camera().generate_rays())
+    idx = np.random.choice(len(origins), n, replace=False)
+    return origins[idx], directions[idx]
+
+
+def synthetic_mesh(n_triangles):
+    """height field grid with about n_triangles triangles"""
+    k = max(2, int(np.sqrt(n_triangles/2)) + 1)
+    x, y = np.meshgrid(np.linspace(-5, 5, k), np.linspace(-5, 5, k))
+    points = np.stack((x, y, np.sin(x)*np.cos(y)), axis=-1)
+
+    a = points[:-1, :-1].reshape(-1, 3)
+    b = points[1:, :-1].reshape(-1, 3)
+    c = points[1:, 1:].reshape(-1, 3)
+    d = points[:-1, 1:].reshape(-1, 3)
+    p1, p2, p3 = np.concatenate((a, a)), np.concatenate((b, c)), np.concatenate((c, d))
+
+    return TriangleMesh(p1, p2, p3, np.zeros(len(p1)))
+
+
+def synthetic_rays(n):
+    seed()
+    origins = np.column_stack((np.random.uniform(-4, 4, (n, 2)), np.full(n, 10.0)))
+    directions = np.column_stack((np.random.normal(0, 0.1, (n, 2)), -np.ones(n)))
+    return origins, directions
+
+
+##
+## micro benchmarks
+##
+
+@case('triangles_intersect', 'micro')
+def triangles_intersect():
+    scene, _ = cornell_tracer()
+    triangles = [obj for scene_obj in scene.get_objects() for obj in scene_obj.objects]
+    origins, directions = cornell_rays(64)
+    rays = [Ray(p, v) for p, v in zip(origins, directions)]
+
+    def run():
+        for ray in rays:
+            for triangle in triangles:
+                triangle.intersect(ray)
+
+    return run, len(rays)*len(triangles)
+
+
+def send_ray(accelerator):
+    _, pt = cornell_tracer(accelerator)
+    origins, directions = cornell_rays(256)
+    rays = [Ray(p, v) for p, v in zip(origins, directions)]
+    send = pt._PathTracing__send_ray
+
+    def run():
+        for ray in rays:
+            send(ray)
+
+    return run, len(rays)
+
+
+@case('send_ray_brute', 'micro')
+def send_ray_brute():
+    return send_ray('brute')
+
+
+@case('send_ray_bvh', 'micro')
+def send_ray_bvh():
+    return send_ray('bvh')
+
+
+@case('is_shadowed', 'micro')
+def is_shadowed():
+    _, pt = cornell_tracer()
+    origins, directions = cornell_rays(256)
+    hits = [pt._PathTracing__send_ray(Ray(p, v)) for p, v in zip(origins, directions)]
+    points = [hit[0] for hit in hits if hit is not None]
+    light_points = [pt.lights[0].get_point() for _ in points]
+    shadowed = pt._PathTracing__is_shadowed
+
+    def run():
+        for point, light_point in zip(points, light_points):
+            shadowed(point, light_point)
+
+    return run, len(points)
+
+
+@case('sampling_up_hemisphere', 'micro')
+def sampling_hemisphere():
+    seed()
+    V = np.random.normal(size=(256, 3))
+    N = np.random.normal(size=(256, 3))
+
+    def run():
+        for v, n in zip(V, N):
+            sampling_up_hemisphere(v, n)
+
+    return run, len(V)
+
+
+@case('snell_law', 'micro')
+def snell():
+    seed()
+    V = np.random.normal(size=(256, 3))
+    N = np.random.normal(size=(256, 3))
+
+    def run():
+        for v, n in zip(V, N):
+            snell_law(v, n)
+
+    return run, len(V)
+
+
+@case('camera_get_rays', 'micro')
+def camera_get_rays():
+    camera = SceneLoader(SDL_FILE).get_camera()
+    w, h = camera.pixels_size
+    return camera.get_rays, w*h
+
+
+@case('camera_generate_rays', 'micro')
+def camera_generate_rays():
+    camera = SceneLoader(SDL_FILE).get_camera()
+    w, h = camera.pixels_size
+
+    def run():
+        for _ in camera.generate_rays():
+            pass
+
+    return run, w*h
+
+
+def sampler_uniform(name):
+    """4 dimensions of a bounce for a 256x256 pass"""
+    rng = SAMPLERS[name](SEED)
+    pixels = np.arange(256*256)
+
+    def run():
+        rng.uniform(pixels, 0, 1, 0, 4)
+
+    return run, len(pixels)
+
+
+for _name in SAMPLERS:
+    case(f'sampler_{_name}', 'micro')(lambda name=_name: sampler_uniform(name))
+
+
+@case('scene_loader', 'micro')
+def scene_loader():
+    def run():
+        scene = SceneLoader(SDL_FILE)
+        scene.get_objects()
+        scene.get_light()
+
+    return run, 1
+
+
+@case('scene_cache_open', 'micro')
+def scene_cache_open():
+    SceneLoader(SDL_FILE).get_compiled()
+
+    def run():
+        SceneLoader(SDL_FILE).get_compiled()
+
+    return run, 1
+
+
+##
+## macro benchmarks
+##
+
+def cornell_pass(size, integrator='phong'):
+    """one fixed seed wavefront pass over the Cornell room at size x size pixels"""
+    scene, pt = cornell_tracer(integrator=integrator)
+    sdl = scene.sdl
+    camera = Camera(sdl.eye, sdl.target, sdl.up, sdl.window_size, [size, size])
+
+    def run():
+        for origins, directions, pixels in camera.generate_rays(chunk_size=1 << 16, rng=pt.rng):
+            pt.path_tracing_wavefront(origins, directions, pixels)
+
+    return run, size*size
+
+
+for _size in (64, 128, 256):
+    case(f'cornell_pass_{_size}', 'macro')(lambda size=_size: cornell_pass(size))
+case('cornell_nee_pass_64', 'macro')(lambda: cornell_pass(64, 'nee'))
+
+
+def synthetic_build(n_triangles):
+    mesh = synthetic_mesh(n_triangles)
+    return (lambda: BVH(mesh)), 1
+
+
+def synthetic_trace(n_triangles):
+    bvh = BVH(synthetic_mesh(n_triangles))
+    origins, directions = synthetic_rays(4096)
+    return (lambda: bvh.intersect(origins, directions)), len(origins)
+
+
+def synthetic_obj_read(n_triangles):
+    """parse a v/vn/f obj file of the synthetic mesh"""
+    mesh = synthetic_mesh(n_triangles)
+    folder = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, folder, True)
+    obj_file = Path(folder) / 'synthetic.obj'
+
+    vertices = np.stack((mesh.p1, mesh.p2, mesh.p3), axis=1).reshape(-1, 3)
+    corners = np.arange(1, len(vertices) + 1).reshape(-1, 3)
+    normals = np.arange(1, len(mesh) + 1)
+    with open(obj_file, 'w') as file:
+        file.writelines(f"v {x:.6f} {y:.6f} {z:.6f}\n" for x, y, z in vertices)
+        file.writelines(f"vn {x:.6f} {y:.6f} {z:.6f}\n" for x, y, z in mesh.normal)
+        file.writelines(
+            f"f {a}//{n} {b}//{n} {c}//{n}\n" for (a, b, c), n in zip(corners, normals)
+        )
+
+    return (lambda: OBJReader.read_arrays(obj_file)), 1
+
+
+for _label, _n in (('1k', 1_000), ('100k', 100_000), ('1m', 1_000_000)):
+    case(f'synthetic_{_label}_bvh_build', 'synthetic')(lambda n=_n: synthetic_build(n))
+    case(f'synthetic_{_label}_trace', 'synthetic')(lambda n=_n: synthetic_trace(n))
+    case(f'synthetic_{_label}_obj_read', 'synthetic')(lambda n=_n: synthetic_obj_read(n))
@@ -0,0 +1,168 @@
+"""
+Benchmark runner
+
+    python -m benchmarks.run                       # micro + macro cases
+    python -m benchmarks.run --group synthetic     # 1k/100k/1M triangle scenes
+    python -m benchmarks.run --baseline benchmarks/baseline.json
+    python -m benchmarks.run --save-baseline benchmarks/baseline.json
+
+Every case runs in a fresh process so its peak RSS is its own. Results are
+written as JSON and, with --baseline, compared against a stored run: a case
+slower than the baseline by more than --tolerance is flagged as a regression
+and the runner exits with status 1.
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import queue
+import resource
+import sys
+import time
+
+import kernels
+from benchmarks.cases import CASES
+
+
+def measure(name, min_time, repeat):
+    """run one case and return its timings"""
+    _, setup = CASES[name]
+    run, rays = setup()
+
+    # warm up(caches, lazy imports)
+    run()
+
+    timings = []
+    start = time.perf_counter()
+    while len(timings) < repeat or time.perf_counter() - start < min_time:
+        t = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - t)
+
+    best = min(timings)
+    return {
+        'seconds': best,
+        'runs': len(timings),
+        'rays': rays,
+        'rays_per_sec': rays/best,
+        'ns_per_ray': best/rays*1e9,
+        # linux reports KiB
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+    }
+
+
+def _child(name, min_time, repeat, results):
+    try:
+        results.put((True, measure(name, min_time, repeat)))
+    except BaseException as error:
+        results.put((False, f"{type(error).__name__}: {error}"))
+
+
+def run_isolated(name, min_time, repeat):
+    """measure a case in a new process
+
+    Raises:
+        RuntimeError: the case raised or its process died(OOM killed, crashed)
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_child, args=(name, min_time, repeat, results))
+    process.start()
+    while True:
+        try:
+            ok, payload = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                # the result may have been queued right before the exit
+                try:
+                    ok, payload = results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    process.join()
+                    raise RuntimeError(
+                        f"{name}: benchmark process died with exit code {process.exitcode}"
+                    ) from None
+    process.join()
+    if not ok:
+        raise RuntimeError(f"{name}: {payload}")
+    return payload
+
+
+def compare(results, baseline, tolerance):
+    """return the names of the cases slower than baseline by more than tolerance"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['ns_per_ray']/baseline[name]['ns_per_ray']
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:32s} {ratio:6.2f}x baseline{flag}")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Path Tracing benchmarks")
+    parser.add_argument(
+        '--group', nargs='+', default=['micro', 'macro'],
+        choices=['micro', 'macro', 'synthetic'], help="case groups to run"
+    )
+    parser.add_argument('--only', nargs='+', default=None, help="run only these cases")
+    parser.add_argument('--min-time', type=float, default=1.0, help="min seconds per case")
+    parser.add_argument('--repeat', type=int, default=3, help="min runs per case")
+    parser.add_argument('--output', default='bench_output.json', help="results file")
+    parser.add_argument('--baseline', default=None, help="results file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed slowdown(0.1 = 10%%)")
+    parser.add_argument('--save-baseline', default=None, help="also write the results here")
+    parser.add_argument('--list', action='store_true', help="list the cases and exit")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.list:
+        for name, (group, _) in CASES.items():
+            print(f"{group:10s} {name}")
+        return 0
+
+    names = args.only or [name for name, (group, _) in CASES.items() if group in args.group]
+    unknown = set(names) - set(CASES)
+    if unknown:
+        raise ValueError(f"Unknown benchmark cases {sorted(unknown)}")
+
+    results = {}
+    for name in names:
+        result = run_isolated(name, args.min_time, args.repeat)
+        results[name] = result
+        print(
+            f"{name:32s} {result['rays_per_sec']:14.0f} rays/s {result['ns_per_ray']:14.0f} ns/ray"
+            f" {result['peak_rss_mb']:8.1f} MB"
+        )
+
+    report = {
+        'python': sys.version.split()[0],
+        'machine': platform.machine(),
+        'kernels': kernels.BACKEND,
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        if compare(results, baseline, args.tolerance):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""
+Render checkpoints
+
+A checkpoint is a .npz file with the film buffers(raw radiance sums, per
+pixel sample counts and squared luminance sums), the index of the next pass
+and the seed of the render: random numbers are keyed by (seed, pixel, pass)
+(rng.CounterRNG), so a resumed render continues exactly where it stopped.
+
+save_checkpoint - atomically write a checkpoint
+load_checkpoint - read a checkpoint
+"""
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from film import Film
+from output import FILE_MODE
+
+VERSION = 2
+
+
+def save_checkpoint(path, film, n_pass, seed):
+    """write film and seed, n_pass is the next pass to be rendered
+
+    The file is written next to path and moved over it, so an interrupted
+    write never leaves a broken checkpoint behind.
+    """
+    path = Path(path)
+
+    with tempfile.NamedTemporaryFile(dir=path.parent, suffix='.tmp', delete=False) as file:
+        np.savez(
+            file,
+            version=VERSION,
+            radiance=film.radiance,
+            counts=film.counts,
+            squares=film.squares,
+            n_pass=n_pass,
+            # may not fit an int64
+            seed=str(seed),
+        )
+        file.flush()
+        os.fsync(file.fileno())
+
+    # temporary files are private(0600), checkpoints get the usual mode
+    os.chmod(file.name, FILE_MODE)
+    os.replace(file.name, path)
+
+
+def load_checkpoint(path):
+    """read a checkpoint written by save_checkpoint
+
+    Returns:
+        film.Film, index of the next pass, seed
+    """
+    with np.load(path) as data:
+        if int(data['version']) != VERSION:
+            raise ValueError(f"Unsupported checkpoint version {int(data['version'])}")
+
+        radiance = data['radiance']
+        counts = data['counts']
+        squares = data['squares']
+        h, w = counts.shape
+
+        return Film(w, h, radiance, counts, squares), int(data['n_pass']), int(str(data['seed']))
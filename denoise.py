@@ -0,0 +1,180 @@
+"""
+Edge-avoiding a-trous denoiser
+
+The radiance of a film is divided by the first hit albedo, filtered with 5x5
+a-trous wavelet passes of growing step and multiplied back, so textures and
+colors stay sharp and only the lighting is smoothed. Every tap is weighted by
+how much the neighbour agrees with the pixel in normal, depth and luminance;
+the luminance tolerance follows the per pixel variance the film keeps, so
+converged pixels are barely touched and noisy ones are smoothed hard.
+
+AOVs - per pixel first hit albedo, normal and depth(guide buffers)
+Denoiser - film -> denoised radiance image
+"""
+import numpy as np
+
+from film import Film, luminance
+
+# B3 spline taps of one a-trous pass
+KERNEL = np.array([1/16, 1/4, 3/8, 1/4, 1/16])
+# guide buffers converge fast, a few jittered samples per pixel are enough
+AOV_SAMPLES = 8
+EPSILON = 1e-10
+
+
+class AOVs():
+    """albedo (h, w, 3), normal (h, w, 3) and depth (h, w) averaged over samples
+
+    Args:
+        w, h (int): image size in pixels
+    """
+
+    def __init__(self, w, h):
+        self.w = w
+        self.h = h
+        self.albedo = np.zeros((h, w, 3))
+        self.normal = np.zeros((h, w, 3))
+        self.depth = np.zeros((h, w))
+        self.counts = np.zeros((h, w))
+
+    @classmethod
+    def render(cls, pt, camera, samples=AOV_SAMPLES, chunk_size=None, tile=None):
+        """trace samples jittered first hits per pixel with pt.trace_aovs(jittered
+        with pt.rng, as the first samples of the render), only over the
+        (x0, y0, x1, y1) tile when given"""
+        w, h = camera.pixels_size[0], camera.pixels_size[1]
+        aovs = cls(w, h)
+        for sample in range(samples):
+            batches = camera.generate_rays(
+                tile=tile, chunk_size=chunk_size, rng=pt.rng, sample=sample
+            )
+            for origins, directions, pixels in batches:
+                aovs.add(pixels, *pt.trace_aovs(origins, directions))
+        return aovs
+
+    def add(self, pixels, albedo, normal, depth):
+        """accumulate one sample per entry, pixels may repeat"""
+        size = self.w*self.h
+        for buffer, values in ((self.albedo, albedo), (self.normal, normal)):
+            flat = buffer.reshape(-1, 3)
+            for c in range(3):
+                flat[:, c] += np.bincount(pixels, weights=values[:, c], minlength=size)
+        self.depth.reshape(-1)[:] += np.bincount(pixels, weights=depth, minlength=size)
+        self.counts.reshape(-1)[:] += np.bincount(pixels, minlength=size)
+
+    def means(self):
+        """mean albedo, unit normal(0 where nothing was hit) and mean depth"""
+        n = np.maximum(self.counts, 1)
+        albedo = self.albedo/n[:, :, None]
+        normal = self.normal/np.maximum(np.linalg.norm(self.normal, axis=2, keepdims=True), EPSILON)
+        return albedo, normal, self.depth/n
+
+
+class Denoiser():
+    """edge-avoiding a-trous filter guided by AOVs
+
+    Args:
+        aovs (AOVs): guide buffers of the image
+        iterations (int): a-trous passes, pass i spreads its taps 2^i pixels apart
+        sigma_color (float): luminance tolerance in standard deviations
+        sigma_normal (float): exponent of the normal agreement(n_p . n_q)^sigma_normal
+        sigma_depth (float): depth tolerance in units of the local depth gradient
+        window (tuple): (x0, y0, x1, y1) pixels filtered(a crop render), taps never
+            reach outside it, the whole image by default
+    """
+
+    def __init__(
+            self, aovs, iterations=5, sigma_color=4.0, sigma_normal=128.0, sigma_depth=1.0,
+            window=None
+        ):
+        self.iterations = iterations
+        self.sigma_color = sigma_color
+        self.sigma_normal = sigma_normal
+        self.sigma_depth = sigma_depth
+        self.window = window if window is not None else (0, 0, aovs.w, aovs.h)
+
+        x0, y0, x1, y1 = self.window
+        self.albedo, self.normal, self.depth = (
+            array[y0:y1, x0:x1] for array in aovs.means()
+        )
+        # lights and misses have no albedo to divide by
+        self.albedo = np.where(self.albedo > 1e-3, self.albedo, 1.0)
+        gy, gx = np.gradient(self.depth)
+        self.depth_gradient = np.hypot(gx, gy)
+
+    def __call__(self, film):
+        """denoised (h, w, 3) mean radiance of film, as it is outside the window"""
+        x0, y0, x1, y1 = self.window
+        image = film.image()
+        window = Film(
+            x1 - x0, y1 - y0, film.radiance[y0:y1, x0:x1],
+            film.counts[y0:y1, x0:x1], film.squares[y0:y1, x0:x1]
+        )
+        image[y0:y1, x0:x1] = self.__filter(window)
+        return image
+
+    def __filter(self, film):
+        """denoised mean radiance of the window film"""
+        n = np.maximum(film.counts, 1)
+        mean = luminance(film.radiance)/n
+        # variance of the mean luminance, in the same units as the demodulated color
+        variance = np.maximum(film.squares/n - mean**2, 0)/np.maximum(n - 1, 1)
+        variance = variance/np.maximum(luminance(self.albedo), EPSILON)**2
+
+        color = film.image()/self.albedo
+        for i in range(self.iterations):
+            color, variance = self.__atrous(color, variance, 1 << i)
+
+        return color*self.albedo
+
+    def __atrous(self, color, variance, step):
+        """one 5x5 pass with taps step pixels apart, returns the color and its variance"""
+        h, w = variance.shape
+        pad = 2*step
+        padded = [
+            np.pad(array, ((pad, pad), (pad, pad)) + ((0, 0),)*(array.ndim - 2))
+            for array in (color, variance, self.normal, self.depth, np.ones((h, w)))
+        ]
+
+        lum = luminance(color)
+        sigma_l = self.sigma_color*np.sqrt(blur3x3(variance)) + EPSILON
+
+        total = np.zeros((h, w, 3))
+        total_variance = np.zeros((h, w))
+        weights = np.zeros((h, w))
+
+        for dy in range(-2, 3):
+            for dx in range(-2, 3):
+                y, x = pad + dy*step, pad + dx*step
+                q_color, q_variance, q_normal, q_depth, inside = (
+                    array[y:y + h, x:x + w] for array in padded
+                )
+
+                if dy == 0 and dx == 0:
+                    weight = np.ones((h, w))
+                else:
+                    distance = step*np.hypot(dx, dy)
+                    w_depth = np.abs(self.depth - q_depth)/(
+                        self.sigma_depth*self.depth_gradient*distance + EPSILON
+                    )
+                    w_color = np.abs(lum - luminance(q_color))/sigma_l
+                    w_normal = np.maximum(
+                        np.einsum('ijk,ijk->ij', self.normal, q_normal), 0
+                    )**self.sigma_normal
+                    weight = np.exp(-w_depth - w_color)*w_normal*inside
+
+                weight = weight*KERNEL[dy + 2]*KERNEL[dx + 2]
+                total += weight[:, :, None]*q_color
+                total_variance += weight**2*q_variance
+                weights += weight
+
+        return total/weights[:, :, None], total_variance/weights**2
+
+
+def blur3x3(image):
+    """3x3 gaussian blur of a (h, w) image, edges clamped"""
+    padded = np.pad(image, 1, mode='edge')
+    h, w = image.shape
+    taps = np.array([0.25, 0.5, 0.25])
+    rows = sum(taps[i]*padded[i:i + h, :] for i in range(3))
+    return sum(taps[i]*rows[:, i:i + w] for i in range(3))
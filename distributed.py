@@ -0,0 +1,398 @@
+"""
+Distributed tile rendering
+
+A coordinator splits the image in (tile, sample range) work units and
+serves them over TCP(protocol.py messages) to any number of workers, on this
+machine or on others. No shared filesystem is needed: on connection a worker
+receives the SDL and OBJ files, compiles the scene in a private directory and
+then traces one unit after the other, answering with the radiance, sample
+count and squared luminance sums of the tile, which the coordinator adds into
+its film(the same buffers main.py accumulates).
+
+Workers may join at any time. A unit whose worker disconnects, or that is not
+back after timeout seconds, is queued again; random numbers are keyed by the
+render seed, pixel and sample number(rng.CounterRNG), so whoever traces a
+unit draws the same samples, and every unit is merged exactly once. The units
+of a tile are added in sample order, so the image is the same bit for bit
+whatever the number of workers.
+
+Coordinator - work units, worker connections and the merged film
+work - worker side: trace the units of a coordinator until it is done
+"""
+import argparse
+import asyncio
+import multiprocessing
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from film import Film
+from output import write_image
+from parallel import TILE_SIZE, split_tiles
+from protocol import read_message, write_message
+from readers.load import SceneLoader, SDL_FILE
+from render import INTEGRATORS, ROULETTE_DEPTH
+from samplers import SAMPLERS
+
+HOST = '127.0.0.1'
+PORT = 8766
+# samples per pixel of one work unit
+UNIT_SAMPLES = 4
+# seconds before the unit of a silent worker is handed to another one
+TIMEOUT = 600
+# seconds a worker keeps trying to reach the coordinator
+RETRY = 30
+# seconds local workers get to exit once the render is done
+STOP_GRACE = 5
+
+
+class Coordinator():
+    """hand out the work units of a scene and merge the answers
+
+    Args:
+        sdl_file (Path): scene description file, it and its OBJ files are sent to workers
+        passes (int): samples per pixel
+        tile_size (int): tile width/height in pixels
+        unit_samples (int): samples per pixel of one unit
+        seed (int): random numbers seed, the SDL seed(a random one without it) when None
+        integrator (str): render.INTEGRATORS name, None uses the SDL one
+        options (dict): more integrator arguments, n_reflections and sampler default to
+            the SDL ones
+        timeout (float): max seconds a worker may take on one unit
+    """
+
+    def __init__(
+            self, sdl_file=SDL_FILE, passes=100, tile_size=TILE_SIZE, unit_samples=UNIT_SAMPLES,
+            seed=None, integrator=None, options=None, timeout=TIMEOUT
+        ):
+        self.scene = SceneLoader(sdl_file)
+        self.integrator = integrator or self.scene.get_integrator()
+        if self.integrator not in INTEGRATORS:
+            raise ValueError(f"Unknown integrator {self.integrator}")
+        if seed is None:
+            seed = self.scene.get_seed()
+        self.seed = random.getrandbits(63) if seed is None else seed
+        self.options = {
+            'n_reflections': self.scene.get_reflections(), 'seed': self.seed,
+            'sampler': self.scene.get_sampler(), **(options or {})
+        }
+        self.timeout = timeout
+
+        w, h = self.scene.get_size()
+        self.film = Film(w, h)
+        # unit id -> tile, samples, first sample
+        self.units = [
+            (tile, min(unit_samples, passes - first), first)
+            for tile in split_tiles(w, h, tile_size)
+            for first in range(0, passes, unit_samples)
+        ]
+
+        # units back from a worker, (th, tw, 5) buffers of the ones not added yet and
+        # the next unit to be added of every tile(units of a tile are added in sample order)
+        self.merged = set()
+        self.early = {}
+        self.next = {unit for unit in range(len(self.units)) if self.units[unit][2] == 0}
+        self.on_unit = None
+
+    def files(self):
+        """name -> bytes of the SDL file and every OBJ file it uses"""
+        sdl = self.scene.sdl
+        names = [obj for obj, _ in sdl.objects] + [obj for obj, _, _ in sdl.lights]
+        names += [obj for obj, _, _ in sdl.instances]
+        files = {self.scene.sdl_file.name: self.scene.sdl_file.read_bytes()}
+        for name in dict.fromkeys(names):
+            files[name] = (self.scene.path / name).read_bytes()
+        return files
+
+    async def run(self, host=HOST, port=PORT, on_unit=None):
+        """serve workers until every unit is merged
+
+        Args:
+            on_unit (callable): called as on_unit(merged, total, film) after every merge
+
+        Returns:
+            film.Film with every sample
+        """
+        self.on_unit = on_unit
+        self.queue = asyncio.Queue()
+        for unit in range(len(self.units)):
+            self.queue.put_nowait(unit)
+        self.finished = asyncio.Event()
+        if not self.units:
+            self.finished.set()
+        self.connections = set()
+        # read once, sent to every worker
+        self.scene_files = self.files()
+
+        server = await asyncio.start_server(self.__worker, host, port)
+        async with server:
+            await self.finished.wait()
+        # idle workers are told to stop
+        if self.connections:
+            await asyncio.gather(*self.connections, return_exceptions=True)
+        return self.film
+
+    async def __worker(self, reader, writer):
+        """one worker connection: the scene, then units until none is left"""
+        self.connections.add(asyncio.current_task())
+        unit = None
+        try:
+            await write_message(writer, {
+                'type': 'scene', 'sdl': self.scene.sdl_file.name, 'files': len(self.scene_files),
+                'integrator': self.integrator, 'options': self.options
+            })
+            for name, data in self.scene_files.items():
+                await write_message(
+                    writer, {'type': 'file', 'name': name}, np.frombuffer(data, dtype=np.uint8)
+                )
+
+            while True:
+                unit = await self.__next_unit()
+                if unit is None:
+                    break
+                tile, samples, first = self.units[unit]
+                await write_message(writer, {
+                    'type': 'unit', 'id': unit, 'tile': tile, 'samples': samples, 'first': first
+                })
+                header, buffers = await asyncio.wait_for(read_message(reader), self.timeout)
+                if header is None:
+                    raise ConnectionError("worker closed the connection")
+                self.__merge(unit, buffers)
+                unit = None
+
+            await write_message(writer, {'type': 'done'})
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            if unit is not None and unit not in self.merged:
+                # lost with its worker, someone else traces it
+                self.queue.put_nowait(unit)
+            writer.close()
+            self.connections.discard(asyncio.current_task())
+
+    async def __next_unit(self):
+        """next queued unit, None once every unit is merged"""
+        get = asyncio.ensure_future(self.queue.get())
+        finished = asyncio.ensure_future(self.finished.wait())
+        await asyncio.wait((get, finished), return_when=asyncio.FIRST_COMPLETED)
+        finished.cancel()
+        if get.done():
+            return get.result()
+        get.cancel()
+        return None
+
+    def __merge(self, unit, buffers):
+        """add the (th, tw, 5) radiance/count/squares buffers of a unit to the film
+
+        The units of a tile are added in sample order(the ones back early wait),
+        so the floating point sums do not depend on the workers.
+        """
+        if unit in self.merged:
+            return
+        self.merged.add(unit)
+        self.early[unit] = buffers
+
+        film = self.film
+        while unit in self.next and unit in self.early:
+            buffers = self.early.pop(unit)
+            tile = self.units[unit][0]
+            x0, y0, x1, y1 = tile
+            film.radiance[y0:y1, x0:x1] += buffers[:, :, :3]
+            film.counts[y0:y1, x0:x1] += buffers[:, :, 3]
+            film.squares[y0:y1, x0:x1] += buffers[:, :, 4]
+            self.next.discard(unit)
+            # units of a tile are consecutive
+            unit += 1
+            if unit < len(self.units) and self.units[unit][0] == tile:
+                self.next.add(unit)
+
+        if self.on_unit is not None:
+            self.on_unit(len(self.merged), len(self.units), film)
+        if len(self.merged) == len(self.units):
+            self.finished.set()
+
+
+def render_unit(pt, camera, tile, samples, first):
+    """samples number first, ..., first + samples - 1 of the pixels of tile
+
+    Returns:
+        (th, tw, 5) radiance, sample counts and squared luminance sums
+    """
+    x0, y0, x1, y1 = tile
+    tw, th = x1 - x0, y1 - y0
+    w = camera.pixels_size[0]
+    film = Film(tw, th)
+    for sample in range(first, first + samples):
+        for origins, directions, pixels in camera.generate_rays(
+                tile=tile, rng=pt.rng, sample=sample
+            ):
+            local = (pixels//w - y0)*tw + pixels % w - x0
+            film.add(local, pt.path_tracing_wavefront(origins, directions, pixels, sample))
+    return np.concatenate((film.radiance, film.counts[..., None], film.squares[..., None]), axis=2)
+
+
+async def connect(host, port, retry=RETRY):
+    """open a connection, trying again for retry seconds while nobody listens"""
+    deadline = time.monotonic() + retry
+    while True:
+        try:
+            return await asyncio.open_connection(host, port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.5)
+
+
+async def work(host=HOST, port=PORT, retry=RETRY):
+    """trace the units of the coordinator at host:port until it is done
+
+    Returns:
+        number of units traced
+    """
+    reader, writer = await connect(host, port, retry)
+    units = 0
+    try:
+        with tempfile.TemporaryDirectory(prefix='pt-worker-') as root:
+            header, _ = await read_message(reader)
+            root = Path(root)
+            for _ in range(header['files']):
+                file, data = await read_message(reader)
+                name = Path(file['name'])
+                # scene files stay inside the private directory
+                if name.is_absolute() or '..' in name.parts:
+                    raise ValueError(f"Unsafe scene file name {file['name']}")
+                (root / name).parent.mkdir(parents=True, exist_ok=True)
+                (root / name).write_bytes(data.tobytes())
+
+            scene = SceneLoader(root / header['sdl'])
+            camera = scene.get_camera()
+            pt = INTEGRATORS[header['integrator']].from_compiled(
+                camera, scene.get_compiled(), **header['options']
+            )
+
+            while True:
+                message, _ = await read_message(reader)
+                if message is None or message['type'] == 'done':
+                    break
+                buffers = render_unit(
+                    pt, camera, message['tile'], message['samples'], message['first']
+                )
+                await write_message(writer, {'type': 'result', 'id': message['id']}, buffers)
+                units += 1
+    finally:
+        writer.close()
+    return units
+
+
+def run_worker(host, port, retry):
+    """process entry point of a worker"""
+    asyncio.run(work(host, port, retry))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Distributed Path Tracing render")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    coordinator = commands.add_parser('coordinator', help="serve the work units of a scene")
+    coordinator.add_argument('--sdl', default=SDL_FILE, help="scene description file")
+    coordinator.add_argument('--passes', type=int, default=100, help="samples per pixel")
+    coordinator.add_argument(
+        '--unit-samples', type=int, default=UNIT_SAMPLES, help="samples per pixel of a unit"
+    )
+    coordinator.add_argument('--tile-size', type=int, default=TILE_SIZE, help="tile size in pixels")
+    coordinator.add_argument(
+        '--integrator', choices=sorted(INTEGRATORS), default=None,
+        help="defaults to the SDL integrator"
+    )
+    coordinator.add_argument(
+        '--roulette-depth', type=int, default=ROULETTE_DEPTH, help="nee: see main.py"
+    )
+    coordinator.add_argument(
+        '--seed', type=int, default=None, help="random numbers seed, defaults to the SDL seed"
+    )
+    coordinator.add_argument(
+        '--sampler', choices=sorted(SAMPLERS), default=None, help="defaults to the SDL sampler"
+    )
+    coordinator.add_argument(
+        '--timeout', type=float, default=TIMEOUT,
+        help="seconds before the unit of a silent worker is handed out again"
+    )
+    coordinator.add_argument(
+        '--output', type=Path, default=None, help="final image, defaults to the SDL output"
+    )
+    coordinator.add_argument(
+        '--local-workers', type=int, default=0,
+        help="also start this many worker processes on this machine"
+    )
+
+    worker = commands.add_parser('worker', help="trace units for a coordinator")
+    worker.add_argument(
+        '--processes', type=int, default=1, help="worker processes started on this machine"
+    )
+    worker.add_argument(
+        '--retry', type=float, default=RETRY,
+        help="seconds to keep trying to reach the coordinator"
+    )
+
+    for command in (coordinator, worker):
+        command.add_argument('--host', default=HOST, help="coordinator address")
+        command.add_argument('--port', type=int, default=PORT, help="coordinator port")
+    return parser.parse_args()
+
+
+def start_workers(n, host, port, retry=RETRY):
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(host, port, retry)) for _ in range(n)
+    ]
+    for process in processes:
+        process.start()
+    return processes
+
+
+def stop_workers(processes, grace=STOP_GRACE):
+    """join the local workers of a finished render
+
+    Connected workers were told they are done and exit on their own, the
+    ones still trying to reach the coordinator are terminated after grace
+    seconds instead of retrying until they give up.
+    """
+    deadline = time.monotonic() + grace
+    for process in processes:
+        process.join(max(deadline - time.monotonic(), 0))
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.command == 'worker':
+        for process in start_workers(args.processes, args.host, args.port, args.retry):
+            process.join()
+
+    else:
+        coordinator = Coordinator(
+            args.sdl, args.passes, args.tile_size, args.unit_samples, args.seed,
+            args.integrator, timeout=args.timeout,
+            options=None if args.sampler is None else {'sampler': args.sampler}
+        )
+        if coordinator.integrator == 'nee':
+            coordinator.options['roulette_depth'] = args.roulette_depth
+        workers = start_workers(args.local_workers, args.host, args.port)
+        start = time.perf_counter()
+
+        def on_unit(merged, total, film):
+            elapsed = time.perf_counter() - start
+            print(f"unit {merged}/{total}: {film.counts.sum()/elapsed:.0f} samples/s")
+
+        film = asyncio.run(coordinator.run(args.host, args.port, on_unit))
+        stop_workers(workers)
+
+        output = args.output or coordinator.scene.get_output()
+        if output:
+            write_image(output, film, coordinator.scene.get_tonemapping())
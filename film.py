@@ -0,0 +1,133 @@
+"""
+Accumulation buffers
+
+Film - per pixel radiance sum, sample count and error estimate
+SharedFilm - Film living in a multiprocessing.shared_memory block
+"""
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# samples a pixel takes before its error estimate is trusted
+MIN_SAMPLES = 16
+# keeps the relative error of black pixels finite
+ERROR_EPSILON = 1e-3
+
+
+def luminance(colors):
+    return colors @ np.array([0.2126, 0.7152, 0.0722])
+
+
+def tonemap(image, tonemapping):
+    """radiance image mapped to [0, 1] with the SDL tonemapping value"""
+    kimg = image/(image + tonemapping)
+    return np.clip(kimg, 0, 1)
+
+
+class Film():
+    """radiance sum (h, w, 3), number of samples (h, w) and sum of the squared
+    sample luminances (h, w) of every pixel
+
+    Pixels are addressed by flat index row*w + column.
+    """
+
+    def __init__(self, w, h, radiance=None, counts=None, squares=None):
+        self.w = w
+        self.h = h
+        self.radiance = np.zeros((h, w, 3)) if radiance is None else radiance
+        self.counts = np.zeros((h, w)) if counts is None else counts
+        self.squares = np.zeros((h, w)) if squares is None else squares
+
+    def add(self, pixels, colors):
+        """accumulate one sample per entry, pixels may repeat"""
+        size = self.w*self.h
+        radiance = self.radiance.reshape(-1, 3)
+        for c in range(3):
+            radiance[:, c] += np.bincount(pixels, weights=colors[:, c], minlength=size)
+        self.counts.reshape(-1)[:] += np.bincount(pixels, minlength=size)
+        self.squares.reshape(-1)[:] += np.bincount(
+            pixels, weights=luminance(colors)**2, minlength=size
+        )
+
+    def fill(self, pixels, colors, stride, tile=None):
+        """coarse preview: the stride x stride block starting at every pixel(cut by
+        tile, the whole image by default) holds one sample of colors, whatever
+        it held before"""
+        x0, y0, x1, y1 = tile if tile is not None else (0, 0, self.w, self.h)
+        rows, columns = np.divmod(pixels, self.w)
+        squares = luminance(colors)**2
+        for dy in range(stride):
+            for dx in range(stride):
+                inside = (rows + dy < y1) & (columns + dx < x1)
+                j, i = rows[inside] + dy, columns[inside] + dx
+                self.radiance[j, i] = colors[inside]
+                self.counts[j, i] = 1
+                self.squares[j, i] = squares[inside]
+
+    def image(self):
+        """mean radiance of every pixel, pixels without samples are black"""
+        return self.radiance/np.maximum(self.counts, 1)[:, :, None]
+
+    def error(self):
+        """relative standard error of the mean luminance of every pixel"""
+        n = np.maximum(self.counts, 1)
+        mean = luminance(self.radiance)/n
+        variance = np.maximum(self.squares/n - mean**2, 0)*n/np.maximum(n - 1, 1)
+        return np.sqrt(variance/n)/(mean + ERROR_EPSILON)
+
+    def converged(self, threshold, min_samples=MIN_SAMPLES):
+        """(h, w) mask of the pixels whose error is below threshold"""
+        return (self.counts >= min_samples) & (self.error() < threshold)
+
+    def tonemap(self, tonemapping):
+        """image mapped to [0, 1] with the SDL tonemapping value"""
+        return tonemap(self.image(), tonemapping)
+
+    def copy(self):
+        return Film(self.w, self.h, self.radiance.copy(), self.counts.copy(), self.squares.copy())
+
+
+class SharedFilm(Film):
+    """Film whose buffers are backed by one shared memory block
+
+    The creator calls SharedFilm.create and, when done, close() and unlink().
+    Other processes open the same buffers with SharedFilm.attach(name, w, h).
+    """
+
+    def __init__(self, w, h, shm):
+        self.shm = shm
+        radiance = np.ndarray((h, w, 3), dtype=np.float64, buffer=shm.buf)
+        counts = np.ndarray((h, w), dtype=np.float64, buffer=shm.buf, offset=radiance.nbytes)
+        squares = np.ndarray(
+            (h, w), dtype=np.float64, buffer=shm.buf, offset=radiance.nbytes + counts.nbytes
+        )
+        super().__init__(w, h, radiance, counts, squares)
+
+    @classmethod
+    def create(cls, w, h):
+        shm = shared_memory.SharedMemory(create=True, size=cls.nbytes(w, h))
+        film = cls(w, h, shm)
+        film.radiance[:] = 0
+        film.counts[:] = 0
+        film.squares[:] = 0
+        return film
+
+    @classmethod
+    def attach(cls, name, w, h):
+        return cls(w, h, shared_memory.SharedMemory(name=name))
+
+    @staticmethod
+    def nbytes(w, h):
+        return w*h*5*np.dtype(np.float64).itemsize
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        # numpy views must go before the buffer is released
+        self.radiance = self.counts = self.squares = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
@@ -2,16 +2,24 @@
 
 - sampling_up_hemisphere
 - snell_law
+- sampling_up_hemisphere_batch/snell_law_batch: same methods for arrays of vectors,
+  computed by the kernels backend
+- sampling_lobe_batch: cosine power lobe directions
 """
 
 import numpy as np 
 
+import kernels
 
-def sampling_up_hemisphere(V, N):
-    """Return a vector from the hemisphere with N as the Z coordinates"""
+
+def sampling_up_hemisphere(V, N, u=None):
+    """Return a vector from the hemisphere with N as the Z coordinates
+
+    u is a pair of uniform numbers(rng.CounterRNG), drawn here when None
+    """
 
     # random selecting a vector from a hemisphere(canonical basis)
-    e1, e2 = np.random.rand(), np.random.rand()
+    e1, e2 = (np.random.rand(), np.random.rand()) if u is None else u
     a, b = np.arccos(np.sqrt(e1)), 2*np.pi*e2
 
     canonical_vector = np.array((
@@ -51,4 +59,37 @@ def snell_law(V, N, n_obj = 1.5, n_air = 1.0):
 
     T = (nr*np.dot(N, I) - np.sqrt(sqrt))*N - nr*I
 
-    return T
\ No newline at end of file
+    return T
+
+def sampling_up_hemisphere_batch(V, N, u=None):
+    """sampling_up_hemisphere for (n, 3) arrays of view vectors and normals, u is
+    (n, 2) uniform numbers or None"""
+    n = len(N)
+
+    # random selecting vectors from a hemisphere(canonical basis)
+    if u is None:
+        u = np.random.rand(n, 2)
+    return kernels.hemisphere(V, N, u[:, 0], u[:, 1])
+
+
+def sampling_lobe_batch(V, N, exponent, u=None):
+    """directions with density (exponent + 1)/(2pi)*cos^exponent around N(exponent 1
+    is sampling_up_hemisphere_batch), V only orients the basis, u as in
+    sampling_up_hemisphere_batch"""
+    n = len(N)
+    if u is None:
+        u = np.random.rand(n, 2)
+
+    # cos = e1^(1/(exponent + 1)), the kernel takes cos = sqrt(e1)
+    e1 = u[:, 0]**(2/(np.asarray(exponent) + 1))
+    return kernels.hemisphere(V, N, e1, u[:, 1])
+
+
+def snell_law_batch(V, N, n_obj = 1.5, n_air = 1.0):
+    """snell_law for (n, 3) arrays, total internal reflection returns a zero vector"""
+    return kernels.refract(V, N, n_obj, n_air)
+
+
+def normalize(V):
+    """normalize (n, 3) vectors"""
+    return kernels.normalize(V)
@@ -0,0 +1,36 @@
+"""
+Ray tracing kernels
+
+The backend is chosen once, at import time: the numba kernels when numba is
+installed, the NumPy kernels otherwise. PT_KERNELS=numpy(or numba) forces one.
+Both modules have the same functions:
+
+closest_hit, any_hit - brute force tests against packed triangles
+bvh_closest_hit, bvh_any_hit - the same through a scene.bvh.BVH
+hemisphere - cosine weighted directions around normals
+refract - snell law
+normalize - unit vectors
+
+BACKEND is the name of the backend in use.
+"""
+import os
+
+_requested = os.environ.get('PT_KERNELS', 'auto')
+if _requested not in ('auto', 'numba', 'numpy'):
+    raise ValueError(f"Unknown PT_KERNELS {_requested}")
+
+BACKEND = 'numpy'
+if _requested != 'numpy':
+    try:
+        from kernels.numba_kernels import (
+            closest_hit, any_hit, bvh_closest_hit, bvh_any_hit, hemisphere, refract, normalize
+        )
+        BACKEND = 'numba'
+    except ImportError:
+        if _requested == 'numba':
+            raise
+
+if BACKEND == 'numpy':
+    from kernels.numpy_kernels import (
+        closest_hit, any_hit, bvh_closest_hit, bvh_any_hit, hemisphere, refract, normalize
+    )
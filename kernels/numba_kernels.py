@@ -0,0 +1,317 @@
+"""
+Numba kernels, used when numba is installed
+
+Same functions and results as kernels.numpy_kernels. Every ray runs its own
+loop(brute force over the triangles, or a stack based BVH traversal) and the
+rays are spread over the cpu cores with prange.
+"""
+import numpy as np
+from numba import njit, prange
+
+# error_model='numpy': a zero direction component gives inf, not an exception
+jit = njit(cache=True, error_model='numpy')
+parallel_jit = njit(cache=True, error_model='numpy', parallel=True)
+
+
+def closest_hit(origins, directions, p1, edge1, edge2, tmin, tmax):
+    """see kernels.numpy_kernels.closest_hit"""
+    return _closest_hit(*contiguous(origins, directions, p1, edge1, edge2, tmin, tmax))
+
+
+def any_hit(origins, directions, p1, edge1, edge2, tmin, tmax):
+    """see kernels.numpy_kernels.any_hit"""
+    return _any_hit(*contiguous(origins, directions, p1, edge1, edge2, tmin, tmax))
+
+
+def bvh_closest_hit(bvh, origins, directions, tmin, tmax):
+    """see kernels.numpy_kernels.bvh_closest_hit"""
+    t, prim, visits, tests = _bvh_closest_hit(
+        *contiguous(origins, directions, tmin, tmax),
+        *contiguous(bvh.lower, bvh.upper, bvh.left, bvh.right, bvh.start, bvh.count, bvh.axis),
+        *contiguous(bvh.p1, bvh.edge1, bvh.edge2), bvh.depth + 2
+    )
+    return t, prim, int(visits.sum()), int(tests.sum())
+
+
+def bvh_any_hit(bvh, origins, directions, tmin, tmax, blockers=None):
+    """see kernels.numpy_kernels.bvh_any_hit"""
+    if blockers is None:
+        blockers = np.ones(len(bvh.p1), dtype=bool)
+    blocked, visits, tests = _bvh_any_hit(
+        *contiguous(origins, directions, tmin, tmax),
+        *contiguous(bvh.lower, bvh.upper, bvh.left, bvh.right, bvh.start, bvh.count),
+        *contiguous(bvh.p1, bvh.edge1, bvh.edge2, blockers), bvh.depth + 2
+    )
+    return blocked, int(visits.sum()), int(tests.sum())
+
+
+def hemisphere(V, N, e1, e2):
+    """see kernels.numpy_kernels.hemisphere"""
+    return _hemisphere(*contiguous(V, N, e1, e2))
+
+
+def refract(V, N, n_obj, n_air):
+    """see kernels.numpy_kernels.refract"""
+    return _refract(*contiguous(V, N), float(n_obj), float(n_air))
+
+
+def normalize(V):
+    """normalize (n, 3) vectors"""
+    return _normalize(*contiguous(V))
+
+
+def contiguous(*arrays):
+    """plain C ordered arrays, so each kernel compiles once(no broadcast views or memmaps)"""
+    return tuple(np.ascontiguousarray(array) for array in arrays)
+
+
+@jit
+def triangle_hit(ox, oy, oz, dx, dy, dz, p1, edge1, edge2, j):
+    """Moller-Trumbore, t of the hit or inf"""
+    e1x, e1y, e1z = edge1[j, 0], edge1[j, 1], edge1[j, 2]
+    e2x, e2y, e2z = edge2[j, 0], edge2[j, 1], edge2[j, 2]
+
+    px, py, pz = dy*e2z - dz*e2y, dz*e2x - dx*e2z, dx*e2y - dy*e2x
+    det = e1x*px + e1y*py + e1z*pz
+    if det == 0:
+        return np.inf
+    inv_det = 1.0/det
+
+    tx, ty, tz = ox - p1[j, 0], oy - p1[j, 1], oz - p1[j, 2]
+    u = (tx*px + ty*py + tz*pz)*inv_det
+    qx, qy, qz = ty*e1z - tz*e1y, tz*e1x - tx*e1z, tx*e1y - ty*e1x
+    v = (dx*qx + dy*qy + dz*qz)*inv_det
+    if u < 0 or v < 0 or u + v > 1:
+        return np.inf
+    return (e2x*qx + e2y*qy + e2z*qz)*inv_det
+
+
+@jit
+def fmin(a, b):
+    """np.fmin, a nan loses"""
+    if a != a:
+        return b
+    if b != b:
+        return a
+    return min(a, b)
+
+
+@jit
+def fmax(a, b):
+    """np.fmax, a nan loses"""
+    if a != a:
+        return b
+    if b != b:
+        return a
+    return max(a, b)
+
+
+@jit
+def box_hit(lower, upper, node, ox, oy, oz, ix, iy, iz):
+    """entry and exit parameters of the ray in the box of node"""
+    t1, t2 = (lower[node, 0] - ox)*ix, (upper[node, 0] - ox)*ix
+    t_near, t_far = fmin(t1, t2), fmax(t1, t2)
+    t1, t2 = (lower[node, 1] - oy)*iy, (upper[node, 1] - oy)*iy
+    t_near, t_far = fmax(t_near, fmin(t1, t2)), fmin(t_far, fmax(t1, t2))
+    t1, t2 = (lower[node, 2] - oz)*iz, (upper[node, 2] - oz)*iz
+    return fmax(t_near, fmin(t1, t2)), fmin(t_far, fmax(t1, t2))
+
+
+@parallel_jit
+def _closest_hit(origins, directions, p1, edge1, edge2, tmin, tmax):
+    n = origins.shape[0]
+    t = np.full(n, np.inf)
+    tri = np.full(n, -1, dtype=np.int64)
+
+    for i in prange(n):
+        ox, oy, oz = origins[i, 0], origins[i, 1], origins[i, 2]
+        dx, dy, dz = directions[i, 0], directions[i, 1], directions[i, 2]
+        best = tmax[i]
+        for j in range(p1.shape[0]):
+            t_hit = triangle_hit(ox, oy, oz, dx, dy, dz, p1, edge1, edge2, j)
+            if t_hit >= tmin[i] and t_hit < best:
+                best = t_hit
+                tri[i] = j
+        if tri[i] >= 0:
+            t[i] = best
+
+    return t, tri
+
+
+@parallel_jit
+def _any_hit(origins, directions, p1, edge1, edge2, tmin, tmax):
+    n = origins.shape[0]
+    blocked = np.zeros(n, dtype=np.bool_)
+
+    for i in prange(n):
+        ox, oy, oz = origins[i, 0], origins[i, 1], origins[i, 2]
+        dx, dy, dz = directions[i, 0], directions[i, 1], directions[i, 2]
+        for j in range(p1.shape[0]):
+            t_hit = triangle_hit(ox, oy, oz, dx, dy, dz, p1, edge1, edge2, j)
+            if t_hit >= tmin[i] and t_hit < tmax[i]:
+                blocked[i] = True
+                break
+
+    return blocked
+
+
+@parallel_jit
+def _bvh_closest_hit(
+        origins, directions, tmin, tmax, lower, upper, left, right, start, count, axis,
+        p1, edge1, edge2, stack_size
+    ):
+    n = origins.shape[0]
+    t = tmax.copy()
+    prim = np.full(n, -1, dtype=np.int64)
+    visits = np.zeros(n, dtype=np.int64)
+    tests = np.zeros(n, dtype=np.int64)
+
+    for i in prange(n):
+        ox, oy, oz = origins[i, 0], origins[i, 1], origins[i, 2]
+        dx, dy, dz = directions[i, 0], directions[i, 1], directions[i, 2]
+        ix, iy, iz = 1.0/dx, 1.0/dy, 1.0/dz
+        d = (dx, dy, dz)
+
+        stack = np.empty(stack_size, dtype=np.int64)
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            visits[i] += 1
+            t_near, t_far = box_hit(lower, upper, node, ox, oy, oz, ix, iy, iz)
+            if not (t_near <= t_far and t_far >= tmin[i] and t_near < t[i]):
+                continue
+
+            if count[node] > 0:
+                tests[i] += count[node]
+                for j in range(start[node], start[node] + count[node]):
+                    t_hit = triangle_hit(ox, oy, oz, dx, dy, dz, p1, edge1, edge2, j)
+                    if t_hit >= tmin[i] and t_hit < t[i]:
+                        t[i] = t_hit
+                        prim[i] = j
+            else:
+                near, far = left[node], right[node]
+                if d[axis[node]] < 0:
+                    near, far = far, near
+                stack[top] = far
+                stack[top + 1] = near
+                top += 2
+
+        if prim[i] < 0:
+            t[i] = np.inf
+
+    return t, prim, visits, tests
+
+
+@parallel_jit
+def _bvh_any_hit(
+        origins, directions, tmin, tmax, lower, upper, left, right, start, count,
+        p1, edge1, edge2, blockers, stack_size
+    ):
+    n = origins.shape[0]
+    blocked = np.zeros(n, dtype=np.bool_)
+    visits = np.zeros(n, dtype=np.int64)
+    tests = np.zeros(n, dtype=np.int64)
+
+    for i in prange(n):
+        ox, oy, oz = origins[i, 0], origins[i, 1], origins[i, 2]
+        dx, dy, dz = directions[i, 0], directions[i, 1], directions[i, 2]
+        ix, iy, iz = 1.0/dx, 1.0/dy, 1.0/dz
+
+        stack = np.empty(stack_size, dtype=np.int64)
+        stack[0] = 0
+        top = 1
+        while top > 0 and not blocked[i]:
+            top -= 1
+            node = stack[top]
+            visits[i] += 1
+            t_near, t_far = box_hit(lower, upper, node, ox, oy, oz, ix, iy, iz)
+            if not (t_near <= t_far and t_far >= tmin[i] and t_near < tmax[i]):
+                continue
+
+            if count[node] > 0:
+                for j in range(start[node], start[node] + count[node]):
+                    if not blockers[j]:
+                        continue
+                    tests[i] += 1
+                    t_hit = triangle_hit(ox, oy, oz, dx, dy, dz, p1, edge1, edge2, j)
+                    if t_hit >= tmin[i] and t_hit < tmax[i]:
+                        blocked[i] = True
+                        break
+            else:
+                stack[top] = right[node]
+                stack[top + 1] = left[node]
+                top += 2
+
+    return blocked, visits, tests
+
+
+@parallel_jit
+def _hemisphere(V, N, e1, e2):
+    n = N.shape[0]
+    out = np.empty((n, 3))
+
+    for i in prange(n):
+        a, b = np.arccos(np.sqrt(e1[i])), 2*np.pi*e2[i]
+        c0, c1, c2 = np.sin(a)*np.cos(b), np.sin(a)*np.sin(b), np.cos(a)
+
+        norm = np.sqrt(N[i, 0]**2 + N[i, 1]**2 + N[i, 2]**2)
+        nx, ny, nz = N[i, 0]/norm, N[i, 1]/norm, N[i, 2]/norm
+        vx, vy, vz = V[i, 0], V[i, 1], V[i, 2]
+
+        sx, sy, sz = ny*vz - nz*vy, nz*vx - nx*vz, nx*vy - ny*vx
+        norm = np.sqrt(sx*sx + sy*sy + sz*sz)
+        if norm < 1e-12:
+            # V parallel to N: any vector orthogonal to N works
+            hx, hy = (1.0, 0.0) if abs(nx) < 0.9 else (0.0, 1.0)
+            sx, sy, sz = -nz*hy, nz*hx, nx*hy - ny*hx
+            norm = np.sqrt(sx*sx + sy*sy + sz*sz)
+        sx, sy, sz = sx/norm, sy/norm, sz/norm
+
+        vx, vy, vz = sy*nz - sz*ny, sz*nx - sx*nz, sx*ny - sy*nx
+        norm = np.sqrt(vx*vx + vy*vy + vz*vz)
+        vx, vy, vz = vx/norm, vy/norm, vz/norm
+
+        out[i, 0] = sx*c0 + vx*c1 + nx*c2
+        out[i, 1] = sy*c0 + vy*c1 + ny*c2
+        out[i, 2] = sz*c0 + vz*c1 + nz*c2
+
+    return out
+
+
+@parallel_jit
+def _refract(V, N, n_obj, n_air):
+    n = N.shape[0]
+    out = np.zeros((n, 3))
+
+    for i in prange(n):
+        nx, ny, nz = N[i, 0], N[i, 1], N[i, 2]
+        if nx*V[i, 0] + ny*V[i, 1] + nz*V[i, 2] > 0:
+            nx, ny, nz = -nx, -ny, -nz
+            nr = n_obj/n_air
+        else:
+            nr = n_air/n_obj
+
+        ix, iy, iz = -V[i, 0], -V[i, 1], -V[i, 2]
+        ni = nx*ix + ny*iy + nz*iz
+        sqrt = 1 - nr**2*(1 - ni**2)
+        if sqrt < 0:
+            continue
+
+        k = nr*ni - np.sqrt(sqrt)
+        out[i, 0] = k*nx - nr*ix
+        out[i, 1] = k*ny - nr*iy
+        out[i, 2] = k*nz - nr*iz
+
+    return out
+
+
+@parallel_jit
+def _normalize(V):
+    out = np.empty_like(V)
+    for i in prange(V.shape[0]):
+        norm = np.sqrt(V[i, 0]**2 + V[i, 1]**2 + V[i, 2]**2)
+        for k in range(3):
+            out[i, k] = V[i, k]/norm
+    return out
@@ -0,0 +1,258 @@
+"""
+NumPy kernels, always available
+
+Rays are processed as arrays: brute force tests a block of rays against every
+triangle at once, the BVH is traversed by ray packets(the rays reaching a node
+are tested together).
+"""
+import numpy as np
+
+# max number of (ray, triangle) pairs tested at once
+CHUNK_SIZE = 1 << 21
+
+
+def closest_hit(origins, directions, p1, edge1, edge2, tmin, tmax):
+    """closest of (m,) triangles hit by each of (n,) rays with tmin <= t < tmax
+
+    Returns:
+        (n,) t(inf on a miss), (n,) triangle index(-1 on a miss)
+    """
+    n = len(origins)
+    t = np.full(n, np.inf)
+    tri = np.full(n, -1, dtype=np.int64)
+
+    for start, end in chunks(n, len(p1)):
+        t_hit = intersect_triangles(
+            origins[start:end], directions[start:end],
+            p1, edge1, edge2, tmin[start:end], tmax[start:end]
+        )
+        t[start:end], tri[start:end] = nearest(t_hit)
+
+    return t, tri
+
+
+def any_hit(origins, directions, p1, edge1, edge2, tmin, tmax):
+    """(n,) True where some of the (m,) triangles is hit with tmin <= t < tmax"""
+    n = len(origins)
+    blocked = np.zeros(n, dtype=bool)
+
+    for start, end in chunks(n, len(p1)):
+        t_hit = intersect_triangles(
+            origins[start:end], directions[start:end],
+            p1, edge1, edge2, tmin[start:end], tmax[start:end]
+        )
+        blocked[start:end] = np.any(np.isfinite(t_hit), axis=1)
+
+    return blocked
+
+
+def bvh_closest_hit(bvh, origins, directions, tmin, tmax):
+    """closest_hit through a scene.bvh.BVH
+
+    Returns:
+        t, leaf triangle index(position in bvh.p1), node visits, triangle tests
+    """
+    n = len(origins)
+    # t is the closest hit so far, anything farther is pruned
+    t = np.array(tmax, dtype=float)
+    prim = np.full(n, -1, dtype=np.int64)
+    visits = tests = 0
+
+    inv_dir = inverse(directions)
+    stack = [(0, np.arange(n))]
+
+    while stack:
+        node, rays = stack.pop()
+        visits += len(rays)
+        t_near, t_far = slab(bvh.lower[node], bvh.upper[node], origins[rays], inv_dir[rays])
+        rays = rays[(t_near <= t_far) & (t_far >= tmin[rays]) & (t_near < t[rays])]
+        if len(rays) == 0:
+            continue
+
+        if bvh.count[node] > 0:
+            start = bvh.start[node]
+            end = start + bvh.count[node]
+            tests += len(rays)*(end - start)
+            t_hit = intersect_triangles(
+                origins[rays], directions[rays],
+                bvh.p1[start:end], bvh.edge1[start:end], bvh.edge2[start:end],
+                tmin[rays], t[rays]
+            )
+            idx = np.argmin(t_hit, axis=1)
+            best = t_hit[np.arange(len(rays)), idx]
+            closer = best < t[rays]
+            t[rays[closer]] = best[closer]
+            prim[rays[closer]] = start + idx[closer]
+        else:
+            near, far = bvh.left[node], bvh.right[node]
+            if directions[rays[0], bvh.axis[node]] < 0:
+                near, far = far, near
+            stack.append((far, rays))
+            stack.append((near, rays))
+
+    t[prim < 0] = np.inf
+    return t, prim, visits, tests
+
+
+def bvh_any_hit(bvh, origins, directions, tmin, tmax, blockers=None):
+    """any_hit through a scene.bvh.BVH, rays leave as soon as they are blocked
+
+    Args:
+        blockers (np.array): (m,) bool over bvh.p1, False triangles never block(None: all block)
+
+    Returns:
+        blocked, node visits, triangle tests
+    """
+    n = len(origins)
+    blocked = np.zeros(n, dtype=bool)
+    visits = tests = 0
+
+    inv_dir = inverse(directions)
+    stack = [(0, np.arange(n))]
+
+    while stack:
+        node, rays = stack.pop()
+        rays = rays[~blocked[rays]]
+        if len(rays) == 0:
+            continue
+
+        visits += len(rays)
+        t_near, t_far = slab(bvh.lower[node], bvh.upper[node], origins[rays], inv_dir[rays])
+        rays = rays[(t_near <= t_far) & (t_far >= tmin[rays]) & (t_near < tmax[rays])]
+        if len(rays) == 0:
+            continue
+
+        if bvh.count[node] > 0:
+            start = bvh.start[node]
+            end = start + bvh.count[node]
+            tris = slice(start, end) if blockers is None else (
+                start + np.flatnonzero(blockers[start:end])
+            )
+            p1 = bvh.p1[tris]
+            tests += len(rays)*len(p1)
+            t_hit = intersect_triangles(
+                origins[rays], directions[rays], p1, bvh.edge1[tris], bvh.edge2[tris],
+                tmin[rays], tmax[rays]
+            )
+            blocked[rays] |= np.any(np.isfinite(t_hit), axis=1)
+        else:
+            stack.append((bvh.right[node], rays))
+            stack.append((bvh.left[node], rays))
+
+    return blocked, visits, tests
+
+
+def hemisphere(V, N, e1, e2):
+    """cosine weighted directions around the normals N, e1/e2 are (n,) uniform numbers"""
+    a, b = np.arccos(np.sqrt(e1)), 2*np.pi*e2
+
+    canonical_vector = np.stack((
+        np.sin(a)*np.cos(b),
+        np.sin(a)*np.sin(b),
+        np.cos(a)
+        ), axis=1
+    )
+
+    # creating a new basis with V and N vectors
+    N = normalize(N)
+    S = cross(N, V)
+    # V parallel to N: any vector orthogonal to N works
+    degenerate = np.linalg.norm(S, axis=1) < 1e-12
+    if np.any(degenerate):
+        helper = np.where(np.abs(N[degenerate, :1]) < 0.9, [1.0, 0, 0], [0, 1.0, 0])
+        S[degenerate] = cross(N[degenerate], helper)
+    S = normalize(S)
+    V = normalize(cross(S, N))
+
+    # rows of the orthogonal matrix [S, V, N] transposed times the canonical vector
+    return (
+        S*canonical_vector[:, :1] + V*canonical_vector[:, 1:2] + N*canonical_vector[:, 2:]
+    )
+
+
+def refract(V, N, n_obj, n_air):
+    """snell law for (n, 3) arrays, total internal reflection returns a zero vector"""
+    entering = np.einsum('ij,ij->i', N, V) > 0
+    N = np.where(entering[:, None], -N, N)
+    nr = np.where(entering, n_obj/n_air, n_air/n_obj)
+
+    I = -V
+    NI = np.einsum('ij,ij->i', N, I)
+
+    sqrt = 1 - nr**2*(1 - NI**2)
+    valid = sqrt >= 0
+
+    T = (nr*NI - np.sqrt(np.where(valid, sqrt, 0)))[:, None]*N - nr[:, None]*I
+
+    return np.where(valid[:, None], T, 0.0)
+
+
+def normalize(V):
+    """normalize (n, 3) vectors"""
+    return V/np.linalg.norm(V, axis=1, keepdims=True)
+
+
+def chunks(n, m):
+    """split n rays so a chunk never tests more than CHUNK_SIZE pairs with m triangles"""
+    if m == 0:
+        return []
+    step = max(1, CHUNK_SIZE//m)
+    return [(start, start + step) for start in range(0, n, step)]
+
+
+def nearest(t_hit):
+    """return nearest t and its column for a (n, m) ray/triangle t matrix"""
+    tri = np.argmin(t_hit, axis=1)
+    t = t_hit[np.arange(len(t_hit)), tri]
+    tri = np.where(np.isfinite(t), tri, -1)
+    return t, tri
+
+
+def intersect_triangles(origins, directions, p1, edge1, edge2, tmin, tmax):
+    """Moller-Trumbore test of (n,) rays against (m,) triangles
+
+    Args:
+        tmin, tmax (float or np.array): hits must have tmin <= t < tmax, scalars or (n,)
+
+    Returns:
+        (n, m) ray parameter t of each hit, inf where the ray misses
+    """
+    D = directions[:, None, :]
+    pvec = cross(D, edge2[None, :, :])
+    det = np.einsum('mk,nmk->nm', edge1, pvec)
+
+    parallel = det == 0
+    inv_det = 1.0/np.where(parallel, 1.0, det)
+
+    tvec = origins[:, None, :] - p1[None, :, :]
+    u = np.einsum('nmk,nmk->nm', tvec, pvec)*inv_det
+    qvec = cross(tvec, edge1[None, :, :])
+    v = np.einsum('nk,nmk->nm', directions, qvec)*inv_det
+    t = np.einsum('mk,nmk->nm', edge2, qvec)*inv_det
+
+    tmin = np.reshape(tmin, (-1, 1))
+    tmax = np.reshape(tmax, (-1, 1))
+    hit = ~parallel & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= tmin) & (t < tmax)
+    return np.where(hit, t, np.inf)
+
+
+def inverse(directions):
+    with np.errstate(divide='ignore'):
+        return 1.0/directions
+
+
+def slab(lower, upper, origins, inv_dir):
+    """ray/box entry and exit parameters(fmin/fmax drop the 0*inf nans)"""
+    with np.errstate(invalid='ignore'):
+        t1 = (lower - origins)*inv_dir
+        t2 = (upper - origins)*inv_dir
+    t_near = np.fmax.reduce(np.fmin(t1, t2), axis=1)
+    t_far = np.fmin.reduce(np.fmax(t1, t2), axis=1)
+    return t_near, t_far
+
+
+def cross(a, b):
+    """cross product over the last axis(np.cross has a large per call overhead)"""
+    ax, ay, az = a[..., 0], a[..., 1], a[..., 2]
+    bx, by, bz = b[..., 0], b[..., 1], b[..., 2]
+    return np.stack((ay*bz - az*by, az*bx - ax*bz, ax*by - ay*bx), axis=-1)
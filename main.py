@@ -1,31 +1,399 @@
-from matplotlib.image import imsave
-import numpy as np
-from readers.load import SceneLoader
-from render import PathTracing
+import argparse
+import random
+import time
+from pathlib import Path
+
+from checkpoint import load_checkpoint, save_checkpoint
+from denoise import AOVs, Denoiser
+from film import Film, luminance
+from output import ImageWriter, frame_path
+from parallel import TileRenderer
+from readers.load import SceneLoader, SDL_FILE
+from render import INTEGRATORS, ROULETTE_DEPTH, PathTracing
+from samplers import SAMPLERS
+from stats import RenderStats
+
+# --progressive: block sizes of the coarse passes traced before the full resolution ones
+PROGRESSIVE_STRIDES = (8, 4, 2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Path Tracing render")
+    parser.add_argument('--sdl', default=SDL_FILE, help="scene description file")
+    parser.add_argument(
+        '--mode', choices=['wavefront', 'scalar'], default='wavefront',
+        help="wavefront: every ray of a pass traced as arrays, scalar: one ray at a time"
+    )
+    parser.add_argument(
+        '--integrator', choices=sorted(INTEGRATORS), default=None,
+        help="phong: Phong illumination at the path ends, nee: next event estimation with "
+             "MIS, defaults to the SDL integrator"
+    )
+    parser.add_argument(
+        '--roulette-depth', type=int, default=ROULETTE_DEPTH,
+        help="nee: bounces before russian roulette may end a path(the SDL reflections "
+             "value is the hard max)"
+    )
+    parser.add_argument(
+        '--sampler', choices=sorted(SAMPLERS), default=None,
+        help="random: independent samples, sobol/halton: low discrepancy samples stratified "
+             "over the passes, defaults to the SDL sampler"
+    )
+    parser.add_argument('--passes', type=int, default=100, help="number of paths per pixel")
+    parser.add_argument(
+        '--chunk-size', type=int, default=1 << 16,
+        help="max rays traced at once in wavefront mode"
+    )
+    parser.add_argument(
+        '--workers', type=int, default=0,
+        help="render tiles on this many processes(wavefront only), 0 renders in this process"
+    )
+    parser.add_argument(
+        '--seed', type=int, default=None,
+        help="random numbers seed, defaults to the SDL seed(a random one without it), "
+             "a seed gives the same image for any --workers/--chunk-size"
+    )
+    parser.add_argument('--checkpoint', type=Path, default=None, help="checkpoint file")
+    parser.add_argument(
+        '--checkpoint-interval', type=float, default=300,
+        help="min seconds between checkpoints(one is always written at the end)"
+    )
+    parser.add_argument(
+        '--resume', action='store_true', help="continue the render saved in --checkpoint"
+    )
+    parser.add_argument(
+        '--output', type=Path, default=None,
+        help="final image, .pfm is the only HDR format(raw radiance), .pnm/.ppm/.png are "
+             "tone mapped 8 bit images, defaults to the SDL output"
+    )
+    parser.add_argument(
+        '--preview', default='images/preview.png',
+        help="tone mapped preview written while rendering, {n} is replaced by the pass "
+             "number, '' disables it"
+    )
+    parser.add_argument(
+        '--output-interval', type=float, default=10,
+        help="min seconds between image writes while rendering"
+    )
+    parser.add_argument(
+        '--output-every', type=int, default=None,
+        help="also write the images every this many passes"
+    )
+    parser.add_argument(
+        '--denoise', action='store_true',
+        help="write the images through the edge-avoiding a-trous denoiser(the checkpoint "
+             "keeps the raw samples)"
+    )
+    parser.add_argument(
+        '--progressive', action='store_true',
+        help="trace 1/8, 1/4 and 1/2 resolution passes first and write them upsampled as "
+             "previews, then render at full resolution"
+    )
+    parser.add_argument(
+        '--crop', type=int, nargs=4, default=None, metavar=('X0', 'Y0', 'X1', 'Y1'),
+        help="only trace the pixels x0 <= x < x1, y0 <= y < y1 of the image(look-dev), "
+             "the others stay black"
+    )
+    parser.add_argument(
+        '--sequence', action='store_true',
+        help="render every frame of the SDL animation(frames, *_key) into numbered outputs, "
+             "the scene is loaded once and refit between frames"
+    )
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help="parse the OBJ files instead of using the compiled scene cache(in-process only)"
+    )
+    parser.add_argument(
+        '--stats', action='store_true', help="collect render statistics and print them every pass"
+    )
+    parser.add_argument(
+        '--stats-json', type=Path, default=None, help="write the render statistics to this file"
+    )
+    return parser.parse_args()
+
+
+class FrameOutput():
+    """image writer of the frame being rendered, reopened for every frame
+
+    Args:
+        args: parsed command line
+        scene (readers.load.SceneLoader): scene being rendered
+        compiled (readers.cache.CompiledScene): geometry the denoiser guides are
+            traced on, moved to every frame
+        animation (scene.animation.Animation): frames of the scene
+        output (Path): final image, numbered per frame in a sequence
+        crop (tuple): (x0, y0, x1, y1) rectangle being rendered, the only one denoised
+        options (dict): integrator arguments of the render, the denoiser guides
+            use its seed and sampler
+    """
+
+    def __init__(self, args, scene, compiled, animation, output, crop=None, options=None):
+        self.args = args
+        self.scene = scene
+        self.compiled = compiled
+        self.animation = animation
+        self.output = output
+        self.crop = crop
+        self.options = options or {}
+        self.writer = None
+
+    def start(self, frame):
+        """open the writer of frame(None: the still scene)"""
+        args = self.args
+        camera = self.scene.get_camera()
+        if frame is not None:
+            # without a compiled scene here only the workers move their geometry
+            if self.compiled is not None:
+                self.animation.apply(self.compiled, frame)
+            camera = self.animation.camera(frame)
+
+        denoiser = None
+        if args.denoise:
+            # albedo/normal/depth guides, first hits only so any integrator will do
+            # jittered as the first samples of the render
+            sampling = {
+                name: self.options[name] for name in ('seed', 'sampler') if name in self.options
+            }
+            guide = PathTracing.from_compiled(camera, self.compiled, **sampling)
+            aovs = AOVs.render(guide, camera, chunk_size=args.chunk_size, tile=self.crop)
+            # the pixels around a crop have no radiance to filter with
+            denoiser = Denoiser(aovs, window=self.crop)
+
+        output = self.output
+        if frame is not None and output:
+            output = frame_path(output, frame)
+        self.writer = ImageWriter(
+            [target for target in (args.preview, output) if target],
+            self.scene.get_tonemapping(), interval=args.output_interval,
+            every=args.output_every, denoiser=denoiser
+        )
+        return camera
+
+    def submit(self, n_pass, film, force=False):
+        self.writer.submit(n_pass, film, force)
+
+    def finish(self, n_pass, film):
+        """write the last images of the frame and wait for them"""
+        self.writer.submit(n_pass, film, force=True)
+        self.writer.close()
+        for error in self.writer.errors:
+            print(f"image write failed: {error}")
+
+
+def crop_rectangle(crop, w, h):
+    """--crop as a (x0, y0, x1, y1) tile, None for the whole w x h image"""
+    if crop is None:
+        return None
+    x0, y0, x1, y1 = crop
+    if not (0 <= x0 < x1 <= w and 0 <= y0 < y1 <= h):
+        raise ValueError(f"Crop {x0} {y0} {x1} {y1} is empty or outside the {w}x{h} image")
+    return x0, y0, x1, y1
+
+
+def render_levels(pt, camera, args, crop, on_level):
+    """coarse passes of pt in this process: one sample per PROGRESSIVE_STRIDES
+    block, upsampled into a preview film handed to on_level(stride, film)
+
+    The render film never sees these samples, so the final image only holds
+    full resolution ones.
+    """
+    film = Film(camera.pixels_size[0], camera.pixels_size[1])
+    for stride in PROGRESSIVE_STRIDES:
+        start = time.perf_counter()
+        batches = camera.generate_rays(
+            tile=crop, chunk_size=args.chunk_size, rng=pt.rng, stride=stride
+        )
+        for origins, directions, pixels in batches:
+            film.fill(pixels, pt.path_tracing_wavefront(origins, directions, pixels), stride, crop)
+        print(f"1/{stride} resolution: {time.perf_counter() - start:.2f}s")
+        on_level(stride, film)
+
+
+def render_passes(pt, camera, film, first_pass, args, threshold, stats, on_pass, crop=None):
+    """render passes first_pass, ..., args.passes - 1 of pt in this process, only
+    the crop rectangle when given"""
+    x0, y0, x1, y1 = crop if crop is not None else (0, 0, film.w, film.h)
+    for i in range(first_pass, args.passes):
+        start = time.perf_counter()
+        traced = (x1 - x0)*(y1 - y0)
+        if stats is not None:
+            pt.stats = RenderStats()
+
+        # adaptive sampling: later passes only trace the pixels not converged yet
+        mask = None
+        if threshold is not None:
+            mask = ~film.converged(threshold)[y0:y1, x0:x1]
+            traced = int(mask.sum())
+            if traced == 0:
+                print(f"every pixel converged after {i} passes")
+                break
+
+        if args.mode == 'wavefront':
+            # jitter and paths keyed by pixel and pass i
+            batches = camera.generate_rays(
+                tile=crop, chunk_size=args.chunk_size, mask=mask, rng=pt.rng, sample=i
+            )
+            for origins, directions, pixels in batches:
+                film.add(pixels, pt.path_tracing_wavefront(origins, directions, pixels, i))
+        else:
+            for ray in camera.get_rays(pt.rng, i, crop, mask):
+                color = pt.path_tracing(ray, i)
+                if color is not None:
+                    film.radiance[ray.pixel[1], ray.pixel[0]] += color
+                    film.counts[ray.pixel[1], ray.pixel[0]] += 1
+                    film.squares[ray.pixel[1], ray.pixel[0]] += luminance(color)**2
+
+        elapsed = time.perf_counter() - start
+        print(f"pass {i}: {traced/elapsed:.0f} samples/s, {traced} pixels")
+        if stats is not None:
+            pt.stats.passes = 1
+            stats.merge(pt.stats)
+            if args.stats:
+                print(f"  {pt.stats.summary()}")
+
+        on_pass(i, film)
+
+
+class Checkpointer():
+    """write a checkpoint at pass boundaries, at most every interval seconds"""
+
+    def __init__(self, path, interval, seed):
+        self.path = path
+        self.interval = interval
+        self.seed = seed
+        self.last = time.monotonic()
+
+    def due(self):
+        """whether the next pass boundary is checkpointed"""
+        return self.path is not None and time.monotonic() - self.last >= self.interval
+
+    def __call__(self, n_pass, film, force=False):
+        if self.path is None:
+            return
+        if force or self.due():
+            save_checkpoint(self.path, film, n_pass, self.seed)
+            self.last = time.monotonic()
+
 
 if __name__ == "__main__":
+    args = parse_args()
+    collect_stats = args.stats or args.stats_json is not None
+
     # ## Load Scene
-    scene = SceneLoader()
-    # Initialize Cam
-    camera = scene.get_camera()
-    # Load Objects
-    scene_objects = scene.get_objects()
-    # Load Light
-    lights = scene.get_light()
-    # light_object = scene.get_light()
-
-    # Path Tracing...
-    pt = PathTracing(camera, scene_objects, lights)
-    rays = camera.get_rays()
+    scene = SceneLoader(args.sdl)
     w, h = scene.get_size()
-    img = np.zeros((w, h, 3))
+    crop = crop_rectangle(args.crop, w, h)
+    integrator = args.integrator or scene.get_integrator()
+    if integrator not in INTEGRATORS:
+        raise ValueError(f"Unknown integrator {integrator}")
+    seed = args.seed if args.seed is not None else scene.get_seed()
+    options = {
+        'n_reflections': scene.get_reflections(), 'sampler': args.sampler or scene.get_sampler()
+    }
+    if integrator == 'nee':
+        options['roulette_depth'] = args.roulette_depth
+
+    animation = scene.get_animation()
+    frames = list(range(len(animation))) if args.sequence else [None]
+    if args.sequence and args.checkpoint is not None:
+        raise ValueError("--sequence renders every frame from scratch, no --checkpoint")
+
+    film, first_pass = None, 0
+    if args.resume:
+        if args.checkpoint is None:
+            raise ValueError("--resume needs --checkpoint")
+        film, first_pass, seed = load_checkpoint(args.checkpoint)
+        if (film.w, film.h) != (w, h):
+            raise ValueError(f"Checkpoint is {film.w}x{film.h}, scene is {w}x{h}")
+        print(f"resuming at pass {first_pass}")
+    if seed is None:
+        seed = random.getrandbits(63)
+        print(f"seed {seed}")
+    options['seed'] = seed
+
+    checkpointer = Checkpointer(args.checkpoint, args.checkpoint_interval, seed)
+
+    # Objects, lights and BVH, loaded once for every frame
+    compiled = None
+    if args.workers == 0 or args.denoise or args.progressive:
+        compiled = scene.get_compiled(cache=not args.no_cache)
+    frame_output = FrameOutput(
+        args, scene, compiled, animation, args.output or scene.get_output(), crop, options
+    )
+
+    def on_level(stride, film):
+        frame_output.submit(0, film, force=True)
+
+    def on_pass(i, film):
+        frame_output.submit(i, film)
+        checkpointer(i + 1, film)
+
+    def on_frame_done(frame, film):
+        last = max(args.passes, first_pass)
+        checkpointer(last, film, force=True)
+        frame_output.finish(last - 1, film)
+        if frame is not None:
+            print(f"frame {frame} done")
+
+    if args.workers > 0:
+        def on_worker_pass(i, film):
+            elapsed = time.perf_counter() - start
+            print(f"pass {i}: {(film.counts.sum() - start_samples)/elapsed:.0f} samples/s")
+            if args.stats:
+                print(f"  {renderer.pass_stats[i].summary()}")
+            # checkpoints are taken by the renderer, between two whole passes
+            frame_output.submit(i, film)
+
+        if args.progressive:
+            # coarse passes are traced here while the pool starts
+            preview_pt = INTEGRATORS[integrator].from_compiled(
+                scene.get_camera(), compiled, **options
+            )
+
+        def on_frame(frame):
+            global start, start_samples
+            camera = frame_output.start(frame)
+            if args.progressive and first_pass == 0:
+                preview_pt.refresh(camera)
+                render_levels(preview_pt, camera, args, crop, on_level)
+            start = time.perf_counter()
+            start_samples = 0 if film is None or frame != frames[0] else film.counts.sum()
+
+        renderer = TileRenderer(
+            args.sdl, workers=args.workers, integrator=integrator, options=options,
+            threshold=scene.get_threshold(), crop=crop, stats=collect_stats
+        )
+        rendered = renderer.render_frames(
+            frames, args.passes, on_worker_pass, film=film, first_pass=first_pass,
+            on_frame=on_frame, checkpoint=checkpointer
+        )
+        for frame, film in rendered:
+            on_frame_done(frame, film)
+            first_pass = 0
+        stats = renderer.stats
+
+    else:
+        # Path Tracing...
+        pt = INTEGRATORS[integrator].from_compiled(scene.get_camera(), compiled, **options)
+        stats = RenderStats() if collect_stats else None
 
-    for i in range(100):
-        for ray in rays:
-            color = pt.path_tracing(ray)
-            if color is not None:
-                img[ray.pixel[1], ray.pixel[0]] += color
+        for frame in frames:
+            # the frame output moves the scene, the path tracer follows it
+            camera = frame_output.start(frame)
+            if frame is not None:
+                pt.refresh(camera)
+            if film is None:
+                film = Film(w, h)
+            if args.progressive and first_pass == 0:
+                render_levels(pt, camera, args, crop, on_level)
+            render_passes(
+                pt, camera, film, first_pass, args, scene.get_threshold(), stats, on_pass, crop
+            )
+            on_frame_done(frame, film)
+            film, first_pass = None, 0
 
-        kimg = img/(i + 1)
-        kimg = kimg/(kimg + scene.get_tonemapping())
-        imsave(f"images/pt_{i}.png", np.clip(kimg, 0, 1))
+    if stats is not None:
+        if args.stats:
+            print(f"total: {stats.summary()}")
+        if args.stats_json is not None:
+            stats.save_json(args.stats_json)
@@ -1,30 +1,27 @@
-import pyglet
-from pyglet import app 
-from pyglet.window import Window
-
 import random
 from threading import Thread, Lock
 
-import numpy as np
+from film import Film
+from preview import FRAMERATE, Preview, open_display
 from readers.load import SceneLoader
 from render import PathTracing
 
-FRAMERATE = 5
 THREADS = 1
 
-def run_path_tracing(camera, scene_objects, lights, rays, img_buffer, img_count, img_lock, update_lock, npaths=10):
-    pt = PathTracing(camera, scene_objects, lights)
-    random.shuffle(rays)
-    for _ in range(npaths):
+def run_path_tracing(camera, scene_objects, lights, tile, film, img_lock, npaths=10, options=None):
+    pt = PathTracing(camera, scene_objects, lights, **(options or {}))
+    for i in range(npaths):
+        # new jitter and paths every pass, keyed by pixel and pass i
+        rays = camera.get_rays(pt.rng, i, tile)
+        random.shuffle(rays)
         for ray in rays:
-            with update_lock:
-                pass
-            color = pt.path_tracing(ray)
+            color = pt.path_tracing(ray, i)
             if color is not None:
+                # only the render threads share this lock, the preview never takes it
                 with img_lock:
-                    img_buffer[ray.pixel[0], ray.pixel[1]] += color
-                    img_count[ray.pixel[0], ray.pixel[1]] += 1
-    
+                    film.radiance[ray.pixel[1], ray.pixel[0]] += color
+                    film.counts[ray.pixel[1], ray.pixel[0]] += 1
+
 if __name__ == "__main__":
     print("Starting")
     scene = SceneLoader()
@@ -33,51 +30,40 @@ if __name__ == "__main__":
     lights = scene.get_light()
 
     # Path Tracing...
-    rays = camera.get_rays()
     w, h = scene.get_size()
+    seed = scene.get_seed()
+    options = {
+        'n_reflections': scene.get_reflections(), 'sampler': scene.get_sampler(),
+        'seed': random.getrandbits(63) if seed is None else seed,
+    }
 
     img_lock = Lock()
-    update_lock = Lock()
-    img_buffer = np.zeros((w, h, 3))
-    img_count = np.zeros((w, h, 3))
+    film = Film(w, h)
 
     print("Starting PT..")
-    rays_list = []
+    # every thread traces a band of rows
+    tiles = []
     for i in range(THREADS):
-        split = len(rays)//THREADS
-        if i - 1 == THREADS:
-            rays_list.append(rays[i*split:])
+        split = h//THREADS
+        if i + 1 == THREADS:
+            tiles.append((0, i*split, w, h))
         else:
-            rays_list.append(rays[i*split: i*split + split])
+            tiles.append((0, i*split, w, i*split + split))
 
     # Start Path Tracining
     threads = []
     for i in range(THREADS):
         th = Thread(
-            target = run_path_tracing, args = (scene.get_camera(), scene.get_objects(), scene.get_light(), rays_list[i], img_buffer, img_count, img_lock, update_lock, scene.sdl.npaths)
+            target = run_path_tracing, args = (camera, scene_objects, lights, tiles[i], film, img_lock, scene.get_npaths() or 10, options)
         )
         threads.append(th)
-    
-    # Pyglet
-    print("Initialize window")
-    win = Window(width=w, height=h)
 
-    @win.event
-    def on_draw():
-        with update_lock:
-            img = img_buffer/(img_count + 1)
-            rescaled_image = (img*255).astype('int')
-            for i in range(w):
-                for j in range(h):
-                    color = rescaled_image[(i), (h - j - 1)]
-                    pyglet.graphics.draw(1, pyglet.gl.GL_POINTS,
-                        ('v2i', (i, j)),
-                        ('c3B', (color[0], color[1], color[2]))
-                )
-            #
-    pyglet.clock.schedule_interval(lambda dt: None, FRAMERATE) 
+    # Preview: a window when pyglet can open one, images/framebuffer.ppm otherwise
+    print("Initialize preview")
+    preview = Preview(w, h, scene.get_tonemapping())
+    display = open_display(preview, source=film, interval=1/FRAMERATE)
 
     for th in threads:
         th.start()
 
-    app.run()
+    display.run(done=lambda: not any(th.is_alive() for th in threads))
@@ -0,0 +1,194 @@
+"""
+Image output
+
+Images are written on a background thread from a snapshot of the film. The
+writer owns two snapshot buffers: the renderer copies the film into the one
+not being written and goes on, a newer snapshot replaces one still waiting,
+so rendering never waits on the disk(or on the denoiser, which also runs on
+that thread).
+
+write_pfm - raw HDR radiance as a PFM file, the only HDR format
+write_pnm - tone mapped 8 bit binary PPM(LDR, the SDL default cornell.pnm)
+write_image - pick the format from the file suffix
+frame_path - numbered image path of an animation frame
+ImageWriter - rate limited background writer
+"""
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from matplotlib.image import imsave
+
+from film import tonemap
+
+# formats storing the mean radiance as it is, the others are tone mapped
+HDR_FORMATS = ('.pfm',)
+# the umask can only be read by setting it, done once here before any writer thread
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+# modes open()/mkdir() give a new file/directory
+FILE_MODE = 0o666 & ~_UMASK
+DIR_MODE = 0o777 & ~_UMASK
+
+
+def write_pfm(path, image):
+    """(h, w, 3) float image as a little endian PFM(rows stored bottom to top)"""
+    h, w, _ = image.shape
+    with open(path, 'wb') as file:
+        file.write(f"PF\n{w} {h}\n-1.0\n".encode())
+        file.write(np.ascontiguousarray(image[::-1], dtype='<f4').tobytes())
+
+
+def write_pnm(path, image):
+    """(h, w, 3) image in [0, 1] as a binary 8 bit PPM, the radiance is not kept"""
+    h, w, _ = image.shape
+    with open(path, 'wb') as file:
+        file.write(f"P6\n{w} {h}\n255\n".encode())
+        file.write(np.round(np.clip(image, 0, 1)*255).astype(np.uint8).tobytes())
+
+
+def write_image(path, film, tonemapping, image=None):
+    """write film to path, PFM keeps the radiance, PNM/PPM and the matplotlib
+    formats(png, jpg, ...) are tone mapped
+
+    The image is written next to path and moved over it, so readers never see
+    half a file.
+
+    Args:
+        image (np.array): (h, w, 3) radiance written instead of film.image()(a
+            denoised one)
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    suffix = path.suffix.lower()
+    if image is None:
+        image = film.image()
+
+    with tempfile.NamedTemporaryFile(dir=path.parent, suffix=suffix, delete=False) as file:
+        tmp = file.name
+    # temporary files are private(0600), images are not
+    os.chmod(tmp, FILE_MODE)
+    try:
+        if suffix in HDR_FORMATS:
+            write_pfm(tmp, image)
+        elif suffix in ('.pnm', '.ppm'):
+            write_pnm(tmp, tonemap(image, tonemapping))
+        else:
+            imsave(tmp, tonemap(image, tonemapping))
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def frame_path(path, frame, digits=4):
+    """path of frame: '{frame}' in path is replaced by the zero padded frame
+    number, otherwise it goes before the suffix(cornell.pnm -> cornell_0007.pnm)"""
+    path = str(path)
+    number = str(frame).zfill(digits)
+    if '{frame}' in path:
+        return path.replace('{frame}', number)
+    path = Path(path)
+    return str(path.with_name(f"{path.stem}_{number}{path.suffix}"))
+
+
+class ImageWriter():
+    """write the film to every target on a background thread
+
+    Args:
+        targets (list): image paths, '{n}' in a path is replaced by the pass number
+        tonemapping (float): SDL tonemapping value for the tone mapped formats
+        interval (float): min seconds between writes
+        every (int): also write once every this many passes(None: time only)
+        denoiser (callable): film -> radiance image(denoise.Denoiser) applied to every
+            snapshot on the writer thread, None writes the mean radiance
+    """
+
+    def __init__(self, targets, tonemapping, interval=10.0, every=None, denoiser=None):
+        self.targets = [str(target) for target in targets]
+        self.tonemapping = tonemapping
+        self.denoiser = denoiser
+        self.interval = interval
+        self.every = every
+        self.errors = []
+
+        self.__buffers = [None, None]
+        self.__writing = None
+        # index of the buffer waiting for the thread and its pass number
+        self.__pending = None
+        self.__pending_pass = None
+        self.__closed = False
+        self.__last_time = time.monotonic()
+        self.__last_pass = None
+        self.__condition = threading.Condition()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def submit(self, n_pass, film, force=False):
+        """snapshot film after pass n_pass if a write is due, returns at once"""
+        if not self.targets:
+            return False
+
+        due = force or time.monotonic() - self.__last_time >= self.interval
+        if self.every is not None:
+            due |= self.__last_pass is None or n_pass - self.__last_pass >= self.every
+        if not due:
+            return False
+
+        with self.__condition:
+            # a snapshot still waiting is replaced, the one being written is left alone
+            idx = self.__pending
+            if idx is None:
+                idx = 1 if self.__writing == 0 else 0
+            self.__buffers[idx] = self.__copy(self.__buffers[idx], film)
+            self.__pending, self.__pending_pass = idx, n_pass
+            self.__condition.notify()
+
+        self.__last_time = time.monotonic()
+        self.__last_pass = n_pass
+        return True
+
+    def close(self):
+        """write what is pending and stop the thread"""
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify()
+        self.__thread.join()
+
+    def __copy(self, buffer, film):
+        if buffer is None or (buffer.w, buffer.h) != (film.w, film.h):
+            return film.copy()
+        np.copyto(buffer.radiance, film.radiance)
+        np.copyto(buffer.counts, film.counts)
+        np.copyto(buffer.squares, film.squares)
+        return buffer
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while self.__pending is None and not self.__closed:
+                    self.__condition.wait()
+                if self.__pending is None:
+                    return
+                self.__writing, self.__pending = self.__pending, None
+                film, n_pass = self.__buffers[self.__writing], self.__pending_pass
+
+            # errors are reported by the owner, a failed write must not kill the render
+            image = None
+            if self.denoiser is not None:
+                try:
+                    image = self.denoiser(film)
+                except Exception as error:
+                    self.errors.append(error)
+
+            for target in self.targets:
+                try:
+                    write_image(target.replace('{n}', str(n_pass)), film, self.tonemapping, image)
+                except Exception as error:
+                    self.errors.append(error)
+
+            with self.__condition:
+                self.__writing = None
@@ -0,0 +1,267 @@
+"""
+Multi-process tile renderer
+
+The image is split in tiles and every (tile, pass) is a work unit. Units sit in
+the pool's shared task queue and idle workers pull the next one, so fast
+workers keep taking the tiles slow workers have not reached. Workers open the
+compiled scene cache once(memory-mapped, so they share one copy of the
+geometry) and add their samples straight into a SharedFilm. A tile has at most
+one unit in flight(its next pass is queued only when the previous one is done),
+so no two workers ever write the same pixel and no lock is needed. Before a
+checkpoint the next pass is held back until every tile finished the current
+one, so the saved film holds whole passes only. Random
+numbers are keyed by pixel and pass(rng.CounterRNG), so the image does not
+depend on the number of workers or on the order the tiles are traced in.
+
+With stats on, every unit returns its stats.RenderStats as a dict and the
+renderer merges them per pass and overall.
+
+Animated scenes(render_frames) keep the pool and the shared film between
+frames: a unit carries its frame and a worker moves its scene there(refit, no
+reload) the first time it sees it.
+"""
+import os
+import queue
+from multiprocessing import Pool
+
+from film import Film, SharedFilm
+from readers.load import SceneLoader, SDL_FILE
+from render import INTEGRATORS
+from stats import RenderStats
+
+TILE_SIZE = 64
+
+# per worker process state, set by _init_worker
+_worker = {}
+
+
+def split_tiles(w, h, tile_size=TILE_SIZE, crop=None):
+    """return (x0, y0, x1, y1) tiles covering a w x h image, or only its crop rectangle"""
+    x0, y0, x1, y1 = crop if crop is not None else (0, 0, w, h)
+    return [
+        (x, y, min(x + tile_size, x1), min(y + tile_size, y1))
+        for y in range(y0, y1, tile_size)
+        for x in range(x0, x1, tile_size)
+    ]
+
+
+def _init_worker(sdl_file, film_name, w, h, integrator, options, accelerator, threshold, stats):
+    """load the scene once per worker process"""
+    scene = SceneLoader(sdl_file)
+    camera = scene.get_camera()
+    compiled = scene.get_compiled()
+    pt = INTEGRATORS[integrator].from_compiled(
+        camera, compiled, accelerator=accelerator, **options
+    )
+
+    _worker.update(
+        pt=pt,
+        camera=camera,
+        compiled=compiled,
+        animation=scene.get_animation(),
+        frame=None,
+        film=SharedFilm.attach(film_name, w, h),
+        threshold=threshold,
+        stats=stats,
+    )
+
+
+def _render_tile(tile, n_pass, frame=None):
+    """trace one pass over a tile of frame(None: the still scene) and accumulate
+    it in the shared film"""
+    film = _worker['film']
+    if frame != _worker['frame']:
+        animation = _worker['animation']
+        animation.apply(_worker['compiled'], frame)
+        _worker['camera'] = animation.camera(frame)
+        _worker['pt'].refresh(_worker['camera'])
+        _worker['frame'] = frame
+
+    # adaptive sampling: skip the converged pixels, this worker owns the tile
+    mask = None
+    if _worker['threshold'] is not None:
+        x0, y0, x1, y1 = tile
+        tile_film = Film(
+            x1 - x0, y1 - y0, film.radiance[y0:y1, x0:x1],
+            film.counts[y0:y1, x0:x1], film.squares[y0:y1, x0:x1]
+        )
+        mask = ~tile_film.converged(_worker['threshold'])
+
+    pt = _worker['pt']
+    pt.stats = RenderStats() if _worker['stats'] else None
+
+    # random numbers keyed by pixel and pass, any worker draws the same ones
+    batches = _worker['camera'].generate_rays(tile=tile, mask=mask, rng=pt.rng, sample=n_pass)
+    for origins, directions, pixels in batches:
+        colors = pt.path_tracing_wavefront(origins, directions, pixels, n_pass)
+        film.add(pixels, colors)
+
+    return tile, n_pass, None if pt.stats is None else pt.stats.to_dict()
+
+
+class TileRenderer():
+    """render passes over the scene tiles on a process pool
+
+    Args:
+        sdl_file (Path): scene description file
+        workers (int): number of processes, defaults to the cpu count
+        tile_size (int): tile width/height in pixels
+        integrator (str): render.INTEGRATORS name, None uses the SDL one
+        options (dict): more integrator arguments(roulette_depth, seed, ...), n_reflections,
+            seed and sampler default to the SDL ones(seed 0 without one)
+        accelerator (str): PathTracing accelerator
+        threshold (float): adaptive sampling error threshold, None samples every pixel
+        crop (tuple): (x0, y0, x1, y1) pixel rectangle traced, the whole image by default
+        stats (bool): collect stats.RenderStats, self.stats holds the total and
+            self.pass_stats[i] the stats of pass i
+    """
+
+    def __init__(
+            self, sdl_file=SDL_FILE, workers=None, tile_size=TILE_SIZE,
+            integrator=None, options=None, accelerator='auto', threshold=None, crop=None,
+            stats=False
+        ):
+        self.sdl_file = sdl_file
+        self.workers = workers or os.cpu_count()
+        self.tile_size = tile_size
+        self.integrator = integrator
+        self.options = options or {}
+        self.accelerator = accelerator
+        self.threshold = threshold
+        self.crop = crop
+        self.stats = RenderStats() if stats else None
+        self.pass_stats = {}
+
+    def render(self, passes, on_pass=None, film=None, first_pass=0, checkpoint=None):
+        """render passes first_pass, ..., passes - 1
+
+        Args:
+            passes (int): samples per pixel
+            on_pass (callable): called as on_pass(i, film) once every tile
+                finished pass i(the film is shared, copy it to keep it, other
+                tiles may already be adding pass i + 1)
+            film (film.Film): samples of the passes already rendered(resume)
+            first_pass (int): index of the first pass to render
+            checkpoint (callable): called as checkpoint(i + 1, film, force=True)
+                after pass i when its due() was true as pass i started to
+                finish, no tile has started pass i + 1 then
+
+        Returns:
+            film.Film with the accumulated samples
+        """
+        rendered = self.render_frames([None], passes, on_pass, film, first_pass, None, checkpoint)
+        for _, film in rendered:
+            return film
+
+    def render_frames(
+            self, frames, passes, on_pass=None, film=None, first_pass=0, on_frame=None,
+            checkpoint=None
+        ):
+        """render the frames of an animated scene(scene.animation.Animation) back
+        to back, the scene is loaded once per worker for all of them
+
+        Args:
+            frames (iterable): frame numbers, None renders the scene as it is
+            passes, on_pass, checkpoint: as in render, called for every frame
+            film, first_pass: resume state of the first frame
+            on_frame (callable): called as on_frame(frame) before a frame is started
+
+        Yields:
+            frame number and film.Film of every frame, once it is done
+        """
+        scene = SceneLoader(self.sdl_file)
+        w, h = scene.get_size()
+        integrator = self.integrator or scene.get_integrator()
+        options = {
+            'n_reflections': scene.get_reflections(), 'seed': scene.get_seed() or 0,
+            'sampler': scene.get_sampler(), **self.options
+        }
+        # compiled here once, workers only open it
+        scene.get_compiled()
+        tiles = split_tiles(w, h, self.tile_size, self.crop)
+        shared = SharedFilm.create(w, h)
+        if film is not None:
+            shared.radiance[:] = film.radiance
+            shared.counts[:] = film.counts
+            shared.squares[:] = film.squares
+        film = shared
+
+        try:
+            with Pool(
+                self.workers,
+                initializer=_init_worker,
+                initargs=(
+                    self.sdl_file, film.name, w, h, integrator, options, self.accelerator,
+                    self.threshold,
+                    self.stats is not None
+                )
+            ) as pool:
+                for frame in frames:
+                    if on_frame is not None:
+                        on_frame(frame)
+                    self.pass_stats = {}
+                    self.__schedule(
+                        pool, tiles, range(first_pass, passes), film, on_pass, checkpoint, frame
+                    )
+                    yield frame, film.copy()
+                    # next frame from scratch
+                    for buffer in (film.radiance, film.counts, film.squares):
+                        buffer[:] = 0
+                    first_pass = 0
+        finally:
+            film.close()
+            film.unlink()
+
+    def __schedule(self, pool, tiles, passes, film, on_pass, checkpoint, frame):
+        done = queue.Queue()
+        errors = queue.Queue()
+        remaining = {n_pass: len(tiles) for n_pass in passes}
+        # pass -> tiles waiting for a checkpoint before their next pass, decided
+        # when the first tile finishes the pass
+        held = {}
+
+        def submit(tile, n_pass):
+            pool.apply_async(
+                _render_tile, (tile, n_pass, frame), callback=done.put,
+                error_callback=errors.put
+            )
+
+        if len(passes) > 0:
+            for tile in tiles:
+                submit(tile, passes[0])
+
+        for _ in range(len(tiles)*len(passes)):
+            while True:
+                if not errors.empty():
+                    raise errors.get()
+                try:
+                    tile, n_pass, unit_stats = done.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    continue
+
+            if n_pass not in held:
+                due = checkpoint is not None and checkpoint.due()
+                held[n_pass] = [] if due else None
+            if n_pass + 1 < passes.stop:
+                if held[n_pass] is None:
+                    submit(tile, n_pass + 1)
+                else:
+                    held[n_pass].append(tile)
+
+            if unit_stats is not None:
+                pass_stats = self.pass_stats.setdefault(n_pass, RenderStats())
+                pass_stats.merge(RenderStats.from_dict(unit_stats))
+
+            remaining[n_pass] -= 1
+            if remaining[n_pass] == 0:
+                if self.stats is not None:
+                    self.pass_stats[n_pass].passes = 1
+                    self.stats.merge(self.pass_stats[n_pass])
+                if on_pass is not None:
+                    on_pass(n_pass, film)
+                if held[n_pass] is not None:
+                    # every tile is at pass n_pass + 1, none has started it
+                    checkpoint(n_pass + 1, film, force=True)
+                    for tile in held.pop(n_pass):
+                        submit(tile, n_pass + 1)
@@ -0,0 +1,188 @@
+"""
+Interactive preview
+
+The renderer(or the display itself, on a timer) publishes snapshots of the
+accumulation buffers with Preview.submit and the display takes the newest one
+as 8 bit RGB with Preview.frame. There are two snapshot buffers flipped by
+reference: submit only writes the buffer the display is not reading(the
+snapshot is skipped otherwise) and frame checks the front buffer again after
+claiming it, so neither side ever waits on a lock and tracing is never held
+up. A refresh is one copy, one vectorized tone map and one texture upload.
+
+Preview - double-buffered tone mapped snapshots of a film
+WindowDisplay - pyglet window, every frame blitted as a single image
+FileDisplay - headless fallback, every frame written to a framebuffer file
+open_display - a window when pyglet can open one, the file otherwise
+"""
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from film import tonemap
+from output import FILE_MODE
+
+# preview refreshes per second
+FRAMERATE = 5
+# file the headless display keeps up to date(binary PPM)
+FRAMEBUFFER = Path('images/framebuffer.ppm')
+
+
+class Preview():
+    """newest snapshot of a w x h film, tone mapped on demand
+
+    Args:
+        w, h (int): image size in pixels
+        tonemapping (float): SDL tonemapping value
+    """
+
+    def __init__(self, w, h, tonemapping):
+        self.w = w
+        self.h = h
+        self.tonemapping = tonemapping
+        # (radiance, counts) pairs, front holds the newest complete snapshot
+        self.__buffers = [(np.zeros((h, w, 3)), np.zeros((h, w))) for _ in range(2)]
+        self.__front = None
+        self.__reading = None
+        # bumped by every snapshot, displays skip frames they already have
+        self.version = 0
+
+    def submit(self, film):
+        """snapshot film.radiance/film.counts(they may be written meanwhile, a
+        preview does not mind), False if the display still reads the back buffer"""
+        back = 1 if self.__front == 0 else 0
+        if self.__reading == back:
+            return False
+        radiance, counts = self.__buffers[back]
+        np.copyto(radiance, film.radiance)
+        np.copyto(counts, film.counts)
+        self.__front = back
+        self.version += 1
+        return True
+
+    def frame(self):
+        """newest snapshot as (h, w, 3) uint8 RGB, top row first, None before any submit"""
+        while True:
+            front = self.__front
+            if front is None:
+                return None
+            self.__reading = front
+            # a flip in between may hand this buffer back to submit, claim the new front
+            if self.__front == front:
+                break
+        try:
+            radiance, counts = self.__buffers[front]
+            image = tonemap(radiance/np.maximum(counts, 1)[:, :, None], self.tonemapping)
+            return (image*255 + 0.5).astype(np.uint8)
+        finally:
+            self.__reading = None
+
+
+class WindowDisplay():
+    """pyglet window showing a Preview
+
+    Args:
+        preview (Preview): frames to show
+        source (film.Film): snapshot taken on every refresh, None if the
+            renderer submits itself
+        interval (float): seconds between refreshes
+    """
+
+    def __init__(self, preview, source=None, interval=1/FRAMERATE):
+        import pyglet
+
+        self.pyglet = pyglet
+        self.preview = preview
+        self.source = source
+        self.image = None
+        self.version = None
+        self.window = pyglet.window.Window(width=preview.w, height=preview.h)
+        self.window.event(self.on_draw)
+        pyglet.clock.schedule_interval(self.refresh, interval)
+
+    def refresh(self, dt=None):
+        if self.source is not None:
+            self.preview.submit(self.source)
+        if self.preview.version == self.version:
+            return
+        self.version = self.preview.version
+        frame = self.preview.frame()
+        if frame is None:
+            return
+        # a negative pitch hands the rows top first, OpenGL stores them bottom first
+        pitch = -3*self.preview.w
+        if self.image is None:
+            self.image = self.pyglet.image.ImageData(
+                self.preview.w, self.preview.h, 'RGB', frame.tobytes(), pitch=pitch
+            )
+        else:
+            self.image.set_data('RGB', pitch, frame.tobytes())
+
+    def on_draw(self):
+        self.window.clear()
+        if self.image is not None:
+            self.image.blit(0, 0)
+
+    def run(self, done=None):
+        """show the window until it is closed"""
+        self.pyglet.app.run()
+
+
+class FileDisplay():
+    """write the frames of a Preview to a binary PPM file, replaced atomically
+
+    Args:
+        preview (Preview): frames to write
+        path (Path): framebuffer file
+        source (film.Film): snapshot taken on every refresh, None if the
+            renderer submits itself
+        interval (float): seconds between refreshes
+    """
+
+    def __init__(self, preview, path=FRAMEBUFFER, source=None, interval=1/FRAMERATE):
+        self.preview = preview
+        self.path = Path(path)
+        self.source = source
+        self.interval = interval
+        self.version = None
+        self.__stopped = threading.Event()
+
+    def refresh(self):
+        if self.source is not None:
+            self.preview.submit(self.source)
+        if self.preview.version == self.version:
+            return
+        self.version = self.preview.version
+        frame = self.preview.frame()
+        if frame is None:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.path.parent, delete=False) as file:
+            file.write(f"P6\n{self.preview.w} {self.preview.h}\n255\n".encode())
+            file.write(frame.tobytes())
+        os.chmod(file.name, FILE_MODE)
+        os.replace(file.name, self.path)
+
+    def run(self, done=None):
+        """refresh until done() is True(or stop is called), then write a last frame"""
+        while not self.__stopped.is_set() and not (done is not None and done()):
+            start = time.monotonic()
+            self.refresh()
+            self.__stopped.wait(max(self.interval - (time.monotonic() - start), 0))
+        self.refresh()
+
+    def stop(self):
+        self.__stopped.set()
+
+
+def open_display(preview, path=FRAMEBUFFER, source=None, interval=1/FRAMERATE):
+    """WindowDisplay if pyglet is installed and a window opens, FileDisplay otherwise"""
+    try:
+        return WindowDisplay(preview, source, interval)
+    except Exception:
+        # no pyglet or no screen(ssh, containers)
+        return FileDisplay(preview, path, source, interval)
@@ -0,0 +1,56 @@
+"""
+Message framing of the render server
+
+A message is a JSON object on one line. A message carrying an array has its
+'dtype' and 'shape' in the header and the raw array bytes(C order) follow the
+line, so images travel without any encoding.
+
+write_message - send a header and an optional array
+read_message - receive one message
+"""
+import json
+
+import numpy as np
+
+
+async def write_message(writer, header, array=None):
+    """send header(dict) and array on an asyncio.StreamWriter"""
+    if array is not None:
+        array = np.ascontiguousarray(array)
+        header = dict(header, dtype=array.dtype.str, shape=list(array.shape))
+    writer.write(json.dumps(header).encode() + b'\n')
+    if array is not None:
+        writer.write(array.tobytes())
+    await writer.drain()
+
+
+async def read_message(reader, arrays=True):
+    """next (header, array) of an asyncio.StreamReader, array is None when the
+    message has none, (None, None) once the other side closed
+
+    Raises:
+        json.JSONDecodeError: the line is not JSON, the next message can still be read
+        ValueError: the header is not an object, or its array is malformed or not
+            allowed(arrays False)
+    """
+    line = await reader.readline()
+    if not line:
+        return None, None
+    header = json.loads(line)
+    if not isinstance(header, dict):
+        raise ValueError(f"A message is a JSON object, got {line.decode(errors='replace').strip()}")
+
+    array = None
+    if 'dtype' in header:
+        if not arrays:
+            raise ValueError("This message may not carry an array")
+        try:
+            dtype = np.dtype(header['dtype'])
+            shape = tuple(int(n) for n in header['shape'])
+        except (KeyError, TypeError, ValueError) as error:
+            raise ValueError(f"Invalid array header: {error}") from None
+        if dtype.hasobject or any(n < 0 for n in shape):
+            raise ValueError(f"Invalid array {dtype} {shape}")
+        data = await reader.readexactly(dtype.itemsize*int(np.prod(shape)))
+        array = np.frombuffer(data, dtype=dtype).reshape(shape)
+    return header, array
@@ -0,0 +1,210 @@
+"""
+Compiled scene cache
+
+A scene is compiled once into a directory next to its SDL file,
+.scenecache/<sdl name>-<hash>/, keyed by a hash of the SDL and OBJ contents.
+scene.bin packs the triangle arrays(sorted in BVH leaf order), the BVH nodes,
+the material table, the light triangles and, for instanced scenes, every
+distinct instanced mesh with its BVH plus the instance transforms and top
+level nodes; index.json has the dtype, shape and offset of each array. scene.bin is opened with np.memmap, so repeated runs
+skip parsing and building, and every worker process reads the same page cache
+copy of the geometry.
+
+CompiledScene - mesh, BVH, materials, lights and instances of a compiled scene
+scene_key - content hash of a scene
+load_scene - open the compiled scene of a SceneLoader, compiling it if needed
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from output import DIR_MODE, FILE_MODE
+from scene.bvh import BVH, NODE_ARRAYS
+from scene.instances import INSTANCE_ARRAYS, TOP_ARRAYS, Instances
+from scene.mesh import MESH_ARRAYS, TriangleMesh
+from scene.objects import MATERIAL_ARRAYS, Light, Materials
+
+CACHE_DIR = '.scenecache'
+# bump when the layout changes, old caches are then recompiled
+VERSION = 2
+
+LIGHT_ARRAYS = ('lp', 'color', 'p1', 'p2', 'p3', 'offsets')
+# arrays start at multiples of ALIGNMENT bytes in scene.bin
+ALIGNMENT = 64
+
+
+class CompiledScene():
+    """scene geometry ready for PathTracing.from_compiled
+
+    Args:
+        mesh (scene.mesh.TriangleMesh): triangles in BVH leaf order
+        bvh (scene.bvh.BVH): hierarchy over mesh
+        materials (scene.objects.Materials): per object properties
+        lights (list): scene.objects.Light
+        instances (scene.instances.Instances): instanced meshes, None if there is none
+        path (Path): cache directory, None for a scene kept in memory
+    """
+
+    def __init__(self, mesh, bvh, materials, lights, instances=None, path=None):
+        self.mesh = mesh
+        self.bvh = bvh
+        self.materials = materials
+        self.lights = lights
+        self.instances = instances
+        self.path = path
+
+    @classmethod
+    def from_loader(cls, loader):
+        """parse the scene of a readers.load.SceneLoader and build its BVH"""
+        mesh, materials = loader.get_mesh()
+        bvh = BVH(mesh)
+        # sorting the triangles in leaf order lets the BVH read the mesh arrays directly
+        mesh = mesh.take(bvh.order)
+        nodes = dict(bvh.arrays(), order=np.arange(len(mesh), dtype=np.int64))
+
+        return cls(
+            mesh, BVH.from_arrays(mesh, nodes), materials, loader.get_light(),
+            loader.get_instances()
+        )
+
+    @classmethod
+    def open(cls, path):
+        """open a compiled scene directory memory-mapped"""
+        with open(path / 'index.json') as file:
+            index = json.load(file)
+        data = np.memmap(path / 'scene.bin', mode='r')
+
+        def load(group, names):
+            arrays = {}
+            for name in names:
+                dtype, shape, offset = index[f"{group}/{name}"]
+                dtype = np.dtype(dtype)
+                size = dtype.itemsize*int(np.prod(shape))
+                # plain ndarray views of the map, memmap indexing is slow in hot loops
+                arrays[name] = np.asarray(data[offset:offset + size].view(dtype).reshape(shape))
+            return arrays
+
+        mesh = TriangleMesh.from_arrays(load('mesh', MESH_ARRAYS))
+        bvh = BVH.from_arrays(mesh, load('bvh', NODE_ARRAYS))
+        materials = Materials.from_arrays(load('material', MATERIAL_ARRAYS))
+
+        light = load('light', LIGHT_ARRAYS)
+        lights = []
+        for i, lp in enumerate(light['lp']):
+            tris = slice(light['offsets'][i], light['offsets'][i + 1])
+            lights.append(Light(
+                float(lp), light['color'][i],
+                triangles=(light['p1'][tris], light['p2'][tris], light['p3'][tris])
+            ))
+
+        instances = None
+        if 'instance/mesh_id' in index:
+            arrays = load('instance', INSTANCE_ARRAYS)
+            bvhs = []
+            for i in range(int(arrays['mesh_id'].max()) + 1):
+                blas_mesh = TriangleMesh.from_arrays(load(f"mesh{i}", MESH_ARRAYS))
+                bvhs.append(BVH.from_arrays(blas_mesh, load(f"bvh{i}", NODE_ARRAYS)))
+            instances = Instances(
+                bvhs, arrays['mesh_id'], arrays['transform'], arrays['object_id'],
+                top=load('top', TOP_ARRAYS)
+            )
+
+        return cls(mesh, bvh, materials, lights, instances, path)
+
+    def save(self, path):
+        """write scene.bin and index.json in the directory path"""
+        lights = self.lights
+        # light i owns the triangles offsets[i]:offsets[i + 1]
+        light = {
+            'lp': np.array([l.lp for l in lights], dtype=float),
+            'color': np.array([l.color for l in lights], dtype=float).reshape(-1, 3),
+            'offsets': np.cumsum([0] + [len(l.p1) for l in lights]).astype(np.int64),
+        }
+        for p in ('p1', 'p2', 'p3'):
+            light[p] = np.concatenate([getattr(l, p) for l in lights] or [np.zeros((0, 3))])
+
+        groups = {
+            'mesh': self.mesh.arrays(),
+            'bvh': self.bvh.arrays(),
+            'material': self.materials.arrays(),
+            'light': light,
+        }
+        if self.instances is not None:
+            groups['instance'] = self.instances.arrays()
+            groups['top'] = self.instances.top_arrays()
+            for i, bvh in enumerate(self.instances.bvhs):
+                groups[f"mesh{i}"] = bvh.mesh.arrays()
+                groups[f"bvh{i}"] = bvh.arrays()
+        index = {}
+        with open(path / 'scene.bin', 'wb') as file:
+            for group, arrays in groups.items():
+                for name, array in arrays.items():
+                    array = np.ascontiguousarray(array)
+                    file.write(bytes(-file.tell() % ALIGNMENT))
+                    index[f"{group}/{name}"] = array.dtype.str, array.shape, file.tell()
+                    file.write(array.tobytes())
+
+        with open(path / 'index.json', 'w') as file:
+            json.dump(index, file)
+
+
+def scene_key(loader):
+    """hash of the SDL file and every OBJ file it references"""
+    digest = hashlib.sha256(f"scene cache {VERSION}".encode())
+    digest.update(loader.sdl_file.read_bytes())
+
+    obj_files = [obj for obj, _ in loader.sdl.objects] + [obj for obj, _, _ in loader.sdl.lights]
+    obj_files += list(dict.fromkeys(obj for obj, _, _ in loader.sdl.instances))
+    for obj_file in obj_files:
+        digest.update(obj_file.encode())
+        digest.update((loader.path / obj_file).read_bytes())
+
+    return digest.hexdigest()[:16]
+
+
+def load_scene(loader, cache=True):
+    """compiled scene of a readers.load.SceneLoader
+
+    Args:
+        loader (readers.load.SceneLoader): scene to be compiled
+        cache (bool): reuse/write the cache directory, False compiles in memory
+
+    Returns:
+        CompiledScene
+    """
+    if not cache:
+        return CompiledScene.from_loader(loader)
+
+    root = loader.path / CACHE_DIR
+    name = f"{loader.sdl_file.stem}-{scene_key(loader)}"
+    path = root / name
+
+    if not path.is_dir():
+        root.mkdir(exist_ok=True)
+        # compile in a private directory and rename it, so readers never see half a cache
+        tmp = tempfile.mkdtemp(dir=root, prefix='.tmp-')
+        try:
+            CompiledScene.from_loader(loader).save(Path(tmp))
+            # mkdtemp directories are private(0700), other users open the cache too
+            for file in Path(tmp).iterdir():
+                os.chmod(file, FILE_MODE)
+            os.chmod(tmp, DIR_MODE)
+            os.rename(tmp, path)
+        except OSError:
+            # another process compiled the same scene first
+            if not path.is_dir():
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        # caches of older versions of this scene
+        for old in root.glob(f"{loader.sdl_file.stem}-*"):
+            if old != path and old.name.rsplit('-', 1)[0] == loader.sdl_file.stem:
+                shutil.rmtree(old, ignore_errors=True)
+
+    return CompiledScene.open(path)
@@ -1,12 +1,7 @@
-import regex
-
-SPACE_REGEX = '[ ]+'
-
 def read_lines(f: str):
 
     def remove_spaces(line):
-        line = regex.sub(SPACE_REGEX, ' ', line)
-        return line.strip()
+        return ' '.join(line.split())
 
     lines = []
     for line in f.split('\n'):
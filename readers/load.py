@@ -1,10 +1,14 @@
 from pathlib import Path
 
 import numpy as np
+from readers.cache import load_scene
 from readers.sdl import SDLReader
 from readers.obj import OBJReader
+from scene.animation import Animation
 from scene.camera import Camera
-from scene.objects import Light, Properties, SceneObject
+from scene.instances import Instances
+from scene.mesh import TriangleMesh
+from scene.objects import Light, Materials, Properties, SceneObject
 from scene.triangles import Triangles
 
 PATH = Path('./cornellroom/')
@@ -12,35 +16,66 @@ SDL_FILE = PATH / 'cornellroom.sdl'
 
 class SceneLoader():
 
-    def __init__(self):
+    def __init__(self, sdl_file=SDL_FILE):
+        self.sdl_file = Path(sdl_file)
+        # obj files are relative to the sdl file
+        self.path = self.sdl_file.parent
         self.sdl = SDLReader()
-        self.sdl.read(SDL_FILE)
+        self.sdl.read(self.sdl_file)
+        # obj file name -> readers.obj.OBJMesh, light files are also scene objects
+        self.__obj_files = {}
 
     def get_objects(self):
-        objects = []
+        return [
+            self.__get_object(obj_file_name, properties)
+            for obj_file_name, properties in self.__entries()
+        ]
 
-        # objects
-        for obj_file_name, obj_props in self.sdl.objects:
-            # properties
-            properties = Properties(
-                color = obj_props[:3],
-                ka = obj_props[3],
-                kd = obj_props[4],
-                ks = obj_props[5],
-                kt = obj_props[6],
-                n  = obj_props[7]
-            )
-            # object vertices/triangles
-            obj = self.__get_object(obj_file_name, properties)
-            objects.append(obj)
+    def get_mesh(self):
+        """scene.mesh.TriangleMesh and scene.objects.Materials of the scene objects,
+        same triangles and object ids as from get_objects but built from arrays
 
-        # light object
-        for obj_file_name, color, lp in self.sdl.lights:
-            properties = Properties(color=np.array(color)*lp, is_light=True)
-            obj_scene = self.__get_object(obj_file_name, properties=properties)
-            objects.append(obj_scene)    
+        The materials of the instances(see get_instances) follow the lights.
+        """
+        triangles, object_id, properties = [], [], []
+        for idx, (obj_file_name, obj_properties) in enumerate(self.__entries()):
+            tris = self.__read(obj_file_name).triangles()
+            triangles.append(tris)
+            object_id.append(np.full(len(tris), idx))
+            properties.append(obj_properties)
+
+        triangles = np.concatenate(triangles) if triangles else np.zeros((0, 3, 3))
+        object_id = np.concatenate(object_id) if object_id else np.zeros(0, dtype=np.int64)
+        mesh = TriangleMesh(triangles[:, 0], triangles[:, 1], triangles[:, 2], object_id)
+        properties += [self.__properties(material) for _, _, material in self.sdl.instances]
+        return mesh, Materials(properties)
+
+    def get_instances(self):
+        """scene.instances.Instances of the SDL instance lines, None if there is none
+
+        Every OBJ file is read and indexed once however many instances place it.
+        """
+        if not self.sdl.instances:
+            return None
+
+        n_entries = len(self.sdl.objects) + len(self.sdl.lights)
+        # obj file -> index of its mesh
+        obj_files = {}
+        for obj, _, _ in self.sdl.instances:
+            obj_files.setdefault(obj, len(obj_files))
+        meshes = []
+        for obj_file_name in obj_files:
+            tris = self.__read(obj_file_name).triangles()
+            meshes.append(
+                TriangleMesh(tris[:, 0], tris[:, 1], tris[:, 2], np.zeros(len(tris)))
+            )
 
-        return objects
+        return Instances.from_meshes(
+            meshes,
+            [obj_files[obj] for obj, _, _ in self.sdl.instances],
+            [transform for _, transform, _ in self.sdl.instances],
+            n_entries + np.arange(len(self.sdl.instances)),
+        )
 
     def get_camera(self):
         camera = Camera(
@@ -52,23 +87,109 @@ class SceneLoader():
         )
         return camera
 
+    def get_animation(self):
+        """scene.animation.Animation of the SDL frames and keys(one static frame by default)
+
+        object_key names an OBJ file, every object or light of that file moves.
+        """
+        object_ids = {}
+        for idx, (obj_file_name, _) in enumerate(self.__entries()):
+            object_ids.setdefault(obj_file_name, []).append(idx)
+
+        object_keys = {}
+        for obj_file_name, frame, values in self.sdl.object_keys:
+            if obj_file_name not in object_ids:
+                raise ValueError(f"object_key of {obj_file_name}, not an object or light")
+            for idx in object_ids[obj_file_name]:
+                object_keys.setdefault(idx, []).append((frame, np.reshape(values, (4, 4))))
+
+        instance_keys = {}
+        for inst, frame, values in self.sdl.instance_keys:
+            if not 0 <= inst < len(self.sdl.instances):
+                raise ValueError(
+                    f"instance_key of instance {inst}, the SDL has {len(self.sdl.instances)}"
+                )
+            instance_keys.setdefault(inst, []).append((frame, np.reshape(values, (4, 4))))
+
+        return Animation(
+            self.sdl.frames, self.get_camera(), self.sdl.camera_keys, object_keys,
+            instance_keys, len(self.sdl.objects)
+        )
+
     def get_size(self):
         return self.sdl.size[0], self.sdl.size[1]
 
     def get_light(self):
         lights = []
         for obj_file_name, color, lp in self.sdl.lights:
-            objs = self.__get_object(obj_file_name)
+            tris = self.__read(obj_file_name).triangles()
             lights.append(
-                Light(lp, color, objs)
+                Light(lp, color, triangles=(tris[:, 0], tris[:, 1], tris[:, 2]))
             )
         return lights
 
+    def get_compiled(self, cache=True):
+        """readers.cache.CompiledScene, memory-mapped from the scene cache unless cache=False"""
+        return load_scene(self, cache)
+
     def get_tonemapping(self):
         return self.sdl.tonemapping
 
+    def get_output(self):
+        """image file named by the SDL output directive, None if there is none"""
+        return self.sdl.output
+
+    def get_integrator(self):
+        """render.INTEGRATORS name set by the SDL integrator directive('phong' by default)"""
+        return self.sdl.integrator
+
+    def get_reflections(self):
+        """max number of bounces of a path(SDL reflections)"""
+        return self.sdl.reflections
+
+    def get_npaths(self):
+        """paths per pixel set by the SDL npaths directive, None if there is none"""
+        return self.sdl.npaths
+
+    def get_sampler(self):
+        """samplers.SAMPLERS name set by the SDL sampler directive('random' by default)"""
+        return self.sdl.sampler
+
+    def get_seed(self):
+        """seed set by the SDL seed directive, None if there is none"""
+        return self.sdl.seed
+
+    def get_threshold(self):
+        """adaptive sampling error threshold, None to sample every pixel every pass"""
+        return self.sdl.threshold
+
+    def __entries(self):
+        """(obj file, Properties) of every scene object, lights last"""
+        for obj_file_name, obj_props in self.sdl.objects:
+            yield obj_file_name, self.__properties(obj_props)
+
+        for obj_file_name, color, lp in self.sdl.lights:
+            yield obj_file_name, Properties(color=np.array(color)*lp, is_light=True)
+
+    def __properties(self, obj_props):
+        """Properties of the SDL values red green blue ka kd ks kt n"""
+        return Properties(
+            color = obj_props[:3],
+            ka = obj_props[3],
+            kd = obj_props[4],
+            ks = obj_props[5],
+            kt = obj_props[6],
+            n  = obj_props[7]
+        )
+
+    def __read(self, obj_file_name):
+        if obj_file_name not in self.__obj_files:
+            self.__obj_files[obj_file_name] = OBJReader.read_arrays(self.path / obj_file_name)
+        return self.__obj_files[obj_file_name]
+
     def __get_object(self,obj_file_name, properties=None):
-        vertices, faces = OBJReader().read(PATH / obj_file_name)
+        obj_mesh = self.__read(obj_file_name)
+        vertices, faces = obj_mesh.vertices, obj_mesh.faces
         triangles = []
         for face in faces:
             t = Triangles(
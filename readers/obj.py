@@ -1,9 +1,41 @@
 """
-Implement class to read a SDL(Scene Description Language)
+Implement class to read a OBJ(Wavefront object) file
+
+OBJMesh - vertices, triangles and normals of an OBJ file as arrays
+OBJReader - chunked OBJ parser
 """
-from readers.helper import read_lines, to_int, to_float
+import warnings
+
+import numpy as np
+
+# bytes read from the file at once
+CHUNK_SIZE = 1 << 24
+
+
+class OBJMesh():
+    """OBJ geometry, polygons fan triangulated
+
+    The vn normals are kept with the geometry, but the renderer shades with
+    the flat triangle normals(scene.mesh.TriangleMesh has no per corner normals).
+
+    Args:
+        vertices (np.array): (V, 3) positions
+        faces (np.array): (F, 3) vertex indices of every triangle
+        normals (np.array): (N, 3) vn normals
+        face_normals (np.array): (F, 3) normal index of every triangle corner, -1 when
+            the face gives none
+    """
+
+    def __init__(self, vertices, faces, normals, face_normals):
+        self.vertices = vertices
+        self.faces = faces
+        self.normals = normals
+        self.face_normals = face_normals
+
+    def triangles(self):
+        """(F, 3, 3) corner positions of every triangle"""
+        return self.vertices[self.faces]
 
-SPACE_REGEX = '[ ]+'
 
 class OBJReader():
 
@@ -16,22 +48,182 @@ class OBJReader():
 
         Args:
             obj_path (str): obj file path
+
+        Returns:
+            vertices, faces as lists(see read_arrays)
         """
-        # Read and load objects
-        with open(obj_path, 'r') as file:
-            f = file.read()
-
-        vertices = []
-        faces = []
-        for line in read_lines(f):
-            split = line.split(' ')
-            command, data = split[0], split[1:]
-            if command == 'v':
-                vertices.append(to_float(data))
-            elif command == 'f':
-                data = [x - 1 for x in to_int(data)]
-                faces.append(to_int(data))
-            else:
-                raise ValueError(f"Command not found {command}")
-
-        return vertices, faces
+        mesh = clf.read_arrays(obj_path)
+        return mesh.vertices.tolist(), mesh.faces.tolist()
+
+    @classmethod
+    def read_arrays(clf, obj_path: str, chunk_size=CHUNK_SIZE):
+        """parse a obj file chunk by chunk into arrays
+
+        v, vn and f(v, v/vt, v//vn or v/vt/vn corners, negative indices
+        included) are read, polygons are fan triangulated and every other
+        directive(vt, o, g, s, usemtl, ...) and # comments are skipped.
+
+        Args:
+            obj_path (str): obj file path
+            chunk_size (int): bytes parsed at once
+
+        Returns:
+            OBJMesh
+        """
+        parser = _ChunkParser()
+        with open(obj_path, 'rb') as file:
+            rest = b''
+            while True:
+                data = file.read(chunk_size)
+                if not data:
+                    break
+                data = rest + data
+                # a chunk ends at a line break, the partial line goes to the next one
+                cut = data.rfind(b'\n') + 1
+                parser.parse(data[:cut])
+                rest = data[cut:]
+            parser.parse(rest)
+
+        return parser.mesh()
+
+
+class _ChunkParser():
+    """accumulate the arrays of consecutive chunks of a obj file"""
+
+    def __init__(self):
+        self.vertices = []
+        self.normals = []
+        self.faces = []
+        self.face_normals = []
+        self.n_vertices = 0
+        self.n_normals = 0
+
+    def parse(self, text):
+        if b'#' in text:
+            # a comment may follow the values of a line
+            text = b'\n'.join(line.split(b'#', 1)[0] for line in text.split(b'\n'))
+        if b'\t' in text:
+            text = text.replace(b'\t', b' ')
+        if b'\n ' in text or text.startswith(b' '):
+            text = b'\n'.join(line.lstrip() for line in text.split(b'\n'))
+        if not text.endswith(b'\n'):
+            text += b'\n'
+
+        # every line is classified by its first bytes, no per line python objects
+        chars = np.frombuffer(text + b'\0\0\0', dtype=np.uint8)
+        starts = np.concatenate(([0], np.flatnonzero(chars == ord('\n')) + 1))
+        first, second, third = chars[starts], chars[starts + 1], chars[starts + 2]
+        is_v = (first == ord('v')) & (second == ord(' '))
+        is_vn = (first == ord('v')) & (second == ord('n')) & (third == ord(' '))
+        is_f = (first == ord('f')) & (second == ord(' '))
+
+        n_v, n_vn = int(is_v.sum()), int(is_vn.sum())
+        if n_v:
+            self.vertices.append(parse_vectors(select_lines(text, starts, is_v), b'v ', n_v))
+        if n_vn:
+            self.normals.append(parse_vectors(select_lines(text, starts, is_vn), b'vn ', n_vn))
+        if is_f.any():
+            # vertices/normals read before each face line, for negative indices
+            v_base = self.n_vertices + np.cumsum(is_v)[is_f]
+            vn_base = self.n_normals + np.cumsum(is_vn)[is_f]
+            faces, face_normals = parse_faces(select_lines(text, starts, is_f), v_base, vn_base)
+            self.faces.append(faces)
+            self.face_normals.append(face_normals)
+
+        self.n_vertices += n_v
+        self.n_normals += n_vn
+
+    def mesh(self):
+        def concat(arrays, dtype):
+            return np.concatenate(arrays) if arrays else np.zeros((0, 3), dtype=dtype)
+
+        return OBJMesh(
+            concat(self.vertices, float), concat(self.faces, np.int64),
+            concat(self.normals, float), concat(self.face_normals, np.int64)
+        )
+
+
+def parse_numbers(text, dtype, count):
+    """count numbers separated by spaces, None if text holds something else"""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            numbers = np.fromstring(text, dtype=dtype, sep=' ')
+        except ValueError:
+            return None
+    return numbers if len(numbers) == count else None
+
+
+def select_lines(text, starts, mask):
+    """the lines of text flagged by mask, joined(consecutive lines are sliced at once)"""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    first, last = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    return b''.join(text[starts[i]:starts[j]] for i, j in zip(first, last))
+
+
+def parse_vectors(text, key, n):
+    """(n, 3) array of the first 3 numbers of n key lines(drops w and vertex colors)"""
+    numbers = parse_numbers(text.replace(key, b' '), float, 3*n)
+    if numbers is not None:
+        return numbers.reshape(-1, 3)
+    lines = text.splitlines()
+    return np.array([line.split()[1:4] for line in lines], dtype=float).reshape(-1, 3)
+
+
+def parse_faces(text, v_base, vn_base):
+    """fan triangulated vertex and normal indices of f lines
+
+    Args:
+        text (bytes): f lines
+        v_base, vn_base (np.array): vertices/normals read before each line
+
+    Returns:
+        (F, 3) vertex indices, (F, 3) normal indices(-1 when missing)
+    """
+    text = text.replace(b'f ', b' ')
+    counts = count_tokens(text, len(v_base))
+
+    # every corner as (v, vt, vn), 0 marks a missing index
+    width = text.split(None, 1)[0].count(b'/') + 1
+    numbers = parse_numbers(
+        text.replace(b'//', b'/0/').replace(b'/', b' '), np.int64, width*counts.sum()
+    )
+    if numbers is not None:
+        indices = numbers.reshape(-1, width)
+    else:
+        # corners written in mixed forms
+        corners = text.split()
+        indices = np.zeros((len(corners), 3), dtype=np.int64)
+        for i, corner in enumerate(corners):
+            values = corner.split(b'/')
+            indices[i, :len(values)] = [int(value) if value else 0 for value in values]
+
+    vertex = indices[:, 0]
+    normal = indices[:, 2] if indices.shape[1] > 2 else np.zeros(len(indices), dtype=np.int64)
+    # negative indices count back from the last vertex/normal read
+    vertex = np.where(vertex < 0, np.repeat(v_base, counts) + vertex + 1, vertex)
+    normal = np.where(normal < 0, np.repeat(vn_base, counts) + normal + 1, normal)
+    # 1-based to 0-based, a missing normal(0) becomes -1
+    vertex = vertex - 1
+    normal = normal - 1
+
+    # fan: polygon (c0, c1, ..., ck) -> (c0, c1, c2), (c0, c2, c3), ...
+    starts = np.cumsum(counts) - counts
+    n_triangles = np.maximum(counts - 2, 0)
+    polygon = np.repeat(np.arange(len(counts)), n_triangles)
+    first = starts[polygon]
+    step = np.arange(len(polygon)) - np.repeat(np.cumsum(n_triangles) - n_triangles, n_triangles)
+    corner_ids = np.stack((first, first + step + 1, first + step + 2), axis=1)
+
+    return vertex[corner_ids], normal[corner_ids]
+
+
+def count_tokens(text, n_lines):
+    """number of space separated tokens on each of the n_lines lines of text"""
+    chars = np.frombuffer(text, dtype=np.uint8)
+    blank = (chars == ord(' ')) | (chars == ord('\r')) | (chars == ord('\n'))
+    token_start = ~blank
+    token_start[1:] &= blank[:-1]
+    line_ends = np.flatnonzero(chars == ord('\n'))
+    line = np.searchsorted(line_ends, np.flatnonzero(token_start))
+    return np.bincount(line, minlength=n_lines)[:n_lines]
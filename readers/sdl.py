@@ -9,6 +9,27 @@ class SDLReader():
     def __init__(self):
         self.lights = []
         self.objects = [] 
+        # (obj file, 16 row major transform values, material) of every instance
+        self.instances = []
+        # adaptive sampling is off unless the file sets a threshold
+        self.threshold = None
+        self.output = None
+        # paths per pixel, None leaves it to the renderer
+        self.npaths = None
+        # render.INTEGRATORS name
+        self.integrator = 'phong'
+        # max path depth
+        self.reflections = 10
+        # random numbers seed, None picks one per render
+        self.seed = None
+        # samplers.SAMPLERS name
+        self.sampler = 'random'
+        # animation: number of frames, (frame, eye, target, up) camera keys and
+        # (obj file or instance index, frame, 16 row major transform values) keys
+        self.frames = 1
+        self.camera_keys = []
+        self.object_keys = []
+        self.instance_keys = []
 
     def read(self, sdl_path: str):
         """read and parse sdl file
@@ -46,6 +67,8 @@ class SDLReader():
             self.ambient = float(options[1])
         elif 'npaths' == command:
             self.npaths = int(options[1]) 
+        elif 'threshold' == command:
+            self.threshold = float(options[1])
         elif 'tonemapping' == command:
             self.tonemapping = float(options[1])  
         elif 'seed' == command:
@@ -54,14 +77,45 @@ class SDLReader():
             self.objects.append(
                 (options[1], to_float(options[2:]))
             )
+        elif 'instance' == command:
+            if len(options) != 26:
+                raise ValueError(
+                    f"instance {options[1]}: esperados 16 valores da matriz 4x4 e 8 do material!"
+                )
+            self.instances.append(
+                (options[1], to_float(options[2:18]), to_float(options[18:]))
+            )
         elif 'light' == command:
             self.lights.append(
                 (options[1], to_float(options[2:-1]), float(options[-1]))
             )
         elif 'output' == command:
             self.output = options[1]
+        elif 'integrator' == command:
+            self.integrator = options[1]
+        elif 'sampler' == command:
+            self.sampler = options[1]
         elif 'reflections' == command:
             self.reflections = int(options[1])
+        elif 'frames' == command:
+            self.frames = int(options[1])
+        elif 'camera_key' == command:
+            if len(options) != 11:
+                raise ValueError(f"camera_key {options[1]}: esperados eye, target e up!")
+            values = to_float(options[2:])
+            self.camera_keys.append(
+                (int(options[1]), values[:3], values[3:6], values[6:])
+            )
+        elif command in ('object_key', 'instance_key'):
+            if len(options) != 19:
+                raise ValueError(
+                    f"{command} {options[1]}: esperados o frame e 16 valores da matriz 4x4!"
+                )
+            keys = self.object_keys if command == 'object_key' else self.instance_keys
+            target = options[1] if command == 'object_key' else int(options[1])
+            keys.append(
+                (target, int(options[2]), to_float(options[3:]))
+            )
         else:
             raise ValueError(f"Comando não encontrado: {command}!") 
 
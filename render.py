@@ -1,41 +1,128 @@
 """
 PATH TRACING Python Implementation
+
+PathTracing - Phong illumination at every path end
+NEEPathTracing - next event estimation with multiple importance sampling
+INTEGRATORS - integrator name -> class
 """
-import random
+from contextlib import nullcontext
+
 import numpy as np
 
+from rng import DIM_DIRECTION, DIM_LIGHT, DIM_LIGHTS, DIM_LOBE, DIM_SURVIVAL
+from samplers import SAMPLERS
 from scene.ray import Ray
-from help import sampling_up_hemisphere, snell_law
+from scene.mesh import TriangleMesh
+from scene.bvh import BVH
+from scene.objects import Materials
+from scene.emitters import EmitterSampler
+from scene.instances import TwoLevelBVH
+from help import (
+    sampling_up_hemisphere, snell_law,
+    sampling_up_hemisphere_batch, sampling_lobe_batch, snell_law_batch, normalize
+)
+
+# below this size testing every triangle beats the BVH traversal overhead
+BVH_MIN_TRIANGLES = 1024
+# stage timer used while stats are disabled
+NO_STAGE = nullcontext()
+# NEEPathTracing paths longer than this face russian roulette
+ROULETTE_DEPTH = 3
+# max survival probability, bright paths still end eventually
+ROULETTE_MAX_SURVIVAL = 0.95
 
 
 class PathTracing():
 
-    def __init__(self, camera, scene_objects, lights, ambient = 0.5, n_reflections=10):
+    def __init__(
+            self, camera, scene_objects, lights, ambient = 0.5, n_reflections=10,
+            accelerator='auto', stats=None, mesh=None, materials=None, bvh=None,
+            instances=None, seed=0, sampler='random'
+        ):
+        """scene_objects are packed in a mesh and materials, unless both are given
+        (then scene_objects may be None). bvh is a prebuilt BVH over mesh,
+        instances(scene.instances.Instances) are traced on top of it. Every
+        random number comes from the samplers.SAMPLERS sampler(seed), keyed by
+        the pixel and sample of the path."""
         self.camera = camera 
         self.scene_objects = scene_objects 
         self.lights = lights
         self.ambient = ambient
         self.n_reflections = n_reflections
-
-    def path_tracing(self, ray):
-        """1 path for a given ray"""
+        self.mesh = TriangleMesh.from_scene(scene_objects) if mesh is None else mesh
+        self.materials = Materials.from_scene(scene_objects) if materials is None else materials
+        # per object Properties for the scalar path
+        self.properties = self.materials.properties()
+
+        # 'bvh', 'brute'(test every triangle) or 'auto', all share the intersect interface
+        if accelerator == 'auto':
+            accelerator = 'bvh' if len(self.mesh) >= BVH_MIN_TRIANGLES else 'brute'
+
+        if accelerator == 'bvh':
+            self.accelerator = BVH(self.mesh) if bvh is None else bvh
+        elif accelerator == 'brute':
+            self.accelerator = self.mesh
+        else:
+            raise ValueError(f"Unknown accelerator {accelerator}")
+
+        if instances is not None:
+            self.accelerator = TwoLevelBVH(self.accelerator, instances)
+
+        self.stats = stats
+        if sampler not in SAMPLERS:
+            raise ValueError(f"Unknown sampler {sampler}")
+        self.rng = SAMPLERS[sampler](seed)
+
+    @classmethod
+    def from_compiled(cls, camera, scene, **kwargs):
+        """path tracer over a readers.cache.CompiledScene(no parsing or BVH build)"""
+        return cls(
+            camera, None, scene.lights, mesh=scene.mesh, materials=scene.materials,
+            bvh=scene.bvh, instances=scene.instances, **kwargs
+        )
+
+    @property
+    def stats(self):
+        """stats.RenderStats being recorded or None(instrumentation off)"""
+        return self._stats
+
+    @stats.setter
+    def stats(self, stats):
+        self._stats = stats
+        self.accelerator.stats = stats
+
+    def refresh(self, camera=None):
+        """follow a scene moved in place(scene.animation.Animation.apply), the
+        acceleration data is refit by whoever moved it"""
+        if camera is not None:
+            self.camera = camera
+
+    def path_tracing(self, ray, sample=0):
+        """1 path for a given ray(of pixel ray.pixel) in sample number sample"""
         I = np.zeros(3)
-        intersection = self.__send_ray(ray)
+        pixel = 0 if ray.pixel is None else ray.pixel[1]*self.camera.pixels_size[0] + ray.pixel[0]
+        intersection = self.__send_ray(ray, 'primary')
+
+        if intersection is None:
+            self._end_path('miss', 1)
 
         if intersection:
             SP, SN, VP, obj_properties = intersection
 
             if obj_properties.is_light:
+                self._end_path('light', 1)
                 return obj_properties.color
 
-            I += self.__illumination(SP, SN, VP, obj_properties) 
+            I += self.__illumination(SP, SN, VP, obj_properties, (pixel, sample, 1))
             
             ###
             ### Secundary RAY
             ###
             snd_intersection = None
-            new_ray, att = self.__secundary_ray(SP, SN, VP, obj_properties)
-            snd_intersection = self.__send_ray(new_ray)
+            new_ray, att = self.__secundary_ray(SP, SN, VP, obj_properties, (pixel, sample, 1))
+            snd_intersection = self.__send_ray(new_ray, 'secondary')
+            depth = 2
+            ending = 'exhausted'
 
             for _ in range(self.n_reflections):
             
@@ -43,15 +130,20 @@ class PathTracing():
                     SP, SN, VP, obj_properties = snd_intersection
             
                     if obj_properties.is_light:
+                        ending = 'light'
                         break
-                    elif obj_properties.random() < obj_properties.kt:
+                    elif obj_properties.random(
+                        self.rng.uniform(pixel, sample, depth, DIM_SURVIVAL)
+                    ) < obj_properties.kt:
                         # New Ray
                         V = VP-SP
                         V = V/np.linalg.norm(V)
                         new_ray = Ray(SP, snell_law(-V, SN))
                         # Find intersections
-                        snd_intersection = self.__send_ray(new_ray)
+                        snd_intersection = self.__send_ray(new_ray, 'transmission')
+                        depth += 1
                     else:
+                        ending = 'surface'
                         break
                 else:
                     break
@@ -61,39 +153,199 @@ class PathTracing():
 
                 if obj_properties.is_light:
                     I += att*obj_properties.color
+                    ending = 'light'
                 else:
-                    I += att*self.__illumination(SP, SN, VP, obj_properties)
+                    I += att*self.__illumination(SP, SN, VP, obj_properties, (pixel, sample, depth))
+            else:
+                ending = 'miss'
+
+            self._end_path(ending, depth)
+
+        return I
+
+    def path_tracing_wavefront(self, origins, directions, pixels=None, sample=0):
+        """path_tracing for a batch of rays, each stage is one array operation
+
+        Paths are carried as arrays(surface point/normal, viewer point, object id,
+        attenuation and ray index) and terminated paths are compacted out after
+        every bounce.
+
+        Args:
+            origins (np.array): (N, 3) ray starting points
+            directions (np.array): (N, 3) ray directions
+            pixels (np.array): (N,) pixel index of each ray(row*w + column), the
+                random numbers of a path depend only on its pixel, sample and
+                bounce, defaults to 0, ..., N - 1
+            sample (int): sample(pass) number
+
+        Returns:
+            (N, 3) color of each ray
+        """
+        origins = np.asarray(origins, dtype=float).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=float).reshape(-1, 3)
+        pixels = np.arange(len(origins)) if pixels is None else np.asarray(pixels).reshape(-1)
+        I = np.zeros((len(origins), 3))
+        m = self.materials
+
+        # primary hits
+        SP, SN, VP, obj, path = self._send_rays(
+            'primary', 1, origins, directions, np.arange(len(origins))
+        )
+
+        light = m.is_light[obj]
+        I[path[light]] = m.color[obj[light]]
+        self._end_path('light', 1, np.count_nonzero(light))
+        path, SP, SN, VP, obj = self._compact(~light, path, SP, SN, VP, obj)
+
+        key = (pixels[path], sample, 1)
+        I[path] += self.__illumination_batch(SP, SN, VP, obj, key)
+
+        ###
+        ### Secundary RAYS
+        ###
+        with self._stage('sample'):
+            new_directions, att = self.__secundary_ray_batch(SP, SN, VP, obj, key)
+        SP, SN, VP, obj, path, att = self._send_rays('secondary', 2, SP, new_directions, path, att)
+        depth = 2
+
+        for _ in range(self.n_reflections):
+            if len(path) == 0:
+                break
+
+            key = (pixels[path], sample, depth)
+            light = m.is_light[obj]
+            refract = ~light & (m.random(obj, self._uniform(key, DIM_SURVIVAL)) < m.kt[obj])
+
+            # paths leaving the transmission loop are shaded right away
+            done = ~refract
+            I[path[done]] += self.__shade_batch(
+                *self._compact(done, SP, SN, VP, obj, att), subset(key, done)
+            )
+            self._end_path('light', depth, np.count_nonzero(light))
+            self._end_path('surface', depth, np.count_nonzero(done & ~light))
+
+            path, SP, SN, VP, obj, att = self._compact(refract, path, SP, SN, VP, obj, att)
+            with self._stage('sample'):
+                V = normalize(VP - SP)
+                new_directions = snell_law_batch(-V, SN)
+            depth += 1
+            SP, SN, VP, obj, path, att = self._send_rays(
+                'transmission', depth, SP, new_directions, path, att
+            )
+
+        I[path] += self.__shade_batch(SP, SN, VP, obj, att, (pixels[path], sample, depth))
+        if len(path) > 0:
+            light = m.is_light[obj]
+            self._end_path('light', depth, np.count_nonzero(light))
+            self._end_path('exhausted', depth, np.count_nonzero(~light))
 
         return I
 
-    def __send_ray(self, ray):
+    def trace_aovs(self, origins, directions):
+        """first hit albedo, normal and distance of a batch of rays(denoiser guides)
+
+        Args:
+            origins (np.array): (N, 3) ray starting points
+            directions (np.array): (N, 3) normalized ray directions
+
+        Returns:
+            (N, 3) albedo(object color), (N, 3) normal facing the ray, (N,) distance,
+            all 0 where the ray misses
+        """
+        origins = np.asarray(origins, dtype=float).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=float).reshape(-1, 3)
+        albedo = np.zeros((len(origins), 3))
+        normal = np.zeros((len(origins), 3))
+        depth = np.zeros(len(origins))
+
+        with self._stage('intersect'):
+            t, tri, obj = self.accelerator.intersect(origins, directions)
+        hit = tri >= 0
+
+        albedo[hit] = self.materials.color[obj[hit]]
+        N = self.accelerator.normals(tri[hit])
+        flip = np.einsum('ij,ij->i', N, directions[hit]) > 0
+        normal[hit] = np.where(flip[:, None], -N, N)
+        depth[hit] = t[hit]
+        return albedo, normal, depth
+
+    def _send_rays(self, kind, depth, origins, directions, *carried):
+        """closest intersection for a batch of rays, misses are compacted out
+
+        Args:
+            kind (str): ray kind counted in the stats, None if the caller counts them
+            depth (int): path length once these rays are traced(stats of the misses)
+            carried (np.array): per ray arrays(path index, attenuation) compacted along
+
+        Returns:
+            surface_point, surface_normal, viewer_point, object id of the hits, *carried
+        """
+        with self._stage('intersect'):
+            t, tri, obj = self.accelerator.intersect(origins, directions)
+        hit = tri >= 0
+
+        if self._stats is not None:
+            if kind is not None:
+                self._stats.count_rays(kind, len(origins))
+            self._stats.end_paths('miss', depth, len(hit) - np.count_nonzero(hit))
+
+        SP = origins[hit] + directions[hit]*t[hit, None]
+        SN = self.accelerator.normals(tri[hit])
+        return (SP, SN, origins[hit], obj[hit]) + self._compact(hit, *carried)
+
+    def _compact(self, mask, *arrays):
+        return tuple(array[mask] for array in arrays)
+
+    def _uniform(self, key, dim, n_dims=None):
+        """random numbers of the paths key = (pixels, sample, bounce), see rng.CounterRNG"""
+        return self.rng.uniform(*key, dim, n_dims)
+
+    def _stage(self, name):
+        """context timing a stage when stats are on"""
+        return NO_STAGE if self._stats is None else self._stats.stage(name)
+
+    def _end_path(self, ending, length, n=1):
+        if self._stats is not None:
+            self._stats.end_paths(ending, length, n)
+
+    def __shade_batch(self, SP, SN, VP, obj, att, key):
+        """color of the last hit of a path: emitted light or Phong illumination"""
+        I = np.zeros((len(obj), 3))
+        light = self.materials.is_light[obj]
+        I[light] = self.materials.color[obj[light]]
+
+        surface = ~light
+        if np.any(surface):
+            I[surface] = self.__illumination_batch(
+                SP[surface], SN[surface], VP[surface], obj[surface], subset(key, surface)
+            )
+
+        return att[:, None]*I
+
+    def __send_ray(self, ray, kind='primary'):
         """
         return closest intersection for the given ray
         
         Args:
             ray ([scene.ray.Ray]): Ray
+            kind (str): ray kind counted in the stats
 
         Returns:
             surface_point, surface_normal, viewer_point, surface properties
         """
-        min_distance = np.inf
-        intersection = None
+        if self._stats is not None:
+            self._stats.count_rays(kind)
 
-        for scene_obj in self.scene_objects: 
-            for obj in scene_obj.objects:
-                point = obj.intersect(ray)
-                
-                if point is not None:
-                    distance = np.linalg.norm(ray.p - point)
+        t, tri, obj_id = self.accelerator.intersect(ray.p, ray.v, ray.tmin, ray.tmax)
 
-                    if distance < min_distance:
-                        intersection = point, obj.normal, ray.p, scene_obj.properties
-                        min_distance = distance
+        if tri < 0:
+            return None
 
-        return intersection
+        point = ray.p + ray.v*t
+        return point, self.accelerator.normals(tri), ray.p, self.properties[obj_id]
 
     
-    def __illumination(self, SP, SN, VP, obj_properties):
+    def __illumination(self, SP, SN, VP, obj_properties, key):
         """returns point color(Phong Illumination)
 
         Args:
@@ -101,6 +353,7 @@ class PathTracing():
             SN (np.float): Surface Normal
             VP (np.float): Viewer Point
             obj_properties (scene.objects.Properties): Point/obj properties
+            key (tuple): (pixel, sample, bounce) of the random numbers
 
         Returns:
             [np.float]: point color
@@ -113,8 +366,8 @@ class PathTracing():
         V = VP - SP
         V = V/np.linalg.norm(V)
         
-        for light in self.lights:
-            light_point = light.get_point()
+        for k, light in enumerate(self.lights):
+            light_point = light.get_point(self._uniform(key, DIM_LIGHTS + 4*k, 4))
 
             if self.__is_shadowed(SP, light_point):
                 continue
@@ -130,24 +383,60 @@ class PathTracing():
         return ambient + diffuse + specular
 
 
+    def __illumination_batch(self, SP, SN, VP, obj, key):
+        """__illumination for (n,) surface points, key holds their (n,) pixels"""
+        m = self.materials
+        color = m.color[obj]
+        ambient = color*m.ka[obj, None]*self.ambient
+        diffuse = np.zeros_like(SP)
+        specular = np.zeros_like(SP)
+
+        # to viewer vectors
+        V = normalize(VP - SP)
+
+        for k, light in enumerate(self.lights):
+            light_point = light.get_points(len(SP), self._uniform(key, DIM_LIGHTS + 4*k, 4))
+            lit = ~self._is_shadowed_batch(SP, light_point)
+
+            with self._stage('shade'):
+                L = normalize(light_point - SP)
+                LN = np.einsum('ij,ij->i', L, SN)
+                R = normalize(2*SN*LN[:, None] - L)
+                RV = np.einsum('ij,ij->i', R, V)
+
+                diffuse += (lit*light.lp*m.kd[obj]*LN)[:, None]*color
+                specular += (lit*light.lp*m.ks[obj]*RV**m.n[obj])[:, None]
+
+        return ambient + diffuse + specular
+
+    def _is_shadowed_batch(self, surface_points, light_points):
+        """__is_shadowed for (n,) surface/light point pairs"""
+        if self._stats is not None:
+            self._stats.count_rays('shadow', len(surface_points))
+
+        with self._stage('shadow'):
+            return self.accelerator.occluded(
+                surface_points, light_points - surface_points, tmax=1.0,
+                ignore=self.materials.is_light
+            )
+
     def __is_shadowed(self, surface_point, light_point):
         """return True if there is a object between the point and the light, false otherwise"""
-        shadow_ray = Ray(surface_point, light_point - surface_point)
-        distance = np.linalg.norm(light_point - surface_point)
-
-        intersection = self.__send_ray(shadow_ray)
-        if intersection:
-            SP, _, _, obj_properties = intersection
+        # the light point sits at t = 1
+        shadow_ray = Ray(surface_point, light_point - surface_point, tmax=1.0)
+        return self.__occluded(shadow_ray)
 
-            if obj_properties.is_light:
-                return False
-            if np.linalg.norm(SP - surface_point) < distance:
-                return True
+    def __occluded(self, ray):
+        """any hit query inside [ray.tmin, ray.tmax), lights never block"""
+        if self._stats is not None:
+            self._stats.count_rays('shadow')
 
-        return False
+        return self.accelerator.occluded(
+            ray.p, ray.v, tmax=ray.tmax, tmin=ray.tmin, ignore=self.materials.is_light
+        )
 
 
-    def __secundary_ray(self, SP, SN, VP, properties):
+    def __secundary_ray(self, SP, SN, VP, properties, key):
         """return secundary ray(specular, transmission, diffuse)
 
         Args:
@@ -155,20 +444,21 @@ class PathTracing():
             SN (np.array): Surface normal
             VP (np.array): Viewer point
             properties (scene.objects.Properties): Surface properties
+            key (tuple): (pixel, sample, bounce) of the random numbers
         """
         att = None
-        rand = random.uniform(0, properties.kd + properties.ks + properties.kt)
+        rand = properties.random(self._uniform(key, DIM_LOBE))
 
         V = VP-SP
         V = V/np.linalg.norm(V)
 
         if rand < properties.kd:                  
-            direction = sampling_up_hemisphere(V, SN)
+            direction = sampling_up_hemisphere(V, SN, self._uniform(key, DIM_DIRECTION, 2))
             att = properties.kd
                 
         elif rand < properties.kd + properties.ks:     
             for light in self.lights:
-                light_point = light.get_point()
+                light_point = light.get_point(self._uniform(key, DIM_LIGHT, 4))
                 L = light_point - SP
                 L = L/np.linalg.norm(L)
                 R = 2*SN*np.dot(SN, L) - L
@@ -182,3 +472,274 @@ class PathTracing():
             att = properties.kt
 
         return Ray(SP, direction), att
+
+    def __secundary_ray_batch(self, SP, SN, VP, obj, key):
+        """__secundary_ray for (n,) surface points, returns directions and attenuations"""
+        m = self.materials
+        kd, ks, kt = m.kd[obj], m.ks[obj], m.kt[obj]
+        rand = m.random(obj, self._uniform(key, DIM_LOBE))
+
+        V = normalize(VP - SP)
+        directions = np.zeros_like(SP)
+
+        diffuse = rand < kd
+        specular = ~diffuse & (rand < kd + ks)
+        transmission = ~diffuse & ~specular
+
+        if np.any(diffuse):
+            u = self._uniform(subset(key, diffuse), DIM_DIRECTION, 2)
+            directions[diffuse] = sampling_up_hemisphere_batch(V[diffuse], SN[diffuse], u)
+
+        if np.any(specular) and self.lights:
+            # as in __secundary_ray only the last light point is kept
+            u = self._uniform(subset(key, specular), DIM_LIGHT, 4)
+            light_point = self.lights[-1].get_points(int(specular.sum()), u)
+            L = normalize(light_point - SP[specular])
+            N = SN[specular]
+            R = 2*N*np.einsum('ij,ij->i', N, L)[:, None] - L
+            directions[specular] = normalize(R)
+
+        if np.any(transmission):
+            # method expect the view vector pointing towards the surface...
+            directions[transmission] = snell_law_batch(-V[transmission], SN[transmission])
+
+        att = np.where(diffuse, kd, np.where(specular, ks, kt))
+
+        return directions, att
+
+
+class NEEPathTracing(PathTracing):
+    """path tracing with next event estimation and multiple importance sampling
+
+    Surfaces reflect with a Lambertian lobe(kd*color/pi) plus a normalized
+    Phong lobe(ks*(n + 2)/(2pi)*cos^n around the mirror direction) and refract
+    with an ideal kt lobe. At every non specular hit a point is sampled on the
+    emitters(EmitterSampler) and a direction from the BSDF, both estimates of
+    the direct light are weighted with the power heuristic. Emitters are two
+    sided and the ambient term is not used(indirect light replaces it).
+
+    Paths bounce until they miss, hit a light, reach n_reflections bounces(hard
+    max) or are killed by russian roulette: from roulette_depth on a path
+    survives with probability max(throughput)(at most ROULETTE_MAX_SURVIVAL)
+    and its throughput is divided by it, so dim paths stop early without bias.
+    """
+
+    def __init__(self, *args, roulette_depth=ROULETTE_DEPTH, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.roulette_depth = roulette_depth
+        self.emitters = EmitterSampler(self.mesh, self.materials)
+
+    def refresh(self, camera=None):
+        """emitter areas and positions may have changed"""
+        super().refresh(camera)
+        self.emitters = EmitterSampler(self.mesh, self.materials)
+
+    def path_tracing(self, ray, sample=0):
+        """1 path for a given ray(of pixel ray.pixel) in sample number sample"""
+        pixel = 0 if ray.pixel is None else ray.pixel[1]*self.camera.pixels_size[0] + ray.pixel[0]
+        return self.path_tracing_wavefront(ray.p, ray.v, [pixel], sample)[0]
+
+    def path_tracing_wavefront(self, origins, directions, pixels=None, sample=0):
+        """path_tracing for a batch of rays
+
+        Every path carries its throughput and the solid angle pdf of its last
+        BSDF sample(0 after the camera or a refraction, where MIS does not apply).
+
+        Args:
+            origins (np.array): (N, 3) ray starting points
+            directions (np.array): (N, 3) ray directions
+            pixels (np.array): (N,) pixel index of each ray, see PathTracing.path_tracing_wavefront
+            sample (int): sample(pass) number
+
+        Returns:
+            (N, 3) color of each ray
+        """
+        origins = np.asarray(origins, dtype=float).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=float).reshape(-1, 3)
+        pixels = np.arange(len(origins)) if pixels is None else np.asarray(pixels).reshape(-1)
+        I = np.zeros((len(origins), 3))
+        m = self.materials
+
+        path = np.arange(len(origins))
+        throughput = np.ones((len(origins), 3))
+        pdf = np.zeros(len(origins))
+        kind = 'primary'
+
+        for depth in range(1, self.n_reflections + 2):
+            SP, SN, VP, obj, path, throughput, pdf = self._send_rays(
+                kind, depth, origins, directions, path, throughput, pdf
+            )
+
+            light = m.is_light[obj]
+            if np.any(light):
+                with self._stage('shade'):
+                    weight = self.__emission_weight(SP[light], SN[light], VP[light], obj[light], pdf[light])
+                    I[path[light]] += throughput[light]*m.color[obj[light]]*weight[:, None]
+            self._end_path('light', depth, np.count_nonzero(light))
+            SP, SN, VP, obj, path, throughput = self._compact(~light, SP, SN, VP, obj, path, throughput)
+
+            # the last vertex takes all of its direct light from the emitter sample
+            last = depth > self.n_reflections
+            key = (pixels[path], sample, depth)
+            V = normalize(VP - SP)
+            I[path] += throughput*self.__direct_light(SP, SN, V, obj, key, mis=not last)
+            if last:
+                self._end_path('exhausted', depth, len(path))
+                break
+
+            with self._stage('sample'):
+                directions, factor, pdf, refracted = self.__sample_bsdf(SN, V, obj, key)
+            alive = np.any(factor > 0, axis=1)
+            self._end_path('surface', depth, len(alive) - np.count_nonzero(alive))
+
+            origins, directions, path, pdf, refracted = self._compact(
+                alive, SP, directions, path, pdf, refracted
+            )
+            throughput = throughput[alive]*factor[alive]
+
+            if depth >= self.roulette_depth:
+                survival = np.minimum(throughput.max(axis=1), ROULETTE_MAX_SURVIVAL)
+                alive = self._uniform((pixels[path], sample, depth), DIM_SURVIVAL) < survival
+                self._end_path('roulette', depth, len(alive) - np.count_nonzero(alive))
+                origins, directions, path, pdf, refracted, survival = self._compact(
+                    alive, origins, directions, path, pdf, refracted, survival
+                )
+                throughput = throughput[alive]/survival[:, None]
+
+            if self._stats is not None:
+                self._stats.count_rays('transmission', np.count_nonzero(refracted))
+                self._stats.count_rays('secondary', len(refracted) - np.count_nonzero(refracted))
+            kind = None
+
+        return I
+
+    def __emission_weight(self, SP, SN, VP, obj, pdf):
+        """MIS weight of emitters hit by BSDF sampled rays(1 where pdf is 0)"""
+        D = SP - VP
+        dist2 = np.einsum('ij,ij->i', D, D)
+        cos = np.abs(np.einsum('ij,ij->i', SN, D))/np.sqrt(dist2)
+        # the same point sampled through the emitters, as a solid angle density
+        light_pdf = self.emitters.pdf[obj]*dist2/np.maximum(cos, 1e-12)
+        return np.where(pdf > 0, power_heuristic(pdf, light_pdf), 1.0)
+
+    def __direct_light(self, SP, SN, V, obj, key, mis=True):
+        """one emitter sample per surface point, MIS weighted unless mis is False"""
+        I = np.zeros_like(SP)
+        m = self.materials
+        if len(self.emitters) == 0 or len(SP) == 0:
+            return I
+
+        with self._stage('sample'):
+            points, normals, light_obj = self.emitters.sample(
+                len(SP), self._uniform(key, DIM_LIGHT, 4)
+            )
+            D = points - SP
+            dist2 = np.einsum('ij,ij->i', D, D)
+            L = D/np.sqrt(dist2)[:, None]
+            N = facing(SN, V)
+            cos_surface = np.einsum('ij,ij->i', N, L)
+            cos_light = np.abs(np.einsum('ij,ij->i', normals, L))
+            glossy = m.kd[obj] + m.ks[obj] > 0
+            valid = np.flatnonzero(glossy & (cos_surface > 0) & (cos_light > 0))
+
+        lit = valid[~self._is_shadowed_batch(SP[valid], points[valid])]
+
+        with self._stage('shade'):
+            f, bsdf_pdf = self.__bsdf(N[lit], V[lit], L[lit], obj[lit])
+            light_pdf = self.emitters.pdf[light_obj[lit]]*dist2[lit]/cos_light[lit]
+            weight = power_heuristic(light_pdf, bsdf_pdf) if mis else 1.0
+            scale = cos_surface[lit]*weight/light_pdf
+            I[lit] = f*m.color[light_obj[lit]]*scale[:, None]
+
+        return I
+
+    def __bsdf(self, N, V, L, obj):
+        """reflection BSDF and the solid angle pdf __sample_bsdf draws L with
+
+        Args:
+            N (np.array): (n, 3) normals on the side of V
+            V, L (np.array): (n, 3) unit vectors to the viewer and to the light
+
+        Returns:
+            (n, 3) BSDF value, (n,) pdf
+        """
+        m = self.materials
+        kd, ks, exponent = m.kd[obj], m.ks[obj], m.n[obj]
+        total = kd + ks + m.kt[obj]
+        total = np.where(total > 0, total, 1.0)
+
+        R = 2*N*np.einsum('ij,ij->i', N, V)[:, None] - V
+        lobe = np.maximum(np.einsum('ij,ij->i', R, L), 0)**exponent
+        cos = np.maximum(np.einsum('ij,ij->i', N, L), 0)
+
+        f = (kd/np.pi)[:, None]*m.color[obj] + (ks*(exponent + 2)/(2*np.pi)*lobe)[:, None]
+        pdf = kd/total*cos/np.pi + ks/total*(exponent + 1)/(2*np.pi)*lobe
+        return f, pdf
+
+    def __sample_bsdf(self, SN, V, obj, key):
+        """pick a lobe by kd/ks/kt and sample a direction from it, key holds the
+        (n,) pixels of the paths
+
+        Returns:
+            (n, 3) directions, (n, 3) throughput factor(0 ends the path),
+            (n,) pdf(0 for refraction), (n,) True where the ray was refracted
+        """
+        m = self.materials
+        kd, ks, kt = m.kd[obj], m.ks[obj], m.kt[obj]
+        total = kd + ks + kt
+        rand = self._uniform(key, DIM_LOBE)*total
+        u = self._uniform(key, DIM_DIRECTION, 2)
+
+        N = facing(SN, V)
+        R = 2*N*np.einsum('ij,ij->i', N, V)[:, None] - V
+        diffuse = rand < kd
+        specular = ~diffuse & (rand < kd + ks)
+        refracted = ~diffuse & ~specular & (total > 0)
+
+        directions = np.zeros_like(SN)
+        if np.any(diffuse):
+            directions[diffuse] = sampling_up_hemisphere_batch(V[diffuse], N[diffuse], u[diffuse])
+        if np.any(specular):
+            directions[specular] = sampling_lobe_batch(
+                V[specular], R[specular], m.n[obj[specular]], u[specular]
+            )
+        if np.any(refracted):
+            # method expect the view vector pointing towards the surface...
+            T = snell_law_batch(-V[refracted], SN[refracted])
+            # total internal reflection
+            directions[refracted] = np.where(np.any(T != 0, axis=1)[:, None], T, R[refracted])
+
+        reflected = diffuse | specular
+        f, pdf = self.__bsdf(N, V, directions, obj)
+        cos = np.einsum('ij,ij->i', N, directions)
+        valid = reflected & (cos > 0) & (pdf > 0)
+        pdf = np.where(valid, pdf, 0.0)
+
+        factor = np.zeros_like(SN)
+        factor[valid] = f[valid]*(cos[valid]/pdf[valid])[:, None]
+        # kt over the probability kt/total of picking the lobe
+        factor[refracted] = total[refracted, None]
+        return directions, factor, pdf, refracted
+
+
+def subset(key, mask):
+    """random number key(pixels, sample, bounce) of the paths in mask"""
+    return (key[0][mask],) + tuple(key[1:])
+
+
+def facing(N, V):
+    """normals flipped to the side of V"""
+    return np.where((np.einsum('ij,ij->i', N, V) < 0)[:, None], -N, N)
+
+
+def power_heuristic(pdf, other_pdf):
+    """MIS weight of a sample drawn with pdf, other_pdf being the other strategy"""
+    pdf2 = pdf**2
+    return pdf2/np.maximum(pdf2 + other_pdf**2, 1e-300)
+
+
+# integrators selectable by name(SDL integrator directive, --integrator)
+INTEGRATORS = {
+    'phong': PathTracing,
+    'nee': NEEPathTracing,
+}
@@ -0,0 +1,114 @@
+"""
+Counter based random numbers
+
+Every random number of a render is a pure function of (seed, pixel, sample,
+bounce, dimension): the Philox4x32-10 block cipher encrypts the counter
+(pixel, sample, bounce, dimension//4) with a key made from the seed and the
+dimension picks one of the 4 output words. Numbers are generated for whole
+arrays of paths at once and do not depend on which process traces a pixel,
+on the tile order or on how many paths share a batch, so a seed gives the
+same image on any number of workers and a resumed render continues exactly
+where it stopped.
+
+Dimensions of one bounce(DIM_* below): bounce 0 is the camera, the vertex
+reached after k bounces draws its numbers with bounce k + 1.
+
+philox - Philox4x32-10 over arrays of counters
+CounterRNG - uniform numbers keyed by (pixel, sample, bounce, dimension)
+"""
+import numpy as np
+
+# Philox4x32 multipliers and Weyl key increments
+PHILOX_M = (0xD2511F53, 0xCD9E8D57)
+PHILOX_W = (0x9E3779B9, 0xBB67AE85)
+PHILOX_ROUNDS = 10
+MASK32 = np.uint64(0xFFFFFFFF)
+
+# camera: 2 dims of pixel jitter
+DIM_PIXEL = 0
+# surface vertex: BSDF lobe pick, 2 dims of direction in the lobe
+DIM_LOBE = 0
+DIM_DIRECTION = 1
+# surface vertex: transmission/russian roulette decision
+DIM_SURVIVAL = 3
+# surface vertex: 4 dims of one light/emitter point(pick, accept, 2 barycentric)
+DIM_LIGHT = 4
+# surface vertex: 4 dims for each SDL light of the Phong illumination
+DIM_LIGHTS = 8
+
+
+def philox(counters, key):
+    """Philox4x32-10 of (n, 4) uint32 counters under a (2,) uint32 key
+
+    Returns:
+        (n, 4) uint64 arrays holding 32 bit random words
+    """
+    c = [np.asarray(counters[:, i], dtype=np.uint64) for i in range(4)]
+    k0, k1 = int(key[0]), int(key[1])
+    m0, m1 = np.uint64(PHILOX_M[0]), np.uint64(PHILOX_M[1])
+
+    for _ in range(PHILOX_ROUNDS):
+        # 32x32 -> 64 bit products, uint64 never overflows here
+        p0 = m0*c[0]
+        p1 = m1*c[2]
+        c = [
+            (p1 >> np.uint64(32)) ^ c[1] ^ np.uint64(k0),
+            p1 & MASK32,
+            (p0 >> np.uint64(32)) ^ c[3] ^ np.uint64(k1),
+            p0 & MASK32,
+        ]
+        k0 = (k0 + PHILOX_W[0]) & 0xFFFFFFFF
+        k1 = (k1 + PHILOX_W[1]) & 0xFFFFFFFF
+
+    return np.stack(c, axis=1)
+
+
+class CounterRNG():
+    """stateless uniform random numbers of a seed
+
+    Args:
+        seed (int): any non negative integer(SDL seed), its low 64 bits are the key
+    """
+
+    def __init__(self, seed=0):
+        self.seed = int(seed)
+        self.key = np.array(
+            [self.seed & 0xFFFFFFFF, (self.seed >> 32) & 0xFFFFFFFF], dtype=np.uint64
+        )
+
+    def uniform(self, pixel, sample, bounce, dim, n_dims=None):
+        """uniform numbers in [0, 1)
+
+        Args:
+            pixel (np.array): (n,) pixel indices(row*w + column), or a scalar
+            sample (int or np.array): sample(pass) number
+            bounce (int or np.array): 0 for the camera, k + 1 after k bounces
+            dim (int): first dimension
+            n_dims (int): consecutive dimensions dim, dim + 1, ..., None for one
+
+        Returns:
+            (n,) for one dimension, (n, n_dims) otherwise, scalars for a scalar pixel
+        """
+        pixel = np.asarray(pixel)
+        single = pixel.ndim == 0
+        pixel = np.atleast_1d(pixel).astype(np.uint64)
+        n = len(pixel)
+        sample = np.broadcast_to(np.asarray(sample, dtype=np.uint64), (n,))
+        bounce = np.broadcast_to(np.asarray(bounce, dtype=np.uint64), (n,))
+
+        dims = range(dim, dim + (1 if n_dims is None else n_dims))
+        out = np.empty((n, len(dims)))
+        blocks = {}
+        for j, d in enumerate(dims):
+            block = d//4
+            if block not in blocks:
+                counters = np.stack(
+                    (pixel, sample, bounce, np.full(n, block, dtype=np.uint64)), axis=1
+                )
+                blocks[block] = philox(counters, self.key)
+            # 32 random bits -> [0, 1)
+            out[:, j] = blocks[block][:, d % 4]*2.0**-32
+
+        if n_dims is None:
+            out = out[:, 0]
+        return out[0] if single else out
@@ -0,0 +1,245 @@
+"""
+Low discrepancy samplers
+
+Drop-in replacements of rng.CounterRNG: uniform(pixel, sample, bounce, dim,
+n_dims) is still a pure function of the seed and its arguments, so images
+stay reproducible on any number of workers, but the samples of a pixel are
+stratified over the passes instead of independent, which lowers the error at
+a given number of passes(most with power of two pass counts for sobol).
+
+Pixels, bounces and dimensions are decorrelated with hashed scrambles of the
+same low discrepancy sequence. Dimensions past the ones a sampler covers fall
+back to the counter generator.
+
+SobolSampler - 2D Sobol points for every group of dimensions drawn together
+HaltonSampler - scrambled Halton sequence, one prime base per dimension
+SAMPLERS - sampler name -> class
+"""
+import numpy as np
+
+from rng import CounterRNG
+
+MASK32 = np.uint64(0xFFFFFFFF)
+# HaltonSampler: camera dimensions, dimensions per bounce and bounces with their
+# own prime bases(a vertex draws DIM_LIGHTS + 4 dimensions per SDL light)
+HALTON_CAMERA_DIMS = 2
+HALTON_DIMS_PER_BOUNCE = 12
+HALTON_BOUNCES = 4
+
+
+def hash32(*values):
+    """(n,) 32 bit hashes of integers or integer arrays(murmur3 finalizer chain)"""
+    h = np.uint64(0x9E3779B9)
+    for value in values:
+        h = mix32(h ^ (np.asarray(value, dtype=np.uint64) & MASK32))
+    return h
+
+
+def mix32(h):
+    """murmur3 fmix32 of uint64 arrays holding 32 bit values"""
+    h = h ^ (h >> np.uint64(16))
+    h = (h*np.uint64(0x85EBCA6B)) & MASK32
+    h = h ^ (h >> np.uint64(13))
+    h = (h*np.uint64(0xC2B2AE35)) & MASK32
+    return h ^ (h >> np.uint64(16))
+
+
+def reverse_bits32(x):
+    """bit reversal of uint64 arrays holding 32 bit values"""
+    for shift, mask in ((1, 0x55555555), (2, 0x33333333), (4, 0x0F0F0F0F), (8, 0x00FF00FF)):
+        s, m = np.uint64(shift), np.uint64(mask)
+        x = ((x >> s) & m) | ((x & m) << s)
+    return ((x >> np.uint64(16)) | (x << np.uint64(16))) & MASK32
+
+
+def owen_scramble(v, seed):
+    """nested uniform(Owen) scramble of 32 bit fractions v, Laine-Karras style hash
+
+    The scramble only depends on higher bits, so it keeps the stratification
+    of the points.
+    """
+    v = reverse_bits32(v)
+    v = v ^ ((v*np.uint64(0x3D20ADEA)) & MASK32)
+    v = (v + seed) & MASK32
+    v = (v*((seed >> np.uint64(16)) | np.uint64(1))) & MASK32
+    v = v ^ ((v*np.uint64(0x05526C56)) & MASK32)
+    v = v ^ ((v*np.uint64(0x53A22864)) & MASK32)
+    return reverse_bits32(v)
+
+
+def sobol_tables():
+    """(4, 256) xor of the second Sobol dimension direction numbers selected by
+    every byte of the index"""
+    # direction numbers of x + 1: v(k + 1) = v(k) ^ v(k) >> 1
+    directions = [1 << 31]
+    for _ in range(31):
+        directions.append(directions[-1] ^ (directions[-1] >> 1))
+
+    tables = np.zeros((4, 256), dtype=np.uint64)
+    for byte in range(4):
+        for value in range(256):
+            for bit in range(8):
+                if value >> bit & 1:
+                    tables[byte, value] ^= np.uint64(directions[8*byte + bit])
+    return tables
+
+
+SOBOL_TABLES = sobol_tables()
+
+
+def sobol_2d(index):
+    """first two Sobol dimensions of uint64 indices(below 2^32), as 32 bit fractions"""
+    y = np.zeros_like(index)
+    for byte in range(4):
+        y ^= SOBOL_TABLES[byte][(index >> np.uint64(8*byte)) & np.uint64(0xFF)]
+    return reverse_bits32(index), y
+
+
+def primes(n):
+    """first n primes"""
+    found = []
+    candidate = 2
+    while len(found) < n:
+        if all(candidate % p for p in found if p*p <= candidate):
+            found.append(candidate)
+        candidate += 1
+    return found
+
+
+class SobolSampler():
+    """padded 2D Sobol sampler
+
+    The dimensions of one uniform call are paired((dim, dim + 1), (dim + 2,
+    dim + 3), ...) and every pair is a 2D Sobol (0, 2)-sequence, Owen
+    scrambled per (seed, pixel, bounce, dimension) and visited in a hashed
+    order(an xor of the sample index, so every 2^k first samples are still a
+    net). The pixel jitter, a BSDF direction or a light point are thus
+    stratified 2D samples.
+
+    Args:
+        seed (int): any non negative integer(SDL seed)
+    """
+
+    def __init__(self, seed=0):
+        self.seed = int(seed)
+        self.key = hash32(self.seed & 0xFFFFFFFF, self.seed >> 32)
+
+    def uniform(self, pixel, sample, bounce, dim, n_dims=None):
+        """uniform numbers in [0, 1), see rng.CounterRNG.uniform"""
+        pixel = np.asarray(pixel)
+        single = pixel.ndim == 0
+        pixel = np.atleast_1d(pixel).astype(np.uint64)
+        n = len(pixel)
+        sample = np.broadcast_to(np.asarray(sample, dtype=np.uint64), (n,))
+
+        count = 1 if n_dims is None else n_dims
+        out = np.empty((n, count))
+        for j in range(0, count, 2):
+            scramble = hash32(self.key, pixel, bounce, dim + j)
+            index = (sample ^ hash32(scramble, 0x51ED270B)) & MASK32
+            x, y = sobol_2d(index)
+            out[:, j] = owen_scramble(x, hash32(scramble, 1))*2.0**-32
+            if j + 1 < count:
+                out[:, j + 1] = owen_scramble(y, hash32(scramble, 2))*2.0**-32
+
+        if n_dims is None:
+            out = out[:, 0]
+        return out[0] if single else out
+
+
+class HaltonSampler():
+    """scrambled Halton sampler
+
+    Every (bounce, dimension) has its own prime base, the camera gets the
+    smallest ones, then the first bounces. A dimension is the radical inverse
+    of the sample number with the digits permuted(one random permutation per
+    dimension and digit, which breaks the correlation of large bases) and then
+    shifted by the digits of a hash of (seed, pixel, dimension) to decorrelate
+    the pixels. Dimensions past HALTON_CAMERA_DIMS/HALTON_DIMS_PER_BOUNCE or
+    bounces past HALTON_BOUNCES come from the counter generator.
+
+    Args:
+        seed (int): any non negative integer(SDL seed)
+    """
+
+    BASES = primes(HALTON_CAMERA_DIMS + HALTON_DIMS_PER_BOUNCE*HALTON_BOUNCES)
+
+    def __init__(self, seed=0):
+        self.seed = int(seed)
+        self.key = hash32(self.seed & 0xFFFFFFFF, self.seed >> 32)
+        self.random = CounterRNG(seed)
+        # base index -> digit permutations, made on first use
+        self.permutations = {}
+
+    def uniform(self, pixel, sample, bounce, dim, n_dims=None):
+        """uniform numbers in [0, 1), see rng.CounterRNG.uniform"""
+        pixel = np.asarray(pixel)
+        single = pixel.ndim == 0
+        pixel = np.atleast_1d(pixel).astype(np.uint64)
+        n = len(pixel)
+        sample = np.broadcast_to(np.asarray(sample, dtype=np.int64), (n,))
+        bounce = np.broadcast_to(np.asarray(bounce, dtype=np.int64), (n,))
+
+        count = 1 if n_dims is None else n_dims
+        out = np.empty((n, count))
+        for j in range(count):
+            d = dim + j
+            # base index of every path, -1 past the covered dimensions
+            g = np.where(
+                bounce == 0,
+                np.where(d < HALTON_CAMERA_DIMS, d, -1),
+                HALTON_CAMERA_DIMS + (bounce - 1)*HALTON_DIMS_PER_BOUNCE + d
+            )
+            g[(d >= HALTON_DIMS_PER_BOUNCE) | (bounce > HALTON_BOUNCES)] = -1
+
+            covered = g >= 0
+            if not np.all(covered):
+                out[~covered, j] = self.random.uniform(
+                    pixel[~covered], sample[~covered], bounce[~covered], d
+                )
+            if np.any(covered):
+                out[covered, j] = self.__radical_inverse(
+                    pixel[covered], sample[covered], g[covered]
+                )
+
+        if n_dims is None:
+            out = out[:, 0]
+        return out[0] if single else out
+
+    def __radical_inverse(self, pixel, sample, dims):
+        """scrambled radical inverse of sample in the base of every base index"""
+        out = np.empty(len(pixel))
+        for g in np.unique(dims):
+            rows = np.flatnonzero(dims == g)
+            base = self.BASES[g]
+            permutations = self.__permutations(g)
+            # the base digits of a 32 bit hash shift the digits of a pixel
+            shifts = hash32(self.key, pixel[rows], g).astype(np.int64)
+            index = sample[rows].copy()
+            value = np.zeros(len(rows))
+            scale = 1.0
+            # every digit down to 2^-32, zeros included, is scrambled
+            for permutation in permutations:
+                scale /= base
+                value += ((permutation[index % base] + shifts % base) % base)*scale
+                index //= base
+                shifts //= base
+            out[rows] = np.minimum(value, 1 - 2.0**-53)
+        return out
+
+    def __permutations(self, g):
+        """random permutations of the digits of base index g, one per digit position"""
+        if g not in self.permutations:
+            base = self.BASES[g]
+            generator = np.random.default_rng([self.seed, int(g)])
+            digits = int(np.ceil(32*np.log(2)/np.log(base)))
+            self.permutations[g] = [generator.permutation(base) for _ in range(digits)]
+        return self.permutations[g]
+
+
+# samplers selectable by name(SDL sampler directive, --sampler)
+SAMPLERS = {
+    'random': CounterRNG,
+    'sobol': SobolSampler,
+    'halton': HaltonSampler,
+}
@@ -0,0 +1,122 @@
+"""
+Keyframed animation
+
+A SDL scene may describe frames: camera keys(eye, target, up) and 4x4
+transform keys of objects, lights and instances. Values between two keys are
+linearly interpolated(transforms component by component, so rotations should
+be keyed densely), before the first key and after the last one they hold.
+
+Object transforms apply to the triangles as the OBJ files place them, instance
+keys replace the transform of the SDL instance line. A frame only moves
+geometry and refits the acceleration data, nothing is parsed or rebuilt.
+
+Animation - camera and geometry of every frame of a scene
+interpolate - value of a key list at some frame
+transform_points - points through a 4x4 transform
+"""
+import numpy as np
+
+from scene.camera import Camera
+
+
+class Animation():
+    """camera and transforms of frames 0, ..., frames - 1
+
+    Args:
+        frames (int): number of frames
+        camera (scene.camera.Camera): camera of the frames without camera keys
+        camera_keys (list): (frame, eye, target, up) sorted by frame
+        object_keys (dict): object id(materials index) -> (frame, (4, 4)) keys
+        instance_keys (dict): instance index -> (frame, (4, 4)) keys
+        n_objects (int): number of SDL objects, the lights follow them
+    """
+
+    def __init__(self, frames, camera, camera_keys, object_keys, instance_keys, n_objects):
+        self.frames = frames
+        self.base_camera = camera
+        self.camera_keys = sorted(camera_keys, key=lambda key: key[0])
+        self.object_keys = {
+            obj: sorted(keys, key=lambda key: key[0]) for obj, keys in object_keys.items()
+        }
+        self.instance_keys = {
+            inst: sorted(keys, key=lambda key: key[0]) for inst, keys in instance_keys.items()
+        }
+        self.n_objects = n_objects
+        # object id -> triangle ids and (n, 3) vertices as loaded, set by the first apply
+        self.__rest = None
+
+    def __len__(self):
+        return self.frames
+
+    def is_static(self):
+        """True if no object, light or instance moves"""
+        return not self.object_keys and not self.instance_keys
+
+    def camera(self, frame):
+        """scene.camera.Camera of frame"""
+        if not self.camera_keys:
+            return self.base_camera
+        base = self.base_camera
+        eye, target, up = (
+            interpolate([(key[0], np.array(key[i])) for key in self.camera_keys], frame)
+            for i in (1, 2, 3)
+        )
+        return Camera(eye, target, up, base.window_size, base.pixels_size)
+
+    def apply(self, scene, frame):
+        """move the geometry of a readers.cache.CompiledScene to frame and refit it
+
+        The mesh, lights and instances are changed in place, so every PathTracing
+        over the scene sees the new frame(call their refresh method). The rest
+        pose is taken from the scene on the first call: one scene per Animation.
+        """
+        if self.is_static():
+            return
+        if self.__rest is None:
+            self.__rest = self.__rest_pose(scene)
+
+        mesh = scene.mesh
+        for obj, keys in self.object_keys.items():
+            M = interpolate(keys, frame)
+            tris, rest = self.__rest[obj]
+            mesh.move(tris, *(transform_points(M, p) for p in rest))
+
+            if obj >= self.n_objects:
+                # the Phong integrator samples the Light triangles
+                light = scene.lights[obj - self.n_objects]
+                light.p1, light.p2, light.p3 = (transform_points(M, p) for p in rest)
+
+        for inst, keys in self.instance_keys.items():
+            scene.instances.move(inst, interpolate(keys, frame))
+
+        if self.object_keys:
+            scene.bvh.refit()
+        if self.instance_keys:
+            scene.instances.refit()
+
+    def __rest_pose(self, scene):
+        """object id -> (triangle ids, (p1, p2, p3) copies) of the keyed objects"""
+        mesh = scene.mesh
+        rest = {}
+        for obj in self.object_keys:
+            tris = np.flatnonzero(mesh.object_id == obj)
+            rest[obj] = tris, tuple(np.array(p[tris]) for p in (mesh.p1, mesh.p2, mesh.p3))
+        return rest
+
+
+def interpolate(keys, frame):
+    """linear interpolation of (frame, value) keys sorted by frame, held outside them"""
+    frames = [key[0] for key in keys]
+    i = np.searchsorted(frames, frame, side='right')
+    if i == 0:
+        return np.asarray(keys[0][1], dtype=float)
+    if i == len(keys):
+        return np.asarray(keys[-1][1], dtype=float)
+    (f0, v0), (f1, v1) = keys[i - 1], keys[i]
+    s = (frame - f0)/(f1 - f0)
+    return (1 - s)*np.asarray(v0, dtype=float) + s*np.asarray(v1, dtype=float)
+
+
+def transform_points(M, points):
+    """(n, 3) points through the (4, 4) transform M"""
+    return points @ M[:3, :3].T + M[:3, 3]
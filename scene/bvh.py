@@ -0,0 +1,337 @@
+"""
+Bounding Volume Hierarchy
+
+BVH - binned SAH hierarchy over a scene.mesh.TriangleMesh, stored as flat
+      node arrays, traversed by the kernels closest hit and any hit
+build_nodes - the node arrays of a hierarchy over any list of boxes
+refit_nodes - the node boxes of an existing hierarchy over moved boxes
+"""
+import numpy as np
+
+import kernels
+from scene.mesh import EPSILON, as_interval, as_rays, hit_result
+
+# number of centroid bins tested per axis
+N_BINS = 16
+# nodes with up to MIN_LEAF_SIZE triangles are never split
+MIN_LEAF_SIZE = 4
+# leaves never hold more than MAX_LEAF_SIZE triangles
+MAX_LEAF_SIZE = 8
+# relative cost of one node traversal against one triangle test
+TRAVERSAL_COST = 1.0
+# arrays that fully describe a built BVH, see BVH.arrays
+NODE_ARRAYS = ('lower', 'upper', 'left', 'right', 'start', 'count', 'axis', 'order')
+
+
+class BVH():
+    """flattened BVH over a TriangleMesh
+
+    Node i covers the box lower[i]/upper[i]. Interior nodes have count[i] == 0
+    and children left[i]/right[i], split along axis[i]. Leaves hold the
+    triangles order[start[i]:start[i] + count[i]] of the mesh.
+
+    Args:
+        mesh (scene.mesh.TriangleMesh): triangles to be indexed
+    """
+
+    def __init__(self, mesh):
+        self.mesh = mesh
+        self.object_id = mesh.object_id
+        # stats.RenderStats counting node visits and triangle tests, None when off
+        self.stats = None
+        self.__depth = None
+        self.__build()
+        self.__sort_triangles()
+
+    @classmethod
+    def from_arrays(cls, mesh, arrays):
+        """BVH over mesh from the arrays of BVH.arrays, nothing is rebuilt
+
+        A mesh already sorted in leaf order(order is 0, 1, ...) is used without copies.
+        """
+        bvh = cls.__new__(cls)
+        bvh.mesh = mesh
+        bvh.object_id = mesh.object_id
+        bvh.stats = None
+        bvh.__depth = None
+        for name in NODE_ARRAYS:
+            setattr(bvh, name, arrays[name])
+        bvh.__sort_triangles()
+        return bvh
+
+    def arrays(self):
+        """name -> node array"""
+        return {name: getattr(self, name) for name in NODE_ARRAYS}
+
+    def __len__(self):
+        return len(self.lower)
+
+    def intersect(self, origins, directions, tmin=EPSILON, tmax=np.inf):
+        """closest hit, same signature and result as TriangleMesh.intersect"""
+        origins, directions, single = as_rays(origins, directions)
+        n = len(origins)
+        tmin, tmax = as_interval(tmin, tmax, n)
+
+        t = np.full(n, np.inf)
+        prim = np.full(n, -1, dtype=np.int64)
+
+        if len(self.order) > 0:
+            t, prim, visits, tests = kernels.bvh_closest_hit(self, origins, directions, tmin, tmax)
+            if self.stats is not None:
+                self.stats.node_visits += visits
+                self.stats.triangle_tests += tests
+
+        tri = np.full(n, -1, dtype=np.int64)
+        tri[prim >= 0] = self.order[prim[prim >= 0]]
+        return hit_result(t, tri, self.object_id, single)
+
+    def occluded(self, origins, directions, tmax=1.0, tmin=EPSILON, ignore=None):
+        """any hit, same signature and result as TriangleMesh.occluded
+
+        Rays leave the traversal as soon as one blocking triangle is found.
+        """
+        origins, directions, single = as_rays(origins, directions)
+        n = len(origins)
+        tmin, tmax = as_interval(tmin, tmax, n)
+        blockers = self.__blockers(ignore)
+
+        blocked = np.zeros(n, dtype=bool)
+
+        if len(self.order) > 0:
+            blocked, visits, tests = kernels.bvh_any_hit(
+                self, origins, directions, tmin, tmax, blockers
+            )
+            if self.stats is not None:
+                self.stats.node_visits += visits
+                self.stats.triangle_tests += tests
+
+        return blocked[0] if single else blocked
+
+    def normals(self, tri):
+        """unit normals of the triangle ids returned by intersect"""
+        return self.mesh.normal[tri]
+
+    def refit(self):
+        """recompute the node boxes after the mesh triangles moved
+
+        The tree is kept as it is, only the boxes follow the triangles, so it is
+        much cheaper than a build but traversal gets slower as the motion grows.
+        """
+        mesh = self.mesh
+        tri_lower = np.minimum(np.minimum(mesh.p1, mesh.p2), mesh.p3)
+        tri_upper = np.maximum(np.maximum(mesh.p1, mesh.p2), mesh.p3)
+        self.lower, self.upper = refit_nodes(self.arrays(), tri_lower, tri_upper)
+        self.__sort_triangles()
+
+    def __sort_triangles(self):
+        """leaf triangles stored contiguously in traversal order"""
+        if np.array_equal(self.order, np.arange(len(self.order))):
+            self.p1, self.edge1, self.edge2 = self.mesh.p1, self.mesh.edge1, self.mesh.edge2
+            self.leaf_object_id = self.object_id
+        else:
+            self.p1 = self.mesh.p1[self.order]
+            self.edge1 = self.mesh.edge1[self.order]
+            self.edge2 = self.mesh.edge2[self.order]
+            self.leaf_object_id = self.object_id[self.order]
+        self.__blocker_cache = {}
+
+    def __blockers(self, ignore):
+        """(leaf triangles,) bool, the ones that can block a ray, cached per ignore mask"""
+        if ignore is None:
+            return None
+
+        key = np.asarray(ignore, dtype=bool).tobytes()
+        if key not in self.__blocker_cache:
+            self.__blocker_cache[key] = ~np.asarray(ignore, dtype=bool)[self.leaf_object_id]
+        return self.__blocker_cache[key]
+
+    @property
+    def depth(self):
+        """number of levels below the root"""
+        if self.__depth is None:
+            depth, level = 0, np.array([0])
+            while True:
+                interior = level[self.count[level] == 0]
+                if len(interior) == 0:
+                    break
+                level = np.concatenate((self.left[interior], self.right[interior]))
+                depth += 1
+            self.__depth = depth
+        return self.__depth
+
+    def __build(self):
+        """top down binned SAH build over the triangle bounds"""
+        mesh = self.mesh
+        tri_lower = np.minimum(np.minimum(mesh.p1, mesh.p2), mesh.p3)
+        tri_upper = np.maximum(np.maximum(mesh.p1, mesh.p2), mesh.p3)
+        for name, array in build_nodes(tri_lower, tri_upper).items():
+            setattr(self, name, array)
+
+
+def build_nodes(tri_lower, tri_upper):
+    """top down binned SAH build over (n, 3) primitive bounds
+
+    Returns:
+        name -> node array of every NODE_ARRAYS name
+    """
+    centroids = (tri_lower + tri_upper)/2
+
+    order = np.arange(len(tri_lower), dtype=np.int64)
+    lower, upper = [], []
+    left, right, start, count, axis = [], [], [], [], []
+
+    def new_node():
+        for values in (left, right, start, count, axis):
+            values.append(0)
+        lower.append(np.zeros(3))
+        upper.append(np.zeros(3))
+        return len(left) - 1
+
+    if len(order) > 0:
+        stack = [(new_node(), 0, len(order))]
+    else:
+        stack = []
+
+    while stack:
+        node, first, last = stack.pop()
+        idx = order[first:last]
+        lower[node] = tri_lower[idx].min(axis=0)
+        upper[node] = tri_upper[idx].max(axis=0)
+
+        split = binned_sah(centroids[idx], tri_lower[idx], tri_upper[idx])
+        n = last - first
+
+        if split is None and n <= MAX_LEAF_SIZE:
+            start[node], count[node] = first, n
+            continue
+
+        if split is not None:
+            split_axis, mask = split
+            middle = first + int(mask.sum())
+            order[first:last] = np.concatenate((idx[mask], idx[~mask]))
+        else:
+            # SAH found nothing better but the leaf is too big: median split
+            extent = centroids[idx].max(axis=0) - centroids[idx].min(axis=0)
+            split_axis = int(np.argmax(extent))
+            order[first:last] = idx[np.argsort(centroids[idx, split_axis], kind='stable')]
+            middle = first + n//2
+
+        axis[node] = split_axis
+        left[node] = new_node()
+        right[node] = new_node()
+        stack.append((right[node], middle, last))
+        stack.append((left[node], first, middle))
+
+    return {
+        'lower': np.array(lower, dtype=float).reshape(-1, 3),
+        'upper': np.array(upper, dtype=float).reshape(-1, 3),
+        'left': np.array(left, dtype=np.int64),
+        'right': np.array(right, dtype=np.int64),
+        'start': np.array(start, dtype=np.int64),
+        'count': np.array(count, dtype=np.int64),
+        'axis': np.array(axis, dtype=np.int64),
+        'order': order,
+    }
+
+
+def refit_nodes(nodes, prim_lower, prim_upper):
+    """node boxes of the hierarchy nodes(build_nodes arrays) over moved primitive bounds
+
+    Leaves reduce their primitives at once, then interior nodes are merged one
+    level at a time from the deepest one up.
+
+    Returns:
+        (nodes, 3) lower and upper corners
+    """
+    lower = np.empty_like(nodes['lower'], dtype=float)
+    upper = np.empty_like(nodes['upper'], dtype=float)
+    count, left, right = nodes['count'], nodes['left'], nodes['right']
+    if len(count) == 0:
+        return lower, upper
+
+    # leaves cover order contiguously, sorted by start they split it in segments
+    leaves = np.flatnonzero(count > 0)
+    leaves = leaves[np.argsort(nodes['start'][leaves])]
+    order = nodes['order']
+    lower[leaves] = np.minimum.reduceat(prim_lower[order], nodes['start'][leaves], axis=0)
+    upper[leaves] = np.maximum.reduceat(prim_upper[order], nodes['start'][leaves], axis=0)
+
+    levels, level = [], np.array([0])
+    while len(level) > 0:
+        level = level[count[level] == 0]
+        levels.append(level)
+        level = np.concatenate((left[level], right[level]))
+
+    for level in reversed(levels):
+        lower[level] = np.minimum(lower[left[level]], lower[right[level]])
+        upper[level] = np.maximum(upper[left[level]], upper[right[level]])
+
+    return lower, upper
+
+
+def binned_sah(centroids, tri_lower, tri_upper):
+    """return the cheapest split as (axis, left side mask) or None if a leaf is cheaper
+
+    The three axes are binned at once: bin b of axis a has the key a*N_BINS + b.
+    """
+    n = len(centroids)
+    if n <= MIN_LEAF_SIZE:
+        return None
+
+    parent_area = surface_area(tri_lower.min(axis=0), tri_upper.max(axis=0))
+    if parent_area <= 0:
+        return None
+
+    c_min = centroids.min(axis=0)
+    extent = centroids.max(axis=0) - c_min
+    scale = np.where(extent > 0, N_BINS/np.where(extent > 0, extent, 1), 0)
+
+    bins = ((centroids - c_min)*scale).astype(np.int64)
+    bins = np.minimum(bins, N_BINS - 1)
+    keys = (bins + np.arange(3)*N_BINS).T.ravel()
+
+    bin_count = np.bincount(keys, minlength=3*N_BINS)
+    bin_lower = np.full((3*N_BINS, 3), np.inf)
+    bin_upper = np.full((3*N_BINS, 3), -np.inf)
+
+    # per bin bounds, reduceat over the triangles sorted by key
+    sort = np.argsort(keys, kind='stable') % n
+    filled = np.flatnonzero(bin_count)
+    offsets = np.concatenate(([0], np.cumsum(bin_count)[:-1]))[filled]
+    bin_lower[filled] = np.minimum.reduceat(tri_lower[sort], offsets, axis=0)
+    bin_upper[filled] = np.maximum.reduceat(tri_upper[sort], offsets, axis=0)
+
+    bin_count = bin_count.reshape(3, N_BINS)
+    bin_lower = bin_lower.reshape(3, N_BINS, 3)
+    bin_upper = bin_upper.reshape(3, N_BINS, 3)
+
+    # sweep: left side takes bins [0, i], right side bins (i, N_BINS)
+    left_count = np.cumsum(bin_count, axis=1)[:, :-1]
+    right_count = n - left_count
+    left_area = surface_area(
+        np.minimum.accumulate(bin_lower, axis=1)[:, :-1],
+        np.maximum.accumulate(bin_upper, axis=1)[:, :-1]
+    )
+    right_area = surface_area(
+        np.minimum.accumulate(bin_lower[:, ::-1], axis=1)[:, ::-1][:, 1:],
+        np.maximum.accumulate(bin_upper[:, ::-1], axis=1)[:, ::-1][:, 1:]
+    )
+
+    valid = (left_count > 0) & (right_count > 0) & (extent > 0)[:, None]
+    if not np.any(valid):
+        return None
+
+    cost = TRAVERSAL_COST + (left_area*left_count + right_area*right_count)/parent_area
+    cost = np.where(valid, cost, np.inf)
+
+    split_axis, i = np.unravel_index(np.argmin(cost), cost.shape)
+    if cost[split_axis, i] >= n:
+        return None
+
+    return int(split_axis), bins[:, split_axis] <= i
+
+
+def surface_area(lower, upper):
+    """surface area of (..., 3) boxes, 0 for empty boxes"""
+    d = np.maximum(upper - lower, 0)
+    return 2*(d[..., 0]*d[..., 1] + d[..., 1]*d[..., 2] + d[..., 2]*d[..., 0])
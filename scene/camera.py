@@ -2,6 +2,7 @@ from typing import List
 
 import random
 import numpy as np
+from rng import DIM_PIXEL
 from scene.ray import Ray
 
 class Camera():
@@ -33,12 +34,51 @@ class Camera():
 
         self.d = np.linalg.norm(self._target - self._eye)
 
-    def get_rays(self):
-        """return a list of initial rays from the camera starting point"""
+    def get_rays(self, rng=None, sample=0, tile=None, mask=None):
+        """return a list of initial rays from the camera starting point, jittered
+        as generate_rays does(only the pixels of tile, set in mask, when given)"""
         rays = []
+        batches = self.generate_rays(tile=tile, mask=mask, rng=rng, sample=sample)
+        for origins, directions, pixels in batches:
+            for p, v, pixel in zip(origins, directions, pixels):
+                i, j = pixel % self.pixels_size[0], pixel//self.pixels_size[0]
+                rays.append(
+                    Ray(p=p, v=v, pixel=(i, j))
+                )
+
+        return rays
+
+    def generate_rays(
+            self, tile=None, chunk_size=None, jitter=True, mask=None, rng=None, sample=0,
+            stride=1
+        ):
+        """yield initial rays as arrays, chunk by chunk
+
+        Without rng every call draws a new jitter, so call it once per pass.
+        With a rng.CounterRNG the jitter of a pixel depends only on the pixel
+        and the sample number.
+
+        A stride above 1 traces one ray per stride x stride block of the tile
+        (coarse preview passes): through the block center, jittered over the
+        block and keyed by its top left pixel.
 
+        Args:
+            tile (tuple): (x0, y0, x1, y1) pixel rectangle to cover, the whole image by default
+            chunk_size (int): max rays per chunk(whole rows of the tile), everything at once by default
+            jitter (bool): random offset inside the pixel
+            mask (np.array): (y1 - y0, x1 - x0) bool over the tile, only pixels set in
+                the mask get a ray
+            rng (rng.CounterRNG): jitter source, np.random when None
+            sample (int): sample(pass) number of the jitter drawn from rng
+            stride (int): block size in pixels, 1 traces every pixel
+
+        Yields:
+            origins (n, 3), normalized directions (n, 3) and pixel index row*w + column (n,)
+            (of the block top left pixels)
+        """
         w = self.pixels_size[0]
         h = self.pixels_size[1]
+        x0, y0, x1, y1 = tile if tile is not None else (0, 0, w, h)
 
         gx = self.window_size[0]/2
         gy = self.window_size[1]/2
@@ -48,16 +88,42 @@ class Camera():
 
         p11 = self._eye + self.t*self.d + gx*self.b + gy*self.v
 
-        for i in range(w):
-            for j in range(h):
-                p = p11 - qx*i - qy*j + self.noise(qx, qy, gx/w, gy/h) # random part
-                r = p - self._eye 
-                R = r/np.linalg.norm(r)
-                rays.append(
-                    Ray(p=self._eye, v=R, pixel=(i, j))
-                )
+        tile_w = -(-(x1 - x0)//stride)
+        rows_per_chunk = y1 - y0 if chunk_size is None else max(1, chunk_size//max(tile_w, 1))
+        # whole blocks per chunk
+        rows_per_chunk = -(-rows_per_chunk//stride)*stride
 
-        return rays
+        for row in range(y0, y1, rows_per_chunk):
+            j, i = np.mgrid[row:min(row + rows_per_chunk, y1):stride, x0:x1:stride]
+            i, j = i.reshape(-1), j.reshape(-1)
+            if mask is not None:
+                keep = mask[j - y0, i - x0]
+                i, j = i[keep], j[keep]
+                if len(i) == 0:
+                    continue
+
+            # centers of the blocks, cut by the tile border
+            ci = i + (np.minimum(stride, x1 - i) - 1)/2
+            cj = j + (np.minimum(stride, y1 - j) - 1)/2
+            p = p11 - np.outer(ci, qx) - np.outer(cj, qy)
+            if jitter:
+                u = None if rng is None else rng.uniform(j*w + i, sample, 0, DIM_PIXEL, 2)
+                p += self.noise_batch(qx, qy, stride*gx/w, stride*gy/h, len(i), u)  # random part
+
+            r = p - self._eye
+            R = r/np.linalg.norm(r, axis=1, keepdims=True)
+            origins = np.tile(self._eye, (len(i), 1))
+
+            yield origins, R, j*w + i
+
+    def noise(self, qx, qy, x, y, u=None):
+        """u is a pair of uniform numbers, drawn here when None"""
+        if u is None:
+            return qx*random.uniform(-x, x) + qy*random.uniform(-y, y)
+        return qx*(x*(2*u[0] - 1)) + qy*(y*(2*u[1] - 1))
 
-    def noise(self, qx, qy, x, y):
-        return qx*random.uniform(-x, x) + qy*random.uniform(-y, y) 
\ No newline at end of file
+    def noise_batch(self, qx, qy, x, y, n, u=None):
+        """noise for n pixels, (n, 3) array, u is (n, 2) uniform numbers or None"""
+        if u is None:
+            u = np.random.uniform(0, 1, (n, 2))
+        return np.outer(x*(2*u[:, 0] - 1), qx) + np.outer(y*(2*u[:, 1] - 1), qy)
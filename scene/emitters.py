@@ -0,0 +1,109 @@
+"""
+Emitter sampling
+
+AliasTable - O(1) sampling of a discrete distribution(Vose's alias method)
+EmitterSampler - points on the emissive triangles of a mesh, area/power weighted
+"""
+import numpy as np
+
+from film import luminance
+
+
+class AliasTable():
+    """draw indices i with probability weights[i]/sum(weights)
+
+    Args:
+        weights (np.array): (n,) non negative weights, not all zero
+    """
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=float)
+        n = len(weights)
+        self.probability = weights/weights.sum()
+
+        # every cell holds its own index with prob[i], the alias otherwise
+        scaled = self.probability*n
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+        small = [i for i in range(n) if scaled[i] < 1]
+        large = [i for i in range(n) if scaled[i] >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+        # leftovers are 1 up to rounding errors, they keep prob 1
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self, n, u=None):
+        """(n,) indices, u is (n, 2) uniform numbers(cell, coin) or None"""
+        if u is None:
+            u = np.random.uniform(0, 1, (n, 2))
+        cell = np.minimum((u[:, 0]*len(self.prob)).astype(int), len(self.prob) - 1)
+        return np.where(u[:, 1] < self.prob[cell], cell, self.alias[cell])
+
+
+class EmitterSampler():
+    """uniformly distributed points on the emissive triangles of a mesh
+
+    A triangle is picked with probability proportional to its emitted power
+    (area times emitted luminance, the area alone for equal lights), then a
+    point uniformly inside it, so the area density of a point depends only on
+    its object: pdf[object_id] = luminance/total power.
+
+    Args:
+        mesh (scene.mesh.TriangleMesh): scene triangles
+        materials (scene.objects.Materials): is_light/color(emitted radiance) by object id
+    """
+
+    def __init__(self, mesh, materials):
+        self.mesh = mesh
+        self.triangles = np.flatnonzero(materials.is_light[mesh.object_id])
+        # area density of the points of every object, 0 for non emitters
+        self.pdf = np.zeros(len(materials.is_light))
+        self.table = None
+        if len(self.triangles) == 0:
+            return
+
+        tris = self.triangles
+        area = 0.5*np.linalg.norm(np.cross(mesh.edge1[tris], mesh.edge2[tris]), axis=1)
+        power = luminance(materials.color[mesh.object_id[tris]])
+        if not np.any(area*power > 0):
+            # black lights: still sample them(by area), they just add nothing
+            power = np.ones(len(tris))
+
+        weights = area*power
+        if weights.sum() <= 0:
+            self.triangles = self.triangles[:0]
+            return
+        self.table = AliasTable(weights)
+        self.pdf[mesh.object_id[tris]] = power/weights.sum()
+
+    def __len__(self):
+        return len(self.triangles)
+
+    def sample(self, n, u=None):
+        """n emitter points
+
+        Args:
+            n (int): number of points
+            u (np.array): (n, 4) uniform numbers(triangle pick, alias coin and
+                2 for the point), drawn here when None
+
+        Returns:
+            (n, 3) points, (n, 3) normals, (n,) object ids
+        """
+        if u is None:
+            u = np.random.uniform(0, 1, (n, 4))
+        tri = self.triangles[self.table.sample(n, u[:, :2])]
+        mesh = self.mesh
+
+        # uniform barycentrics: sqrt warps the unit square onto the triangle
+        su = np.sqrt(u[:, 2])[:, None]
+        u2 = u[:, 3][:, None]
+        points = mesh.p1[tri] + mesh.edge1[tri]*(su*(1 - u2)) + mesh.edge2[tri]*(su*u2)
+
+        return points, mesh.normal[tri], mesh.object_id[tri]
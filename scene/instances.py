@@ -0,0 +1,330 @@
+"""
+Geometry instancing
+
+Every distinct OBJ file placed by an SDL instance line is stored once, in
+object space, with its own BVH(bottom level). An instance is only a 4x4
+transform, the index of its mesh and a material id, and a BVH over the world
+boxes of the instances(top level) finds the instances a ray may hit. Rays are
+moved into object space with the inverse transform instead of copying
+triangles, t is the same in both spaces since directions are not normalized.
+
+Instances - bottom level meshes/BVHs, instance transforms and the top level BVH
+TwoLevelBVH - scene accelerator over a base accelerator(the object/light
+              triangles) plus Instances
+"""
+import numpy as np
+
+from kernels.numpy_kernels import inverse
+from scene.bvh import BVH, build_nodes, refit_nodes
+from scene.mesh import EPSILON, as_interval, as_rays
+
+# arrays that fully describe the instances(without the bottom level meshes)
+INSTANCE_ARRAYS = ('mesh_id', 'transform', 'object_id')
+# top level nodes, as scene.bvh.NODE_ARRAYS
+TOP_ARRAYS = ('lower', 'upper', 'left', 'right', 'start', 'count', 'order')
+
+
+class Instances():
+    """placed copies of shared meshes
+
+    Args:
+        bvhs (list): scene.bvh.BVH of every distinct mesh(object space)
+        mesh_id (np.array): (K,) index in bvhs of every instance
+        transform (np.array): (K, 4, 4) object to world transform of every instance
+        object_id (np.array): (K,) material id of every instance
+        top (dict): top level node arrays(TOP_ARRAYS), built when None
+    """
+
+    def __init__(self, bvhs, mesh_id, transform, object_id, top=None):
+        self.bvhs = bvhs
+        self.mesh_id = np.asarray(mesh_id, dtype=np.int64).reshape(-1)
+        self.transform = np.asarray(transform, dtype=float).reshape(-1, 4, 4)
+        self.object_id = np.asarray(object_id, dtype=np.int64).reshape(-1)
+        self.inverse = np.linalg.inv(self.transform)
+
+        # instance i owns the triangle ids offsets[i]:offsets[i + 1]
+        sizes = np.array([len(bvh.mesh) for bvh in bvhs], dtype=np.int64)[self.mesh_id]
+        self.offsets = np.concatenate(([0], np.cumsum(sizes)))
+        self.stats = None
+
+        self.lower, self.upper = self.__world_bounds()
+        if top is None:
+            top = build_nodes(self.lower, self.upper)
+        for name in TOP_ARRAYS:
+            setattr(self, f"top_{name}", top[name])
+
+    @classmethod
+    def from_meshes(cls, meshes, mesh_id, transform, object_id):
+        """instances of scene.mesh.TriangleMesh objects, a BVH is built over each
+
+        The meshes are sorted in leaf order, as the compiled scene cache stores them.
+        """
+        bvhs = []
+        for mesh in meshes:
+            bvh = BVH(mesh)
+            mesh = mesh.take(bvh.order)
+            nodes = dict(bvh.arrays(), order=np.arange(len(mesh), dtype=np.int64))
+            bvhs.append(BVH.from_arrays(mesh, nodes))
+        return cls(bvhs, mesh_id, transform, object_id)
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in INSTANCE_ARRAYS}
+
+    def top_arrays(self):
+        return {name: getattr(self, f"top_{name}") for name in TOP_ARRAYS}
+
+    def __len__(self):
+        return len(self.mesh_id)
+
+    def n_triangles(self):
+        """triangles the scene would hold with every instance copied"""
+        return int(self.offsets[-1])
+
+    def intersect(self, origins, directions, tmin, tmax):
+        """closest instance hit of (n,) rays
+
+        Returns:
+            (n,) t(inf on a miss), instance and triangle of its mesh(-1 on a miss)
+        """
+        n = len(origins)
+        t = np.full(n, np.inf)
+        instance = np.full(n, -1, dtype=np.int64)
+        tri = np.full(n, -1, dtype=np.int64)
+
+        for mesh, ray, inst, o, d in self.__object_rays(origins, directions, tmin, tmax):
+            # hits of the meshes done so far prune the next ones
+            t_hit, local, _ = self.bvhs[mesh].intersect(
+                o, d, tmin[ray], np.minimum(tmax[ray], t[ray])
+            )
+            hit = local >= 0
+            ray, inst, t_hit, local = ray[hit], inst[hit], t_hit[hit], local[hit]
+            if len(ray) == 0:
+                continue
+
+            # closest pair of every ray, then against the other meshes
+            order = np.lexsort((t_hit, ray))
+            first = order[np.concatenate(([True], ray[order][1:] != ray[order][:-1]))]
+            closer = t_hit[first] < t[ray[first]]
+            best = first[closer]
+            t[ray[best]] = t_hit[best]
+            instance[ray[best]] = inst[best]
+            tri[ray[best]] = local[best]
+
+        return t, instance, tri
+
+    def occluded(self, origins, directions, tmin, tmax, ignore=None):
+        """(n,) True where some instance is hit inside [tmin, tmax)"""
+        blocked = np.zeros(len(origins), dtype=bool)
+        keep = None if ignore is None else ~np.asarray(ignore, dtype=bool)[self.object_id]
+
+        for mesh, ray, inst, o, d in self.__object_rays(origins, directions, tmin, tmax, keep):
+            hit = self.bvhs[mesh].occluded(o, d, tmax[ray], tmin[ray])
+            blocked[ray[hit]] = True
+
+        return blocked
+
+    def normals(self, instance, tri):
+        """world unit normals of triangle tri of the mesh of each instance"""
+        normals = np.zeros((len(instance), 3))
+        mesh_id = self.mesh_id[instance]
+        for mesh in np.unique(mesh_id):
+            sel = mesh_id == mesh
+            N = self.bvhs[mesh].normals(tri[sel])
+            # normals go through the inverse transpose
+            inv = self.inverse[instance[sel], :3, :3]
+            normals[sel] = np.einsum('kji,kj->ki', inv, N)
+        return normals/np.linalg.norm(normals, axis=1, keepdims=True)
+
+    def move(self, instance, transform):
+        """new object to world transforms of the instances instance, refit afterwards"""
+        if not self.transform.flags.writeable:
+            self.transform = self.transform.copy()
+        self.transform[instance] = transform
+        self.inverse[instance] = np.linalg.inv(transform)
+
+    def refit(self):
+        """world boxes of the current transforms and the top level boxes over them,
+        the top level tree is kept"""
+        self.lower, self.upper = self.__world_bounds()
+        self.top_lower, self.top_upper = refit_nodes(self.top_arrays(), self.lower, self.upper)
+
+    def __object_rays(self, origins, directions, tmin, tmax, keep=None):
+        """rays paired with the instances whose box they cross, grouped by mesh
+
+        Yields:
+            mesh index, (m,) ray and instance of every pair, (m, 3) object space
+            origins and directions
+        """
+        ray, inst = self.__candidates(origins, directions, tmin, tmax)
+        if keep is not None:
+            ray, inst = ray[keep[inst]], inst[keep[inst]]
+
+        mesh_id = self.mesh_id[inst]
+        for mesh in np.unique(mesh_id):
+            sel = mesh_id == mesh
+            r, i = ray[sel], inst[sel]
+            inv = self.inverse[i]
+            o = np.einsum('kij,kj->ki', inv[:, :3, :3], origins[r]) + inv[:, :3, 3]
+            d = np.einsum('kij,kj->ki', inv[:, :3, :3], directions[r])
+            yield mesh, r, i, o, d
+
+    def __candidates(self, origins, directions, tmin, tmax):
+        """(ray, instance) pairs whose instance box is crossed inside [tmin, tmax)
+
+        The top level is walked one level at a time over every (ray, node) pair
+        at once, so the python loop runs once per level, not once per node.
+        """
+        inv_dir = inverse(directions)
+        rays_out, instances_out = [], []
+        visits = 0
+
+        ray = np.arange(len(origins) if len(self) > 0 else 0)
+        node = np.zeros(len(ray), dtype=np.int64)
+
+        while len(ray) > 0:
+            visits += len(ray)
+            crossed = crosses(
+                self.top_lower[node], self.top_upper[node], origins[ray], inv_dir[ray],
+                tmin[ray], tmax[ray]
+            )
+            ray, node = ray[crossed], node[crossed]
+
+            leaf = self.top_count[node] > 0
+            # leaf pairs: every instance of the leaf against its own box
+            count = self.top_count[node[leaf]]
+            first = np.repeat(self.top_start[node[leaf]] - np.cumsum(count) + count, count)
+            inst = self.top_order[first + np.arange(count.sum())]
+            pair_ray = np.repeat(ray[leaf], count)
+            crossed = crosses(
+                self.lower[inst], self.upper[inst], origins[pair_ray], inv_dir[pair_ray],
+                tmin[pair_ray], tmax[pair_ray]
+            )
+            rays_out.append(pair_ray[crossed])
+            instances_out.append(inst[crossed])
+
+            # interior pairs go on with both children
+            ray, node = ray[~leaf], node[~leaf]
+            ray = np.concatenate((ray, ray))
+            node = np.concatenate((self.top_left[node], self.top_right[node]))
+
+        if self.stats is not None:
+            self.stats.node_visits += visits
+
+        if not rays_out:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(rays_out), np.concatenate(instances_out)
+
+    def __world_bounds(self):
+        """(K, 3) world boxes of the instances, the bottom level root boxes transformed"""
+        lower = np.zeros((len(self), 3))
+        upper = np.zeros((len(self), 3))
+        # the 8 corners of a box as 0/1 picks between lower and upper
+        corners = np.array([[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)])
+
+        for mesh in np.unique(self.mesh_id):
+            bvh = self.bvhs[mesh]
+            sel = self.mesh_id == mesh
+            if len(bvh) == 0:
+                lower[sel], upper[sel] = np.inf, -np.inf
+                continue
+            points = np.where(corners, bvh.upper[0], bvh.lower[0])
+            M = self.transform[sel]
+            world = np.einsum('kij,cj->kci', M[:, :3, :3], points) + M[:, None, :3, 3]
+            lower[sel] = world.min(axis=1)
+            upper[sel] = world.max(axis=1)
+
+        return lower, upper
+
+
+def crosses(lower, upper, origins, inv_dir, tmin, tmax):
+    """(n,) True where ray i crosses box i inside [tmin, tmax)"""
+    with np.errstate(invalid='ignore'):
+        t1 = (lower - origins)*inv_dir
+        t2 = (upper - origins)*inv_dir
+    t_near = np.fmax.reduce(np.fmin(t1, t2), axis=1)
+    t_far = np.fmin.reduce(np.fmax(t1, t2), axis=1)
+    return (t_near <= t_far) & (t_far >= tmin) & (t_near < tmax)
+
+
+class TwoLevelBVH():
+    """base accelerator plus instances behind the TriangleMesh/BVH interface
+
+    Triangle ids below len(base mesh) are base triangles, an instance hit has the
+    id len(base mesh) + instances.offsets[instance] + triangle.
+
+    Args:
+        base (scene.bvh.BVH or scene.mesh.TriangleMesh): object and light triangles
+        instances (Instances): placed meshes
+    """
+
+    def __init__(self, base, instances):
+        self.base = base
+        self.instances = instances
+        self.n_base = len(base.object_id)
+        self._stats = None
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @stats.setter
+    def stats(self, stats):
+        self._stats = stats
+        self.base.stats = stats
+        self.instances.stats = stats
+        for bvh in self.instances.bvhs:
+            bvh.stats = stats
+
+    def refit(self):
+        """refit the base accelerator and the instances after they moved"""
+        self.base.refit()
+        self.instances.refit()
+
+    def intersect(self, origins, directions, tmin=EPSILON, tmax=np.inf):
+        """closest hit, same signature and result as TriangleMesh.intersect"""
+        origins, directions, single = as_rays(origins, directions)
+        n = len(origins)
+        tmin, tmax = as_interval(tmin, tmax, n)
+
+        t, tri, obj = self.base.intersect(origins, directions, tmin, tmax)
+        # instances farther than the base hit are pruned
+        t_inst, inst, local = self.instances.intersect(
+            origins, directions, tmin, np.minimum(tmax, t)
+        )
+
+        closer = inst >= 0
+        t = np.where(closer, t_inst, t)
+        tri = np.where(closer, self.n_base + self.instances.offsets[inst] + local, tri)
+        obj = np.where(closer, self.instances.object_id[inst], obj)
+
+        if single:
+            return t[0], tri[0], obj[0]
+        return t, tri, obj
+
+    def occluded(self, origins, directions, tmax=1.0, tmin=EPSILON, ignore=None):
+        """any hit, same signature and result as TriangleMesh.occluded"""
+        origins, directions, single = as_rays(origins, directions)
+        n = len(origins)
+        tmin, tmax = as_interval(tmin, tmax, n)
+
+        blocked = np.asarray(self.base.occluded(origins, directions, tmax, tmin, ignore))
+        rest = np.flatnonzero(~blocked)
+        blocked[rest] = self.instances.occluded(
+            origins[rest], directions[rest], tmin[rest], tmax[rest], ignore
+        )
+
+        return blocked[0] if single else blocked
+
+    def normals(self, tri):
+        """unit normals of the triangle ids returned by intersect"""
+        tri = np.asarray(tri)
+        if tri.ndim == 0:
+            return self.normals(tri[None])[0]
+        normals = np.zeros(tri.shape + (3,))
+        base = tri < self.n_base
+        normals[base] = self.base.normals(tri[base])
+
+        ids = tri[~base] - self.n_base
+        inst = np.searchsorted(self.instances.offsets, ids, side='right') - 1
+        normals[~base] = self.instances.normals(inst, ids - self.instances.offsets[inst])
+        return normals
@@ -0,0 +1,200 @@
+"""
+Packed triangle storage
+
+TriangleMesh - every scene triangle packed as arrays(structure of arrays),
+               tested with the kernels Moller-Trumbore intersection
+"""
+import numpy as np
+
+import kernels
+
+# same self intersection offset used by Triangles.intersect
+EPSILON = 0.01
+# arrays that fully describe a mesh, see TriangleMesh.arrays
+MESH_ARRAYS = ('p1', 'p2', 'p3', 'edge1', 'edge2', 'normal', 'object_id')
+
+
+class TriangleMesh():
+    """all scene triangles packed in contiguous arrays
+
+    Args:
+        p1, p2, p3 (np.array): (M, 3) triangle vertices
+        object_id (np.array): (M,) index of the scene object owning the triangle,
+            also used as material id (scene_objects[object_id].properties)
+    """
+
+    def __init__(self, p1, p2, p3, object_id):
+        self.p1 = np.ascontiguousarray(p1, dtype=float).reshape(-1, 3)
+        self.p2 = np.ascontiguousarray(p2, dtype=float).reshape(-1, 3)
+        self.p3 = np.ascontiguousarray(p3, dtype=float).reshape(-1, 3)
+        self.object_id = np.ascontiguousarray(object_id, dtype=np.int64).reshape(-1)
+
+        self.edge1 = self.p2 - self.p1
+        self.edge2 = self.p3 - self.p1
+
+        # same orientation as Triangles.normal
+        normal = np.cross(self.p2 - self.p1, self.p3 - self.p2)
+        self.normal = normal/np.linalg.norm(normal, axis=1, keepdims=True)
+
+        self.__blocker_cache = {}
+        # stats.RenderStats counting the ray/triangle tests, None when off
+        self.stats = None
+
+    @classmethod
+    def from_scene(cls, scene_objects):
+        """pack the triangles of a list of scene.objects.SceneObject"""
+        p1, p2, p3, object_id = [], [], [], []
+        for idx, scene_obj in enumerate(scene_objects):
+            for obj in scene_obj.objects:
+                p1.append(obj.p1)
+                p2.append(obj.p2)
+                p3.append(obj.p3)
+                object_id.append(idx)
+
+        return cls(p1, p2, p3, object_id)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """mesh over the arrays of TriangleMesh.arrays, used as they are(no copy),
+        so memory-mapped arrays stay shared between processes"""
+        mesh = cls.__new__(cls)
+        for name in MESH_ARRAYS:
+            setattr(mesh, name, arrays[name])
+        mesh.__blocker_cache = {}
+        mesh.stats = None
+        return mesh
+
+    def arrays(self):
+        """name -> array of everything the mesh holds"""
+        return {name: getattr(self, name) for name in MESH_ARRAYS}
+
+    def take(self, order):
+        """mesh with the triangles reordered(mesh.take(order)[i] is self[order[i]])"""
+        return TriangleMesh.from_arrays(
+            {name: np.ascontiguousarray(array[order]) for name, array in self.arrays().items()}
+        )
+
+    def __len__(self):
+        return len(self.object_id)
+
+    def intersect(self, origins, directions, tmin=EPSILON, tmax=np.inf):
+        """closest hit for one ray or N rays against every triangle
+
+        Args:
+            origins (np.array): (3,) or (N, 3) ray starting points
+            directions (np.array): (3,) or (N, 3) ray directions(not normalized)
+            tmin, tmax (float or np.array): only hits with tmin <= t < tmax count
+                (in ray parameter units), scalars or (N,)
+
+        Returns:
+            t, triangle id, object id. A miss returns inf, -1, -1.
+            Scalars for one ray, (N,) arrays for N rays.
+        """
+        origins, directions, single = as_rays(origins, directions)
+        n = len(origins)
+        tmin, tmax = as_interval(tmin, tmax, n)
+
+        if len(self.p1) == 0:
+            # nothing to hit, every ray misses
+            return hit_result(np.full(n, np.inf), np.full(n, -1, dtype=np.int64), None, single)
+
+        t, tri = kernels.closest_hit(
+            origins, directions, self.p1, self.edge1, self.edge2, tmin, tmax
+        )
+
+        if self.stats is not None:
+            self.stats.triangle_tests += n*len(self)
+
+        return hit_result(t, tri, self.object_id, single)
+
+    def occluded(self, origins, directions, tmax=1.0, tmin=EPSILON, ignore=None):
+        """any hit test, True if some triangle is hit with tmin <= t < tmax
+
+        Args:
+            origins (np.array): (3,) or (N, 3) ray starting points
+            directions (np.array): (3,) or (N, 3) ray directions(not normalized)
+            tmax, tmin (float or np.array): ray interval, scalars or (N,)
+            ignore (np.array): (objects,) bool, triangles of these objects never block(emitters)
+
+        Returns:
+            bool, or (N,) bool array for N rays
+        """
+        origins, directions, single = as_rays(origins, directions)
+        n = len(origins)
+        tmin, tmax = as_interval(tmin, tmax, n)
+
+        p1, edge1, edge2 = self.__blockers(ignore)
+
+        blocked = kernels.any_hit(origins, directions, p1, edge1, edge2, tmin, tmax)
+
+        if self.stats is not None:
+            self.stats.triangle_tests += n*len(p1)
+
+        return blocked[0] if single else blocked
+
+    def normals(self, tri):
+        """unit normals of the triangle ids returned by intersect"""
+        return self.normal[tri]
+
+    def move(self, tris, p1, p2, p3):
+        """new vertices for the triangles tris, edges and normals follow
+
+        Read only arrays(memory-mapped cache) are copied on the first move, so
+        accelerators over the mesh have to be refit afterwards.
+        """
+        for name in ('p1', 'p2', 'p3', 'edge1', 'edge2', 'normal'):
+            array = getattr(self, name)
+            if not array.flags.writeable:
+                setattr(self, name, array.copy())
+
+        self.p1[tris], self.p2[tris], self.p3[tris] = p1, p2, p3
+        self.edge1[tris] = self.p2[tris] - self.p1[tris]
+        self.edge2[tris] = self.p3[tris] - self.p1[tris]
+        normal = np.cross(self.edge1[tris], self.p3[tris] - self.p2[tris])
+        self.normal[tris] = normal/np.linalg.norm(normal, axis=1, keepdims=True)
+        self.__blocker_cache = {}
+
+    def refit(self):
+        """nothing to update, every triangle is tested(accelerator interface)"""
+
+    def __blockers(self, ignore):
+        """triangles that can block a ray, cached per ignore mask"""
+        if ignore is None:
+            return self.p1, self.edge1, self.edge2
+
+        key = np.asarray(ignore, dtype=bool).tobytes()
+        if key not in self.__blocker_cache:
+            keep = ~np.asarray(ignore, dtype=bool)[self.object_id]
+            self.__blocker_cache[key] = self.p1[keep], self.edge1[keep], self.edge2[keep]
+        return self.__blocker_cache[key]
+
+
+def as_rays(origins, directions):
+    """return (N, 3) origins/directions and whether a single ray was given"""
+    origins = np.asarray(origins, dtype=float)
+    directions = np.asarray(directions, dtype=float)
+    single = origins.ndim == 1 and directions.ndim == 1
+
+    origins, directions = np.broadcast_arrays(
+        np.atleast_2d(origins), np.atleast_2d(directions)
+    )
+    return origins, directions, single
+
+
+def as_interval(tmin, tmax, n):
+    """return tmin/tmax(scalars or arrays) as (n,) arrays"""
+    tmin = np.broadcast_to(np.asarray(tmin, dtype=float), (n,))
+    tmax = np.broadcast_to(np.asarray(tmax, dtype=float), (n,))
+    return tmin, tmax
+
+
+def hit_result(t, tri, object_id, single):
+    """pack (t, triangle id, object id) as returned by the intersect methods,
+    object_id may be None when every ray missed"""
+    obj = np.full(len(tri), -1, dtype=np.int64)
+    hit = tri >= 0
+    if np.any(hit):
+        obj[hit] = object_id[tri[hit]]
+    if single:
+        return t[0], tri[0], obj[0]
+    return t, tri, obj
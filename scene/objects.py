@@ -2,6 +2,7 @@
 Scene Objects Classes
 
 Properties - Hold ilumination info
+Materials - Properties of every scene object packed as arrays
 SceneObject - One or more scene objects
 Triangles - Triangle object
 """
@@ -9,6 +10,8 @@ from random import randint
 import random
 import numpy as np
 
+# arrays that fully describe a Materials, see Materials.arrays
+MATERIAL_ARRAYS = ('color', 'ka', 'kd', 'ks', 'kt', 'n', 'is_light')
 
 class SceneObject():
     """scene object, hold a list of objects that share a commum properties"""
@@ -28,16 +31,98 @@ class Properties():
         self.n = n
         self.is_light = is_light
 
-    def random(self):
-        return random.uniform(0, self.kd + self.ks + self.kt)
+    def random(self, u=None):
+        """uniform in [0, kd + ks + kt), u is a uniform number in [0, 1) or None"""
+        if u is None:
+            return random.uniform(0, self.kd + self.ks + self.kt)
+        return u*(self.kd + self.ks + self.kt)
+
+class Materials():
+    """properties of a list of scene objects as arrays indexed by object id"""
+    def __init__(self, properties):
+        self.color = np.array([p.color for p in properties], dtype=float).reshape(-1, 3)
+        self.ka = self.__pack(properties, 'ka')
+        self.kd = self.__pack(properties, 'kd')
+        self.ks = self.__pack(properties, 'ks')
+        self.kt = self.__pack(properties, 'kt')
+        self.n = self.__pack(properties, 'n')
+        self.is_light = np.array([p.is_light for p in properties], dtype=bool)
+
+    @classmethod
+    def from_scene(cls, scene_objects):
+        return cls([scene_obj.properties for scene_obj in scene_objects])
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """materials from the arrays of Materials.arrays"""
+        materials = cls.__new__(cls)
+        for name in MATERIAL_ARRAYS:
+            setattr(materials, name, arrays[name])
+        return materials
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in MATERIAL_ARRAYS}
+
+    def properties(self):
+        """one Properties per object id"""
+        return [
+            Properties(
+                self.color[i], self.ka[i], self.kd[i], self.ks[i], self.kt[i], self.n[i],
+                bool(self.is_light[i])
+            )
+            for i in range(len(self.is_light))
+        ]
+
+    def random(self, obj_id, u=None):
+        """Properties.random for an array of object ids, u is (n,) uniform numbers or None"""
+        total = self.kd[obj_id] + self.ks[obj_id] + self.kt[obj_id]
+        if u is None:
+            u = np.random.uniform(0, 1, len(obj_id))
+        return u*total
+
+    def __pack(self, properties, attr):
+        # lights carry no coefficients
+        return np.array([getattr(p, attr) or 0 for p in properties], dtype=float)
 
 class Light():
+    """area light, its triangles come from scene_obj or as (p1, p2, p3) arrays"""
 
-    def __init__(self, lp, color, scene_obj):
+    def __init__(self, lp, color, scene_obj=None, triangles=None):
         self.lp = lp
         self.scene_obj = scene_obj
         self.color = np.array(color)   
 
-    def get_point(self):
-        idx = randint(0, len(self.scene_obj.objects) - 1)
-        return self.scene_obj.objects[idx].get_point()
+        # emitter triangles packed for get_point(s)
+        if triangles is None:
+            triangles = [
+                np.array([getattr(obj, p) for obj in scene_obj.objects], dtype=float)
+                for p in ('p1', 'p2', 'p3')
+            ]
+        self.p1, self.p2, self.p3 = (np.asarray(p, dtype=float).reshape(-1, 3) for p in triangles)
+
+    def get_point(self, u=None):
+        """a point drawn as Triangles.get_point does, u is 4 uniform numbers
+        (triangle, c1, c2, c3) or None"""
+        if u is None:
+            idx = randint(0, len(self.p1) - 1)
+            c1 = np.random.uniform(0, 1)
+            c2 = np.random.uniform(0, 1 - c1)
+            c3 = np.random.uniform(0, 1 - c1 - c2)
+        else:
+            idx = min(int(u[0]*len(self.p1)), len(self.p1) - 1)
+            c1 = u[1]
+            c2 = u[2]*(1 - c1)
+            c3 = u[3]*(1 - c1 - c2)
+
+        return self.p1[idx]*c1 + self.p2[idx]*c2 + self.p3[idx]*c3
+
+    def get_points(self, n, u=None):
+        """n points drawn as get_point does, (n, 3) array, u is (n, 4) uniform numbers or None"""
+        if u is None:
+            u = np.random.uniform(0, 1, (n, 4))
+        idx = np.minimum((u[:, 0]*len(self.p1)).astype(int), len(self.p1) - 1)
+        c1 = u[:, 1]
+        c2 = u[:, 2]*(1 - c1)
+        c3 = u[:, 3]*(1 - c1 - c2)
+
+        return self.p1[idx]*c1[:, None] + self.p2[idx]*c2[:, None] + self.p3[idx]*c3[:, None]
@@ -1,8 +1,14 @@
 import numpy as np 
 
+from scene.mesh import EPSILON
+
+
 class Ray():
+    """ray p + t*v, only hits with tmin <= t < tmax count"""
 
-    def __init__(self, p, v, pixel=None):
+    def __init__(self, p, v, pixel=None, tmin=EPSILON, tmax=np.inf):
         self.p = p 
         self.v = v
-        self.pixel = pixel
\ No newline at end of file
+        self.pixel = pixel
+        self.tmin = tmin
+        self.tmax = tmax
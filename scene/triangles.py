@@ -54,9 +54,12 @@ class Triangles():
         return inside
 
 
-    def get_point(self):
-        c1 = np.random.uniform(0, 1)
-        c2 = np.random.uniform(0, 1 - c1)
-        c3 = np.random.uniform(0, 1 - c1 - c2)
+    def get_point(self, u=None):
+        """point drawn with 3 uniform numbers u(drawn here when None)"""
+        if u is None:
+            u = np.random.uniform(0, 1, 3)
+        c1 = u[0]
+        c2 = u[1]*(1 - c1)
+        c3 = u[2]*(1 - c1 - c2)
 
         return self.p1*c1 + self.p2*c2 + self.p3*c3
\ No newline at end of file
@@ -0,0 +1,362 @@
+"""
+Render job server
+
+An asyncio server taking render jobs over a local TCP socket(protocol.py
+messages). A job is one JSON message:
+
+    {"sdl": "cornellroom/cornellroom.sdl", "size": [250, 250], "passes": 64,
+     "budget": 30, "integrator": "nee", "image_interval": 1.0}
+
+only "sdl" is required: size, passes and integrator default to the SDL
+values, budget(seconds) stops scheduling passes once spent. The server answers
+with status messages {"job", "status", ...}: 'loaded', then 'pass' after
+every finished pass(with the mean radiance as a float32 (h, w, 3) array at
+most every image_interval seconds) and finally 'done' with the image or
+'error'. A job may also carry a "seed"(the SDL seed or 0 by default) and a
+"sampler"(samplers.SAMPLERS name, the SDL one by default): a job gives the
+same image whatever the number of workers.
+
+Parsed scenes stay in an LRU pool(ScenePool), their compiled cache is ready
+before any pass is queued. Passes run on a process pool without blocking the
+event loop, every worker keeps its own LRU of opened scenes(memory-mapped
+compiled caches with their BVHs), so a job on a known scene only pays for
+tracing. The passes of a job run on every worker at once and are summed in
+pass order as they come back(a pass back early waits for the ones before it),
+so the floating point sums do not depend on the workers either.
+
+ScenePool - LRU of loaded scenes
+RenderServer - accepts jobs and streams their progress
+request - client side, send a job and iterate over its messages
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from film import Film
+from protocol import read_message, write_message
+from readers.load import SceneLoader
+from render import INTEGRATORS
+from samplers import SAMPLERS
+from scene.camera import Camera
+
+HOST = '127.0.0.1'
+PORT = 8765
+# loaded scenes kept by the server and by every worker process
+SCENE_POOL_SIZE = 4
+# passes of a job without passes and SDL npaths
+DEFAULT_PASSES = 16
+# min seconds between two streamed images of a job
+IMAGE_INTERVAL = 1.0
+# max rays traced at once in a worker
+CHUNK_SIZE = 1 << 16
+
+# per worker process opened scenes, (sdl file, version, integrator, options) -> PathTracing
+_tracers = OrderedDict()
+_worker = {'pool_size': SCENE_POOL_SIZE}
+
+
+def _check_int(value, name, low=1):
+    """value if it is an int >= low, ValueError otherwise"""
+    if isinstance(value, bool) or not isinstance(value, int) or value < low:
+        raise ValueError(f"{name} must be an integer >= {low}, got {value!r}")
+    return value
+
+
+def _check_number(value, name):
+    """value if it is a non negative number, ValueError otherwise"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        raise ValueError(f"{name} must be a non negative number, got {value!r}")
+    return value
+
+
+def _init_worker(pool_size):
+    _worker['pool_size'] = pool_size
+
+
+def _tracer(sdl_file, version, integrator, options):
+    """path tracer of a scene, opened once per worker while it stays in the LRU"""
+    key = (sdl_file, version, integrator, tuple(sorted(options.items())))
+    if key in _tracers:
+        _tracers.move_to_end(key)
+        return _tracers[key]
+
+    scene = SceneLoader(sdl_file)
+    _tracers[key] = INTEGRATORS[integrator].from_compiled(
+        scene.get_camera(), scene.get_compiled(), **options
+    )
+    while len(_tracers) > _worker['pool_size']:
+        _tracers.popitem(last=False)
+    return _tracers[key]
+
+
+def _render_pass(sdl_file, version, integrator, options, camera, sample):
+    """jittered sample number sample of every pixel of camera, traced in a worker process"""
+    pt = _tracer(sdl_file, version, integrator, options)
+    film = Film(*camera.pixels_size[:2])
+    batches = camera.generate_rays(chunk_size=CHUNK_SIZE, rng=pt.rng, sample=sample)
+    for origins, directions, pixels in batches:
+        film.add(pixels, pt.path_tracing_wavefront(origins, directions, pixels, sample))
+    return film
+
+
+class ScenePool():
+    """least recently used readers.load.SceneLoader with their compiled scenes
+
+    A scene is keyed by its SDL path and modification time, so an edited file
+    is loaded again. Loads run on a thread and concurrent jobs of one scene
+    wait for the same load.
+
+    Args:
+        size (int): scenes kept
+    """
+
+    def __init__(self, size=SCENE_POOL_SIZE):
+        self.size = size
+        # (path, mtime) -> asyncio.Future of the SceneLoader
+        self.scenes = OrderedDict()
+
+    async def get(self, sdl_file):
+        """(SceneLoader, version, True if it was already loaded) of sdl_file"""
+        path = Path(sdl_file).resolve()
+        key = (path, path.stat().st_mtime_ns)
+
+        cached = key in self.scenes
+        if not cached:
+            loop = asyncio.get_running_loop()
+            self.scenes[key] = loop.run_in_executor(None, self.__load, path)
+            while len(self.scenes) > self.size:
+                self.scenes.popitem(last=False)
+        self.scenes.move_to_end(key)
+
+        try:
+            scene = await self.scenes[key]
+        except Exception:
+            self.scenes.pop(key, None)
+            raise
+        return scene, key[1], cached
+
+    @staticmethod
+    def __load(path):
+        scene = SceneLoader(path)
+        # compiled once here, workers only open the cache
+        scene.get_compiled()
+        return scene
+
+
+class RenderServer():
+    """render jobs of any number of clients on one process pool
+
+    Args:
+        workers (int): render processes, defaults to the cpu count
+        pool_size (int): scenes kept loaded
+    """
+
+    def __init__(self, workers=None, pool_size=SCENE_POOL_SIZE):
+        self.workers = workers or os.cpu_count()
+        self.executor = ProcessPoolExecutor(
+            self.workers, initializer=_init_worker, initargs=(pool_size,)
+        )
+        self.scenes = ScenePool(pool_size)
+        self.jobs = 0
+
+    async def serve(self, host=HOST, port=PORT):
+        """accept clients until cancelled"""
+        server = await asyncio.start_server(self.__client, host, port)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    async def __client(self, reader, writer):
+        """run the jobs of one connection one after the other"""
+        async def send(header, array=None):
+            await write_message(writer, header, array)
+
+        try:
+            while True:
+                try:
+                    # jobs are plain JSON, an array payload is refused unread
+                    job, _ = await read_message(reader, arrays=False)
+                except json.JSONDecodeError as error:
+                    # messages are lines, the next one may still be a job
+                    await send({
+                        'job': None, 'status': 'error', 'message': f"Invalid JSON: {error}"
+                    })
+                    continue
+                except ValueError as error:
+                    # a payload may follow, the next line is not known to be a message
+                    await send({'job': None, 'status': 'error', 'message': f"Invalid job: {error}"})
+                    break
+                if job is None:
+                    break
+                await self.run(job, send)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # the client went away, its queued passes were cancelled by run
+            pass
+        finally:
+            writer.close()
+
+    async def run(self, job, send):
+        """render a job, its messages go through await send(header, array)"""
+        job_id = self.jobs
+        self.jobs += 1
+        start = time.perf_counter()
+
+        try:
+            if not isinstance(job, dict) or not isinstance(job.get('sdl'), str):
+                raise ValueError("A job is a JSON object with an \"sdl\" path")
+            size = job.get('size')
+            if size is not None and (not isinstance(size, list) or len(size) != 2):
+                raise ValueError(f"size must be [width, height], got {size!r}")
+            passes = job.get('passes')
+            if passes is not None:
+                _check_int(passes, 'passes')
+            if job.get('seed') is not None:
+                _check_int(job['seed'], 'seed', low=0)
+            if job.get('budget') is not None:
+                _check_number(job['budget'], 'budget')
+            _check_number(job.get('image_interval', IMAGE_INTERVAL), 'image_interval')
+
+            scene, version, cached = await self.scenes.get(job['sdl'])
+            w, h = (_check_int(n, 'size') for n in size or scene.get_size())
+            passes = passes or scene.get_npaths() or DEFAULT_PASSES
+            integrator = job.get('integrator') or scene.get_integrator()
+            if integrator not in INTEGRATORS:
+                raise ValueError(f"Unknown integrator {integrator}")
+            sampler = job.get('sampler') or scene.get_sampler()
+            if sampler not in SAMPLERS:
+                raise ValueError(f"Unknown sampler {sampler}")
+        except (KeyError, OSError, ValueError) as error:
+            await send({
+                'job': job_id, 'status': 'error', 'message': f"{type(error).__name__}: {error}"
+            })
+            return
+
+        budget = job.get('budget')
+        image_interval = job.get('image_interval', IMAGE_INTERVAL)
+        seed = job.get('seed')
+        if seed is None:
+            seed = scene.get_seed() or 0
+        options = {'n_reflections': scene.get_reflections(), 'seed': seed, 'sampler': sampler}
+        sdl = scene.sdl
+        camera = Camera(sdl.eye, sdl.target, sdl.up, sdl.window_size, [w, h])
+        await send({
+            'job': job_id, 'status': 'loaded', 'cached': cached,
+            'seconds': time.perf_counter() - start
+        })
+
+        film = Film(w, h)
+        loop = asyncio.get_running_loop()
+        pending = set()
+        # future -> its sample number, sample number -> film of a pass back too early
+        samples, early = {}, {}
+        submitted, done, last_image = 0, 0, -np.inf
+        trace_start = time.perf_counter()
+
+        try:
+            while True:
+                # every worker gets a pass of this job, new ones until passes or budget run out
+                while len(pending) < self.workers and submitted < passes and (
+                    budget is None or time.perf_counter() - start < budget
+                ):
+                    future = loop.run_in_executor(
+                        self.executor, _render_pass, str(scene.sdl_file),
+                        version, integrator, options, camera, submitted
+                    )
+                    pending.add(future)
+                    samples[future] = submitted
+                    submitted += 1
+                if not pending:
+                    break
+
+                finished, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in finished:
+                    early[samples.pop(future)] = future.result()
+                # summed in sample order, so the image does not depend on the workers
+                if done not in early:
+                    continue
+                while done in early:
+                    part = early.pop(done)
+                    film.radiance += part.radiance
+                    film.counts += part.counts
+                    film.squares += part.squares
+                    done += 1
+
+                elapsed = time.perf_counter() - trace_start
+                header = {
+                    'job': job_id, 'status': 'pass', 'passes': done,
+                    'seconds': elapsed, 'samples_per_second': film.counts.sum()/elapsed
+                }
+                image = None
+                if time.perf_counter() - last_image >= image_interval:
+                    image = film.image().astype(np.float32)
+                    last_image = time.perf_counter()
+                await send(header, image)
+
+        except Exception as error:
+            for future in pending:
+                future.cancel()
+            if isinstance(error, ConnectionError):
+                raise
+            await send({
+                'job': job_id, 'status': 'error', 'message': f"{type(error).__name__}: {error}"
+            })
+            return
+
+        await send({
+            'job': job_id, 'status': 'done', 'passes': done,
+            'seconds': time.perf_counter() - start
+        }, film.image().astype(np.float32))
+
+
+async def request(job, host=HOST, port=PORT):
+    """send job to a RenderServer, yield every (header, image) it answers until
+    the job is done or failed"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        await write_message(writer, job)
+        while True:
+            header, image = await read_message(reader)
+            if header is None:
+                raise ConnectionError("the server closed the connection")
+            yield header, image
+            if header['status'] in ('done', 'error'):
+                break
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Path Tracing render job server")
+    parser.add_argument('--host', default=HOST, help="address to listen on")
+    parser.add_argument('--port', type=int, default=PORT, help="port to listen on")
+    parser.add_argument(
+        '--workers', type=int, default=None, help="render processes, defaults to the cpu count"
+    )
+    parser.add_argument(
+        '--pool-size', type=int, default=SCENE_POOL_SIZE, help="scenes kept loaded"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = RenderServer(args.workers, args.pool_size)
+    print(f"listening on {args.host}:{args.port}")
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -0,0 +1,122 @@
+"""
+Render statistics
+
+RenderStats - ray counters, path lengths/endings, intersection work and wall
+              time per stage. PathTracing only records them when it is given
+              a RenderStats, so disabled stats cost a None check per batch.
+"""
+import json
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+import kernels
+
+RAY_KINDS = ('primary', 'secondary', 'transmission', 'shadow')
+# how a path ends: hit a light, left the scene, stopped on a surface(shaded
+# there), ran out of n_reflections bounces or was killed by russian roulette
+PATH_ENDINGS = ('light', 'miss', 'surface', 'exhausted', 'roulette')
+
+
+class RenderStats():
+    """counters aggregated over passes and workers with merge()"""
+
+    def __init__(self):
+        self.rays = dict.fromkeys(RAY_KINDS, 0)
+        self.endings = dict.fromkeys(PATH_ENDINGS, 0)
+        # path_lengths[k] = number of paths with k ray segments
+        self.path_lengths = np.zeros(0, dtype=np.int64)
+        self.triangle_tests = 0
+        self.node_visits = 0
+        self.stage_time = {}
+        self.passes = 0
+        self.backend = kernels.BACKEND
+
+    def count_rays(self, kind, n=1):
+        self.rays[kind] += int(n)
+
+    def end_paths(self, ending, length, n=1):
+        """record n paths of length ray segments ending with the given reason"""
+        n = int(n)
+        if n == 0:
+            return
+        self.endings[ending] += n
+        counts = np.zeros(length + 1, dtype=np.int64)
+        counts[length] = n
+        self.__add_lengths(counts)
+
+    @contextmanager
+    def stage(self, name):
+        """accumulate the wall time spent inside the block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_time[name] = self.stage_time.get(name, 0.0) + time.perf_counter() - start
+
+    def merge(self, other):
+        """add the counters of other(a RenderStats) into self"""
+        for kind, n in other.rays.items():
+            self.rays[kind] += n
+        for ending, n in other.endings.items():
+            self.endings[ending] += n
+        self.__add_lengths(other.path_lengths)
+        self.triangle_tests += other.triangle_tests
+        self.node_visits += other.node_visits
+        for name, seconds in other.stage_time.items():
+            self.stage_time[name] = self.stage_time.get(name, 0.0) + seconds
+        self.passes += other.passes
+        return self
+
+    def to_dict(self):
+        total_rays = sum(self.rays.values())
+        total_paths = sum(self.endings.values())
+        return {
+            'backend': self.backend,
+            'passes': self.passes,
+            'rays': dict(self.rays),
+            'triangle_tests': self.triangle_tests,
+            'node_visits': self.node_visits,
+            'tests_per_ray': self.triangle_tests/total_rays if total_rays else 0.0,
+            'path_lengths': self.path_lengths.tolist(),
+            'endings': dict(self.endings),
+            'ending_fractions': {
+                ending: n/total_paths if total_paths else 0.0 for ending, n in self.endings.items()
+            },
+            'stage_time': dict(self.stage_time),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.backend = data.get('backend', stats.backend)
+        stats.passes = data['passes']
+        stats.rays.update(data['rays'])
+        stats.endings.update(data['endings'])
+        stats.path_lengths = np.array(data['path_lengths'], dtype=np.int64)
+        stats.triangle_tests = data['triangle_tests']
+        stats.node_visits = data['node_visits']
+        stats.stage_time = dict(data['stage_time'])
+        return stats
+
+    def save_json(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+    def summary(self):
+        """one line summary"""
+        data = self.to_dict()
+        rays = ' '.join(f"{kind}={n}" for kind, n in self.rays.items())
+        endings = ' '.join(
+            f"{ending}={fraction:.1%}" for ending, fraction in data['ending_fractions'].items()
+        )
+        stages = ' '.join(f"{name}={seconds:.2f}s" for name, seconds in self.stage_time.items())
+        return f"{self.backend}: rays[{rays}] tests/ray={data['tests_per_ray']:.1f} paths[{endings}] time[{stages}]"
+
+    def __add_lengths(self, counts):
+        size = max(len(self.path_lengths), len(counts))
+        lengths = np.zeros(size, dtype=np.int64)
+        lengths[:len(self.path_lengths)] += self.path_lengths
+        lengths[:len(counts)] += counts
+        self.path_lengths = lengths
@@ -0,0 +1,5 @@
+"""the tests import the renderer modules from the repository root"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
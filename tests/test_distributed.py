@@ -0,0 +1,75 @@
+"""
+Distributed rendering on localhost
+
+A coordinator and two worker processes on 127.0.0.1 render a small scene, the
+merged film has to match a single process render of the same seed bit for bit.
+"""
+import asyncio
+import shutil
+import socket
+from pathlib import Path
+
+import numpy as np
+
+from distributed import Coordinator, start_workers, stop_workers
+from film import Film
+from readers.load import SceneLoader
+from render import INTEGRATORS
+
+CORNELL = Path(__file__).resolve().parent.parent / 'cornellroom'
+HOST = '127.0.0.1'
+PASSES = 4
+SEED = 7
+
+
+def small_scene(path):
+    """cornell room copy rendered at 24x24 pixels with 3 bounces"""
+    for obj in CORNELL.glob('*.obj'):
+        shutil.copy(obj, path / obj.name)
+    lines = []
+    for line in (CORNELL / 'cornellroom.sdl').read_text().splitlines():
+        if line.startswith('size '):
+            line = 'size 24 24'
+        elif line.startswith('reflections '):
+            line = 'reflections 3'
+        lines.append(line)
+    sdl_file = path / 'small.sdl'
+    sdl_file.write_text('\n'.join(lines) + '\n')
+    return sdl_file
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def single_process(sdl_file, integrator, options):
+    """the passes of the scene traced here, one after the other"""
+    scene = SceneLoader(sdl_file)
+    camera = scene.get_camera()
+    pt = INTEGRATORS[integrator].from_compiled(camera, scene.get_compiled(), **options)
+    w, h = scene.get_size()
+    film = Film(w, h)
+    for sample in range(PASSES):
+        for origins, directions, pixels in camera.generate_rays(rng=pt.rng, sample=sample):
+            film.add(pixels, pt.path_tracing_wavefront(origins, directions, pixels, sample))
+    return film
+
+
+def test_two_workers_match_single_process(tmp_path):
+    sdl_file = small_scene(tmp_path)
+    # one sample per unit, so a unit sums exactly what a pass adds
+    coordinator = Coordinator(sdl_file, PASSES, tile_size=8, unit_samples=1, seed=SEED)
+    port = free_port()
+
+    workers = start_workers(2, HOST, port, retry=10)
+    try:
+        film = asyncio.run(coordinator.run(HOST, port))
+    finally:
+        stop_workers(workers)
+
+    expected = single_process(sdl_file, coordinator.integrator, coordinator.options)
+    assert np.all(film.counts == PASSES)
+    assert np.array_equal(film.radiance, expected.radiance)
+    assert np.array_equal(film.squares, expected.squares)